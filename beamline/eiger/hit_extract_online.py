@@ -64,18 +64,25 @@ def create_hitsonly_h5(master_h5, dbfile, hits_h5, spots_min):
     for k in h["/entry/data"].keys():
         del h["/entry/data"][k]
 
-    for name, nsp in sorted(hits):
+    nspots = {} # {frameno: (name, nsp)}
+    for name, nsp in hits:
+        nspots[int(os.path.splitext(name[len(prefix):])[0])] = (name, nsp)
+
+    # each data file is opened once; bslz4 frames are copied without decompression
+    rootgrp = h["/entry/data"]
+    for frameno, frame in eiger.iter_frames_raw(master_h5, nspots.keys()):
+        name, nsp = nspots.pop(frameno)
         print " hit: %s %d" %(name, nsp)
-        frameno = int(os.path.splitext(name[len(prefix):])[0])
-        data = eiger.extract_data(master_h5, frameno, return_raw=True)
         grpname = "%s%.6d"%(prefix, frameno)
-        rootgrp = h["/entry/data"]
         rootgrp.create_group(grpname)
-        if data is not None:
-            eiger.compress_h5data(h, "/entry/data/%s/data"%grpname, data, chunks=None, compression="bslz4")
-            rootgrp["%s/data"%grpname].attrs["n_spots"] = nsp
-        else:
-            print "  error: data not found (%s)" % name
+        eiger.write_frame(h, "/entry/data/%s/data"%grpname, frame, compression="bslz4")
+        rootgrp["%s/data"%grpname].attrs["n_spots"] = nsp
+
+    for frameno in sorted(nspots):
+        name, nsp = nspots[frameno]
+        print " hit: %s %d" %(name, nsp)
+        rootgrp.create_group("%s%.6d"%(prefix, frameno))
+        print "  error: data not found (%s)" % name
 
     h.close()
 
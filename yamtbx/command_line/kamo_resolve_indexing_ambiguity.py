@@ -33,6 +33,9 @@ dry_run = False
 skip_bad_files = False
  .type = bool
  .help = "Set true if you want to ignore bad files (too few reflections)"
+xds_ascii_cache = False
+ .type = bool
+ .help = "Keep binary cache of reflection data (.XDS_ASCII.HKL.npz) next to each input file for faster re-reading in later runs."
 
 d_min = 3
  .type = float
@@ -72,11 +75,11 @@ def run(params):
     if params.method == "brehm_diederichs":
         rb = BrehmDiederichs(xac_files, max_delta=params.max_delta,
                              d_min=params.d_min, min_ios=params.min_ios,
-                             nproc=params.nproc, log_out=log_out)
+                             nproc=params.nproc, log_out=log_out, use_cache=params.xds_ascii_cache)
     elif params.method == "selective_breeding":
         rb = KabschSelectiveBreeding(xac_files, max_delta=params.max_delta,
                                      d_min=params.d_min, min_ios=params.min_ios,
-                                     nproc=params.nproc, log_out=log_out)
+                                     nproc=params.nproc, log_out=log_out, use_cache=params.xds_ascii_cache)
     elif params.method == "reference":
         import iotbx.file_reader
 
@@ -116,7 +119,7 @@ def run(params):
 
         rb = ReferenceBased(xac_files, ref_array, max_delta=params.max_delta,
                             d_min=params.d_min, min_ios=params.min_ios,
-                            nproc=params.nproc, log_out=log_out)
+                            nproc=params.nproc, log_out=log_out, use_cache=params.xds_ascii_cache)
     else:
         raise "Unknown method: %s" % params.method
 
@@ -28,6 +28,7 @@ import numpy
 import shutil
 from yamtbx.dataproc.xds import xds_ascii
 from yamtbx.dataproc.xds import integrate_hkl_as_flex
+from yamtbx.dataproc.auto.cluster_stats import ClusterCompleteness
 from yamtbx import util
 from cctbx.array_family import flex
 from cctbx import miller
@@ -92,12 +93,12 @@ cat(JSON, file="dendro.json")
 
 # run_blend0R()
 
-def load_xds_data_only_indices(xac_files, d_min=None):
+def load_xds_data_only_indices(xac_files, d_min=None, use_cache=False):
     miller_sets = {}
     for f in xac_files:
         if xds_ascii.is_xds_ascii(f):
             print "Loading", f
-            ms = xds_ascii.XDS_ASCII(f, i_only=True).as_miller_set()
+            ms = xds_ascii.XDS_ASCII(f, i_only=True, use_cache=use_cache).as_miller_set()
             miller_sets[f] = ms.resolution_filter(d_min=d_min)
         elif integrate_hkl_as_flex.is_integrate_hkl(f):
             print "Sorry, skipping", f
@@ -107,16 +108,18 @@ def load_xds_data_only_indices(xac_files, d_min=None):
 # load_xds_data_only_indices()
 
 class BlendClusters:
-    def __init__(self, workdir=None, d_min=None, load_results=True):
+    def __init__(self, workdir=None, d_min=None, load_results=True, use_cache=False):
         self.workdir = workdir
         self.d_min = d_min
+        self.use_cache = use_cache # for XDS_ASCII
 
         self.clusters = {} # clno -> (cluster_height, LCV, aLCV, IDs)
         self.files = None
 
         if load_results:
             self.read_results()
-            self.miller_sets = load_xds_data_only_indices(xac_files=self.files, d_min=self.d_min)
+            self.miller_sets = load_xds_data_only_indices(xac_files=self.files, d_min=self.d_min,
+                                                          use_cache=self.use_cache)
     # __init__()
 
     def read_results(self):
@@ -186,10 +189,12 @@ class BlendClusters:
 
     def show_cluster_summary(self, out=null_out()):
         tmp = []
+        cmpl_stats = ClusterCompleteness(map(lambda x: self.miller_sets[x], self.files), d_min=self.d_min)
+        cmpl_stats = cmpl_stats.calc(dict(map(lambda x: (x, map(lambda y: y-1, self.clusters[x][3])), self.clusters)))
+
         for clno in self.clusters:
             cluster_height, LCV, aLCV, IDs = self.clusters[clno]
-            cmpl, redun = self.cluster_completeness(clno, anomalous_flag=False)
-            acmpl, aredun = self.cluster_completeness(clno, anomalous_flag=True)
+            cmpl, redun, acmpl, aredun = cmpl_stats[clno]
             tmp.append((clno, IDs, cluster_height, cmpl*100., redun, acmpl*100., aredun, LCV, aLCV))
 
         tmp.sort(key=lambda x: (-x[4], -x[3])) # redundancy & completeness
@@ -6,15 +6,18 @@ This software is released under the new BSD License; see LICENSE.
 """
 from cctbx.array_family import flex
 from cctbx import miller
-from libtbx import easy_mp
 from libtbx.utils import null_out
 from libtbx.utils import Sorry
 from yamtbx.util import call
 from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
 from yamtbx.dataproc.auto.blend import load_xds_data_only_indices
+from yamtbx.dataproc.auto.cc_matrix import IntensityMatrix, rows_covering_pairs
+from yamtbx.dataproc.auto.cluster_stats import ClusterCompleteness
+from yamtbx.dataproc import blend_lcv
 import os
 import numpy
 import collections
+import sqlite3
 import scipy.cluster
 import scipy.spatial
 import json
@@ -31,11 +34,11 @@ def calc_cc(ari, arj):
       return float("nan"), ari.size()
 # calc_cc()
 
-def read_xac_files(xac_files, d_min=None, d_max=None, min_ios=None):
+def read_xac_files(xac_files, d_min=None, d_max=None, min_ios=None, use_cache=False):
     arrays = collections.OrderedDict()
 
     for f in xac_files:
-        xac = XDS_ASCII(f, i_only=True)
+        xac = XDS_ASCII(f, i_only=True, use_cache=use_cache)
         xac.remove_rejected()
         a = xac.i_obs().resolution_filter(d_min=d_min, d_max=d_max)
         a = a.as_non_anomalous_array().merge_equivalents(use_internal_variance=False).array()
@@ -45,11 +48,65 @@ def read_xac_files(xac_files, d_min=None, d_max=None, min_ios=None):
     return arrays
 # read_xac_files()
 
+def file_identity(f):
+    st = os.stat(f)
+    return "%s|%d|%.6f" % (os.path.abspath(f), st.st_size, st.st_mtime)
+# file_identity()
+
+class PairwiseCCStore:
+    """
+    Persistent store (sqlite3) of pairwise CCs.
+    A pair is identified by identities of the two files (path, size and mtime) and
+    the settings string, which must include everything that changes CC values.
+    """
+
+    def __init__(self, dbfile, settings):
+        self.dbfile = dbfile
+        self.settings = settings
+        con = sqlite3.connect(self.dbfile, timeout=30)
+        con.execute("create table if not exists cc (settings text, file1 text, file2 text, cc real, nref integer, primary key (settings, file1, file2))")
+        con.commit()
+        con.close()
+    # __init__()
+
+    @staticmethod
+    def pair_key(fid1, fid2): return (min(fid1, fid2), max(fid1, fid2))
+
+    def get(self, file_ids):
+        """
+        Returns {(file1, file2): (cc, nref), ...} for pairs among file_ids.
+        """
+        file_ids = set(file_ids)
+        ret = {}
+        con = sqlite3.connect(self.dbfile, timeout=30)
+        for f1, f2, cc, nref in con.execute("select file1, file2, cc, nref from cc where settings=?", (self.settings,)):
+            if f1 not in file_ids or f2 not in file_ids: continue
+            ret[(f1, f2)] = (float("nan") if cc is None else cc, nref) # NaN is stored as NULL
+        con.close()
+        return ret
+    # get()
+
+    def add(self, entries):
+        """
+        entries: [(file1, file2, cc, nref), ...]
+        """
+        con = sqlite3.connect(self.dbfile, timeout=30)
+        con.executemany("insert or replace into cc values (?,?,?,?,?)",
+                        ((self.settings, f1, f2, cc if cc==cc else None, nref) for f1, f2, cc, nref in entries))
+        con.commit()
+        con.close()
+    # add()
+
+# class PairwiseCCStore
+
 class CCClustering:
-    def __init__(self, wdir, xac_files, d_min=None, d_max=None, min_ios=None):
-        self.arrays = read_xac_files(xac_files, d_min=d_min, d_max=d_max, min_ios=min_ios)
+    def __init__(self, wdir, xac_files, d_min=None, d_max=None, min_ios=None, use_cache=False):
+        self.arrays = read_xac_files(xac_files, d_min=d_min, d_max=d_max, min_ios=min_ios, use_cache=use_cache)
+        self.d_min, self.d_max, self.min_ios = d_min, d_max, min_ios
+        self.use_cache = use_cache # for XDS_ASCII
         self.wdir = wdir
         self.clusters = {}
+        self.cluster_lcv = {} # {clno:(LCV, aLCV), ...}
         self.all_cc = {} # {(i,j):cc, ...}
         
         if not os.path.exists(self.wdir): os.makedirs(self.wdir)
@@ -57,16 +114,53 @@ class CCClustering:
         open(os.path.join(self.wdir, "filenames.lst"), "w").write("\n".join(xac_files))
     # __init__()
 
-    def do_clustering(self, nproc=1, b_scale=False, use_normalized=False, cluster_method="ward", distance_eqn="sqrt(1-cc)", min_common_refs=3, html_maker=None):
+    def calc_cc_with_store(self, args, cc_store, nproc=1):
+        """
+        Calculate CCs for pairs in args, reusing ones in cc_store (PairwiseCCStore).
+        Only rows (datasets) needed to cover uncalculated pairs are calculated.
+        """
+        file_ids = map(file_identity, self.arrays.keys())
+        cached = cc_store.get(file_ids)
+        pair_key = lambda i, j: cc_store.pair_key(file_ids[i], file_ids[j])
+
+        missing = numpy.zeros((len(file_ids),)*2, dtype=bool)
+        for i, j in args:
+            if pair_key(i, j) not in cached: missing[i,j] = missing[j,i] = True
+
+        rows = rows_covering_pairs(missing)
+        print "CC store: %d pairs reused; calculating CCs for %d of %d datasets" % (len(args)-missing.sum()//2, len(rows), len(file_ids))
+        if rows: cc_rows, nref_rows = IntensityMatrix(self.arrays.values()).calc_cc_rows(rows, nproc=nproc)
+        rowpos = dict(map(lambda x: (x[1], x[0]), enumerate(rows)))
+
+        results, new_entries = [], []
+        for i, j in args:
+            key = pair_key(i, j)
+            if key in cached:
+                results.append(cached[key])
+                continue
+
+            if i in rowpos: cc, nref = cc_rows[rowpos[i], j], nref_rows[rowpos[i], j]
+            else: cc, nref = cc_rows[rowpos[j], i], nref_rows[rowpos[j], i]
+            results.append((float(cc), int(nref)))
+            new_entries.append(key + results[-1])
+
+        cc_store.add(new_entries)
+        return results
+    # calc_cc_with_store()
+
+    def do_clustering(self, nproc=1, b_scale=False, use_normalized=False, cluster_method="ward", distance_eqn="sqrt(1-cc)", min_common_refs=3, html_maker=None, cc_store_file=None):
         """
         Using correlation as distance metric (for hierarchical clustering)
         https://stats.stackexchange.com/questions/165194/using-correlation-as-distance-metric-for-hierarchical-clustering
 
         Correlation "Distances" and Hierarchical Clustering
         http://research.stowers.org/mcm/efg/R/Visualization/cor-cluster/index.htm
+
+        If cc_store_file is given, pairwise CCs are saved in the file and reused in later runs with the same settings.
         """
 
         self.clusters = {}
+        self.cluster_lcv = {}
         prefix = os.path.join(self.wdir, "cctable")
         assert (b_scale, use_normalized).count(True) <= 1
 
@@ -126,11 +220,14 @@ class CCClustering:
             for j in xrange(i+1, len(self.arrays)):
                 args.append((i,j))
            
-        # Calc all CC
-        worker = lambda x: calc_cc(self.arrays.values()[x[0]], self.arrays.values()[x[1]])
-        results = easy_mp.pool_map(fixed_func=worker,
-                                   args=args,
-                                   processes=nproc)
+        # Calc all CC (same as calc_cc() for each pair)
+        if cc_store_file:
+            settings = "d_min=%s d_max=%s min_ios=%s b_scale=%s use_normalized=%s" % (self.d_min, self.d_max, self.min_ios,
+                                                                                      b_scale, use_normalized)
+            results = self.calc_cc_with_store(args, PairwiseCCStore(cc_store_file, settings), nproc=nproc)
+        else:
+            cc_all, nref_all = IntensityMatrix(self.arrays.values()).calc_all_cc(nproc=nproc)
+            results = map(lambda x: (float(cc_all[x]), int(nref_all[x])), args)
 
         # Check NaN and decide which data to remove
         idx_bad = {}
@@ -192,6 +289,11 @@ class CCClustering:
         pyplot.savefig(os.path.join(self.wdir, "tree.png"))
         pyplot.savefig(os.path.join(self.wdir, "tree.pdf"))
 
+        # LCV & aLCV of all clusters; cluster number is row number of Z + 1
+        cells = map(lambda x: self.arrays.values()[x].unit_cell().parameters(), org2now.keys())
+        lcvs, alcvs = blend_lcv.calc_lcv_on_linkage(cells, Z)
+        for k in xrange(len(lcvs)): self.cluster_lcv[k+1] = (float(lcvs[k]), float(alcvs[k]))
+
         def traverse(node, results, dendro):
             # Cluster id starts with the number of data files
             leaves = map(lambda x: hclabels[x], sorted(node.pre_order())) # file numbers
@@ -274,12 +376,14 @@ class CCClustering:
     
     def show_cluster_summary(self, d_min, out=null_out()):
         tmp = []
-        self.miller_sets = load_xds_data_only_indices(xac_files=self.arrays.keys(), d_min=d_min)
+        self.miller_sets = load_xds_data_only_indices(xac_files=self.arrays.keys(), d_min=d_min,
+                                                     use_cache=self.use_cache)
+        cmpl_stats = ClusterCompleteness(map(lambda x: self.miller_sets[x], self.arrays.keys()), d_min=d_min)
+        cmpl_stats = cmpl_stats.calc(dict(map(lambda x: (x, map(lambda y: y-1, self.clusters[x][1])), self.clusters)))
 
         for clno in self.clusters:
             cluster_height, IDs = self.clusters[clno]
-            cmpl, redun = self.cluster_completeness(clno, anomalous_flag=False, d_min=d_min)
-            acmpl, aredun = self.cluster_completeness(clno, anomalous_flag=True, d_min=d_min)
+            cmpl, redun, acmpl, aredun = cmpl_stats[clno]
             all_cc = self.get_all_cc_in_cluster(clno)
             ccmean, ccmin = numpy.mean(all_cc), min(all_cc)
             tmp.append((clno, IDs, cluster_height, cmpl*100., redun, acmpl*100., aredun, ccmean, ccmin))
@@ -289,10 +393,11 @@ class CCClustering:
         tmp.sort(key=lambda x: (-x[4], -x[3])) # redundancy & completeness
         out.write("# d_min= %.3f\n" % (d_min))
         out.write("# Sorted by redundancy & completeness\n")
-        out.write("Cluster Number   CLh   Cmpl Redun  ACmpl ARedun CCmean CCmin\n")
+        out.write("Cluster Number   CLh   Cmpl Redun  ACmpl ARedun CCmean CCmin  LCV  aLCV\n")
         for clno, IDs, clh, cmpl, redun, acmpl, aredun, ccmean, ccmin in tmp:
-            out.write("%7d %6d %5.1f %6.2f %5.1f %6.2f %5.1f %.4f %.4f\n" % (clno, len(IDs), clh, cmpl, redun,
-                                                                             acmpl, aredun, ccmean, ccmin))
+            out.write("%7d %6d %5.1f %6.2f %5.1f %6.2f %5.1f %.4f %.4f %5.1f %5.1f\n" % ((clno, len(IDs), clh, cmpl, redun,
+                                                                                       acmpl, aredun, ccmean, ccmin) +
+                                                                                      self.cluster_lcv.get(clno, (float("nan"),)*2)))
         return tmp
     # show_cluster_summary()
 
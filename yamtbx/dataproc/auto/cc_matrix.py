@@ -0,0 +1,173 @@
+"""
+(c) RIKEN 2017. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+All pairwise correlation coefficients between many datasets as matrix operations.
+
+Every dataset is mapped once onto one shared index space of unique reflections,
+and the intensities are held in a sparse matrix (datasets x unique hkl).
+For a pair (i,j), CC on common reflections is obtained from the sums
+  n = sum m_i m_j,  sx = sum x_i m_j,  sxx = sum x_i^2 m_j,  sxy = sum x_i x_j
+where m is 1 if observed and 0 otherwise, so all of them are matrix products.
+"""
+
+import numpy
+import scipy.sparse
+from yamtbx.util.shm import shared_copy, shared_empty, run_tasks
+
+def miller_index_keys(indices):
+    """
+    Encode flex.miller_index as numpy int64 keys, with 21 bits for each index (|h|,|k|,|l| must be < 2**20).
+    Keys are in the same order as the indices sorted by (h, k, l).
+    """
+    hkl = indices.as_vec3_double().as_double().as_numpy_array().astype(numpy.int64).reshape(-1, 3)
+    if hkl.size > 0 and numpy.abs(hkl).max() >= 2**20:
+        raise ValueError("Miller index out of range for encoding: %d" % numpy.abs(hkl).max())
+    hkl += 2**20
+    return (hkl[:,0] << 42) | (hkl[:,1] << 21) | hkl[:,2]
+# miller_index_keys()
+
+def cc_from_sums(n, sx, sy, sxx, syy, sxy):
+    """
+    Pearson's correlation coefficients from (arrays of) sums over common reflections.
+    NaN where not well defined, as flex.linear_correlation does.
+    """
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        vx = n * sxx - sx**2
+        vy = n * syy - sy**2
+        cc = (n * sxy - sx * sy) / numpy.sqrt(vx * vy)
+
+    # vx and vy are zero for constant data but may not be exactly zero numerically
+    well_defined = (n > 1) & (vx > 1.e-12 * n * sxx) & (vy > 1.e-12 * n * syy)
+    cc[~well_defined] = numpy.nan
+    return cc
+# cc_from_sums()
+
+def reindexed_keys(arrays, op=None):
+    """
+    Keys of indices of arrays after reindexing by op and mapping to the asymmetric unit.
+    """
+    ret = []
+    for a in arrays:
+        if op is not None and not op.is_identity_op():
+            a = a.customized_copy(indices=op.apply(a.indices())).map_to_asu()
+        ret.append(miller_index_keys(a.indices()))
+    return ret
+# reindexed_keys()
+
+def shared_csr_matrix(m):
+    """
+    Copy of csr matrix whose arrays are on shared memory
+    """
+    return scipy.sparse.csr_matrix((shared_copy(m.data), shared_copy(m.indices), shared_copy(m.indptr)),
+                                   shape=m.shape, copy=False)
+# shared_csr_matrix()
+
+class IntensityMatrix:
+    """
+    Sparse intensity matrix (datasets x unique reflections).
+    Arrays must be merged (unique indices) and share the same asymmetric unit.
+    Intensities are standardized per dataset; this does not change CC but avoids loss of precision.
+    Matrices are on shared memory, so that worker processes never copy them.
+
+    keys: list of index keys of each array, if different from indices of arrays (e.g. reindexed ones).
+    unique_keys: sorted keys of common reflection table shared by other IntensityMatrix objects.
+                 It must contain all keys of arrays.
+    """
+
+    def __init__(self, arrays, keys=None, unique_keys=None):
+        if keys is None: keys = map(lambda x: miller_index_keys(x.indices()), arrays)
+        self.n_sets = len(arrays)
+        if unique_keys is None:
+            self.unique_keys, cols = numpy.unique(numpy.concatenate(keys), return_inverse=True)
+        else:
+            self.unique_keys, cols = unique_keys, numpy.searchsorted(unique_keys, numpy.concatenate(keys))
+        rows = numpy.repeat(numpy.arange(self.n_sets), map(len, keys))
+        shape = (self.n_sets, len(self.unique_keys))
+
+        data = []
+        for a in arrays:
+            x = a.data().as_numpy_array()
+            if x.size > 0:
+                x = x - x.mean()
+                sd = x.std()
+                if sd > 0: x /= sd
+            data.append(x)
+        data = numpy.concatenate(data)
+
+        self.X = shared_csr_matrix(scipy.sparse.csr_matrix((data, (rows, cols)), shape=shape))
+        self.X2 = shared_csr_matrix(scipy.sparse.csr_matrix((data**2, (rows, cols)), shape=shape))
+        self.M = shared_csr_matrix(scipy.sparse.csr_matrix((numpy.ones(data.size), (rows, cols)), shape=shape))
+    # __init__()
+
+    def calc_cc_block(self, rows, other=None):
+        """
+        CC and number of common reflections between datasets in rows (slice or list of indices) and all datasets of other.
+        other must share the reflection table (unique_keys); self is used if None.
+        Returns (cc, nref) arrays of shape (len(rows), other.n_sets).
+        """
+        if other is None: other = self
+        Xb, X2b, Mb = self.X[rows], self.X2[rows], self.M[rows]
+
+        n = Mb.dot(other.M.T).toarray()
+        sx = Xb.dot(other.M.T).toarray()
+        sy = Mb.dot(other.X.T).toarray()
+        sxx = X2b.dot(other.M.T).toarray()
+        syy = Mb.dot(other.X2.T).toarray()
+        sxy = Xb.dot(other.X.T).toarray()
+
+        return cc_from_sums(n, sx, sy, sxx, syy, sxy), numpy.rint(n).astype(int)
+    # calc_cc_block()
+
+    def calc_cc_rows(self, rows, nproc=1, max_block_elements=4000000, other=None):
+        """
+        Returns (cc, nref) matrices of shape (len(rows), other.n_sets). See calc_cc_block().
+        Row blocks are limited to max_block_elements elements of intermediate matrices.
+        Workers write results of each block directly into the shared result matrices.
+        """
+        if other is None: other = self
+        N = other.n_sets
+        rows = list(rows)
+        bsize = max(1, min(len(rows), max_block_elements // max(1, N)))
+        cc = shared_empty((len(rows), N))
+        nref = shared_empty((len(rows), N), dtype=int)
+
+        def work(iblock):
+            s = iblock * bsize
+            cc[s:s+bsize], nref[s:s+bsize] = self.calc_cc_block(rows[s:s+bsize], other)
+        # work()
+
+        run_tasks(work, xrange((len(rows)+bsize-1)//bsize), nproc)
+        return cc, nref
+    # calc_cc_rows()
+
+    def calc_all_cc(self, nproc=1, max_block_elements=4000000):
+        """
+        Returns (cc, nref) matrices of shape (n_sets, n_sets).
+        """
+        return self.calc_cc_rows(xrange(self.n_sets), nproc, max_block_elements)
+    # calc_all_cc()
+
+# class IntensityMatrix
+
+def rows_covering_pairs(missing):
+    """
+    Choose datasets (rows) so that every pair marked in missing (symmetric boolean NxN matrix)
+    involves at least one of them. Greedy; when K new datasets are added to N known ones,
+    only the K new ones are chosen.
+    """
+    missing = missing.copy()
+    counts = missing.sum(axis=1)
+    rows = []
+    while counts.size > 0 and counts.max() > 0:
+        p = int(counts.argmax())
+        rows.append(p)
+        counts -= missing[:,p]
+        counts[p] = 0
+        missing[p,:] = False
+        missing[:,p] = False
+    return sorted(rows)
+# rows_covering_pairs()
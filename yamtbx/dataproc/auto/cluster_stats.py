@@ -0,0 +1,107 @@
+"""
+(c) RIKEN 2017. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Completeness and redundancy of all clusters of a dendrogram.
+
+Each dataset is mapped once onto ids of unique reflections in the asymmetric unit
+(with and without anomalous flag), and kept as sparse observation counts.
+Counts of a cluster are the sum of counts of its largest sub-clusters, so clusters are
+processed from smaller to larger ones and each count vector is merged only once.
+"""
+
+import numpy
+from cctbx import miller
+from yamtbx.dataproc.auto.cc_matrix import miller_index_keys
+
+def sum_counts(nodes):
+    """
+    Sum of sparse count vectors; nodes are list of (sorted ids, counts)
+    """
+    if len(nodes) == 1: return nodes[0]
+    ids, inv = numpy.unique(numpy.concatenate(map(lambda x: x[0], nodes)), return_inverse=True)
+    return ids, numpy.bincount(inv, weights=numpy.concatenate(map(lambda x: x[1], nodes)))
+# sum_counts()
+
+class ClusterCompleteness:
+    """
+    miller_sets: list of (unmerged) miller sets of datasets in the same Laue group and setting.
+    The reference complete sets are made with the median cell of all datasets, instead of the median
+    cell of each cluster. Completeness of a cluster is calculated up to the highest resolution of its
+    datasets (but not beyond d_min if given).
+    """
+    def __init__(self, miller_sets, d_min=None):
+        cells = numpy.array(map(lambda x: x.unit_cell().parameters(), miller_sets))
+        median_cell = map(lambda i: numpy.median(cells[:,i]), xrange(6))
+        symm = miller_sets[0].customized_copy(unit_cell=median_cell)
+        self.leaf_d_min = numpy.array(map(lambda x: x.customized_copy(unit_cell=median_cell).d_min() if x.size() > 0 else float("inf"),
+                                          miller_sets))
+        if d_min is not None: self.leaf_d_min = numpy.maximum(self.leaf_d_min, d_min)
+
+        self.ref_d, self.leaves = {}, {}
+        for anomalous_flag in (False, True):
+            ref_set = miller.build_set(crystal_symmetry=symm, anomalous_flag=anomalous_flag,
+                                       d_min=self.leaf_d_min.min()*(1.-1.e-6))
+            ref_keys = numpy.sort(miller_index_keys(ref_set.indices()))
+            self.ref_d[anomalous_flag] = numpy.sort(ref_set.d_spacings().data().as_numpy_array()) # ascending
+            leaves = []
+            for ms in miller_sets:
+                ms = ms.customized_copy(crystal_symmetry=symm, anomalous_flag=anomalous_flag).map_to_asu()
+                keys = miller_index_keys(ms.indices())
+                pos = numpy.minimum(numpy.searchsorted(ref_keys, keys), max(0, ref_keys.size-1))
+                ids, inv = numpy.unique(pos[ref_keys[pos] == keys], return_inverse=True) # outside resolution or absent are excluded
+                leaves.append((ids, numpy.bincount(inv).astype(numpy.float64)))
+            self.leaves[anomalous_flag] = leaves
+    # __init__()
+
+    def n_complete(self, anomalous_flag, d_min):
+        """
+        Number of reference reflections with d >= d_min
+        """
+        ref_d = self.ref_d[anomalous_flag]
+        return ref_d.size - numpy.searchsorted(ref_d, d_min*(1.-1.e-6))
+    # n_complete()
+
+    def calc(self, clusters):
+        """
+        clusters: dict of cluster number: list of dataset indices (0-based, in the order of miller_sets)
+        Returns dict of cluster number: (cmpl, redun, acmpl, aredun); completeness is in fraction.
+        Clusters are expected to be nested as a tree; otherwise counts are summed up from datasets.
+        """
+        ret = dict(map(lambda x: (x, []), clusters))
+        for anomalous_flag in (False, True):
+            leaves = self.leaves[anomalous_flag]
+            nodes = {}
+            top = -1 - numpy.arange(len(leaves)) # largest node containing each dataset; negative for dataset itself
+            getnode = lambda x: nodes[x] if x >= 0 else leaves[-1-x]
+
+            for i, clno in enumerate(sorted(clusters, key=lambda x: len(clusters[x]))):
+                idxes = numpy.unique(numpy.array(clusters[clno], dtype=int))
+                if idxes.size > 0 and (idxes[0] < 0 or idxes[-1] >= len(leaves)):
+                    raise IndexError("dataset index out of range in cluster %s" % clno)
+
+                children = numpy.unique(top[idxes])
+                members = numpy.concatenate(map(lambda x: nodes[x][2] if x >= 0 else [-1-x], children))
+                if members.size == idxes.size and numpy.in1d(members, idxes).all(): # sub-clusters are disjoint and inside
+                    ids, counts = sum_counts(map(lambda x: getnode(x)[:2], children))
+                    d_min = min(map(lambda x: nodes[x][3] if x >= 0 else self.leaf_d_min[-1-x], children))
+                    for x in children:
+                        if x >= 0: del nodes[x]
+                else:
+                    ids, counts = sum_counts(map(lambda x: leaves[x], idxes))
+                    d_min = self.leaf_d_min[idxes].min() if idxes.size > 0 else float("inf")
+
+                nodes[i] = (ids, counts, idxes, d_min)
+                top[idxes] = i
+                n_complete = self.n_complete(anomalous_flag, d_min) if numpy.isfinite(d_min) else 0
+                cmpl = float(len(ids)) / n_complete if n_complete > 0 else float("nan")
+                redun = counts.sum() / len(ids) if len(ids) > 0 else float("nan")
+                ret[clno].extend([cmpl, redun])
+
+        return dict(map(lambda x: (x[0], tuple(x[1])), ret.items()))
+    # calc()
+
+# class ClusterCompleteness
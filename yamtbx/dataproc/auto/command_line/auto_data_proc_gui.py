@@ -54,6 +54,7 @@ import threading
 import traceback
 import pipes
 import copy
+import hashlib
 
 EventShowProcResult, EVT_SHOW_PROC_RESULT = wx.lib.newevent.NewEvent()
 EventLogsUpdated, EVT_LOGS_UPDATED = wx.lib.newevent.NewEvent()
@@ -112,6 +113,10 @@ logwatch_target = local blconfig *dataset_paths_txt
  .help = "How to find datasets. local: just traverse subdirectories to find data;"
          "blconfig: BSS log files in BLCONFIG/log/ are checked;"
          "dataset_paths_txt: on SPring-8 beamlines ~/.dataset_paths_for_kamo_BLNAME.txt is checked, otherwise users should give a path."
+logwatch_inotify = False
+ .type = bool
+ .help = "When logwatch_target=local, use inotify (if installed) to find changed directories instead of checking their modification times."
+         "Do not use when data are written from other hosts on network file system."
 
 dataset_paths_txt = None
  .type = path
@@ -286,8 +291,10 @@ class BssJobs:
         self._joblogs = []
         self._chaches = {} # chache logfile objects. {filename: [timestamp, objects..]
         self.cell_graph = CellGraph(tol_length=config.params.merging.cell_grouping.tol_length,
-                                    tol_angle=config.params.merging.cell_grouping.tol_angle)
+                                    tol_angle=config.params.merging.cell_grouping.tol_angle,
+                                    cbop_cache_file=os.path.join(config.params.workdir, "cell_graph_cbops.dat"))
         self.xds_inp_overrides = []
+        self.dataset_catalogs = {} # {directory: dataset.DatasetCatalog} for update_jobs_from_files()
     # __init__()
 
     def load_override_geometry(self, ref_file):
@@ -559,7 +566,16 @@ class BssJobs:
         # XXX what if include_dir has sub directories..
 
         for rd in include_dir:
-            for ds in dataset.find_data_sets(rd, skip_0=True, skip_symlinks=False, split_hdf_miniset=config.params.split_hdf_miniset):
+            first_time = rd not in self.dataset_catalogs
+            if first_time:
+                cache_file = os.path.join(config.params.workdir, "dataset_catalog_%s.pkl" % hashlib.md5(os.path.abspath(rd)).hexdigest()[:8])
+                self.dataset_catalogs[rd] = dataset.DatasetCatalog(rd, skip_0=True, skip_symlinks=False,
+                                                                   split_hdf_miniset=config.params.split_hdf_miniset,
+                                                                   cache_file=cache_file,
+                                                                   use_inotify=config.params.logwatch_inotify)
+
+            all_ds, new_ds = self.dataset_catalogs[rd].update()
+            for ds in (all_ds if first_time else new_ds): # datasets not changed are already registered
                 self._register_job_from_file(ds, root_dir, exclude_dir)
 
         # Dump jobs
@@ -752,6 +768,10 @@ run_dials_auto.run_dials_sequence(**pickle.load(open("args.pkl")))
         if config.params.engine == "xds":
             correct_lp = os.path.join(workdir, "CORRECT.LP")
 
+            if key not in self.procjobs:
+                job = batchjobs.restore_job(workdir, "xds_auto.sh") # submitted before restart
+                if job is not None: self.procjobs[key] = job
+
             if key not in self.procjobs:
                 if os.path.exists(os.path.join(workdir, "decision.log")):
                     state = batchjob.STATE_FINISHED
@@ -781,6 +801,10 @@ run_dials_auto.run_dials_sequence(**pickle.load(open("args.pkl")))
         elif config.params.engine == "dials":
             summary_pkl = os.path.join(workdir, "kamo_dials.pkl")
 
+            if key not in self.procjobs:
+                job = batchjobs.restore_job(workdir, "dials_auto.sh") # submitted before restart
+                if job is not None: self.procjobs[key] = job
+
             if key not in self.procjobs:
                 if os.path.exists(os.path.join(workdir, "dials_sequence.log")):
                     state = batchjob.STATE_FINISHED
@@ -1983,9 +2007,11 @@ This is an alpha-version. If you found something wrong, please let staff know! W
     if config.params.batch.engine == "auto":
         config.params.batch.engine = batchjob.auto_engine()
 
+    jobdb = batchjob.JobDB(os.path.join(config.params.workdir, "batchjobs.db"))
+
     if config.params.batch.engine == "sge":
         try:
-            batchjobs = batchjob.SGE(pe_name=config.params.batch.sge_pe_name)
+            batchjobs = batchjob.SGE(pe_name=config.params.batch.sge_pe_name, jobdb=jobdb)
         except batchjob.SgeError, e:
             mylog.error(e.message)
             mylog.error("SGE not configured. If you want to run KAMO on your local computer only (not to use queueing system), please specify batch.engine=sh")
@@ -1999,7 +2025,7 @@ This is an alpha-version. If you found something wrong, please let staff know! W
             else:
                 config.params.batch.nproc_each = nproc_all
                 config.params.batch.sh_max_jobs = 1
-        batchjobs = batchjob.ExecLocal(max_parallel=config.params.batch.sh_max_jobs)
+        batchjobs = batchjob.ExecLocal(max_parallel=config.params.batch.sh_max_jobs, jobdb=jobdb)
     else:
         print(config.params.batch.engine)
         raise ("Unknown batch engine: %s" % config.params.batch.engine)
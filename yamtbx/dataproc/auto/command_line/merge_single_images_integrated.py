@@ -7,12 +7,12 @@ This software is released under the new BSD License; see LICENSE.
 from yamtbx.dataproc.xds import xds_ascii
 from yamtbx.dataproc.crystfel import hkl as crystfel_hkl
 from yamtbx.util import read_path_list
+from yamtbx.util.shm import iter_tasks
 import yamtbx_utils_ext
 from cctbx import miller
 from cctbx import crystal
 from cctbx import sgtbx
 from cctbx.array_family import flex
-from libtbx import easy_mp
 import iotbx.scalepack.merge
 import iotbx.phil
 import libtbx.phil
@@ -20,7 +20,6 @@ import os
 import sys
 import numpy
 import random
-import multiprocessing
 import threading
 import cPickle as pickle
 
@@ -328,10 +327,8 @@ def mc_integration(params, input_files, input_type, scale_ref=None, split_idxes=
 
     sgtype = sgtbx.space_group_info(params.space_group).type()
 
-    manager = multiprocessing.Manager()
-    scale_strs = manager.list()
-
-    def load_xds_or_dials(i, file_in, scout):
+    def load_xds_or_dials(i):
+        file_in = input_files[i]
         print "Reading %5d %s" %(i, file_in if input_type=="xds_ascii" else file_in[1])
         if input_type=="xds_ascii":
             tmp = get_data_from_xac(params, file_in)
@@ -342,10 +339,10 @@ def mc_integration(params, input_files, input_type, scale_ref=None, split_idxes=
                           params.anomalous_flag,
                           tmp.indices())
 
-        k, b = None, None
+        k, b, scale_str = None, None, None
         if scale_ref is not None:
             k, b, cc = scale_data(tmp.indices(), tmp.data(), scale_ref, params.scaling.parameter, params.scaling.calc_cc)
-            scout.append("%s %.4e %.4e %.4f\n" % (file_in if input_type=="xds_ascii" else file_in[1], k, b, cc))
+            scale_str = "%s %.4e %.4e %.4f\n" % (file_in if input_type=="xds_ascii" else file_in[1], k, b, cc)
             #tmp.iobs *= k
             #tmp.sigma_iobs *= k
 
@@ -354,17 +351,18 @@ def mc_integration(params, input_files, input_type, scale_ref=None, split_idxes=
             #    tmp.iobs *= flex.exp(-b*d_star_sq)
             #    tmp.sigma_iobs *= flex.exp(-b*d_star_sq)
 
-        return i, tmp, k, b
+        return i, tmp, k, b, scale_str
     # load_xds_or_dials()
 
-    if params.nproc > 1:
-        # It may cost much memory..
-        xds_data = easy_mp.pool_map(fixed_func=lambda x: load_xds_or_dials(x[0],x[1], scale_strs),
-                                    args=map(lambda x:x, enumerate(input_files)),
-                                    processes=params.nproc)
-    else:
-        # create generator
-        xds_data = (load_xds_or_dials(i, x, scale_strs) for i, x in enumerate(input_files))
+    # Files are read and scaled by worker processes, and merged here in the order of input.
+    # Only a limited number of loaded data are kept at a time, whatever the number of files.
+    xds_data = iter_tasks(load_xds_or_dials, xrange(len(input_files)), nproc=params.nproc,
+                          max_pending=params.nproc*4)
+
+    scales_out = None
+    if scale_ref is not None:
+        scales_out = open(params.prefix+"_scales.dat", "w")
+        print >>scales_out, "file k b cc"
 
     merger = yamtbx_dataproc_crystfel_ext.merge_equivalents_crystfel()
     merger_split = None
@@ -375,9 +373,10 @@ def mc_integration(params, input_files, input_type, scale_ref=None, split_idxes=
     cells = []
     bs = [] # b-factor list
     bs_split = [[], []] # b-factor list for split data
-    for i, x, k, b in xds_data:
+    for i, x, k, b, scale_str in xds_data:
         sys.stdout.write("Merging %7d\r" % (i+1))
         sys.stdout.flush()
+        if scale_str is not None: scales_out.write(scale_str)
 
         data, sigmas = x.data(), x.sigmas()
 
@@ -406,10 +405,7 @@ def mc_integration(params, input_files, input_type, scale_ref=None, split_idxes=
 
     print "\nDone."
 
-    if scale_ref is not None:
-        scales_out = open(params.prefix+"_scales.dat", "w")
-        print >>scales_out, "file k b cc"
-        for s in scale_strs: scales_out.write(s)
+    if scales_out is not None: scales_out.close()
 
     # Merge
     if params.sigma_calculation == "population":
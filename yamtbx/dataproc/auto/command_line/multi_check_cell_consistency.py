@@ -21,6 +21,7 @@ from yamtbx.util import xtal
 
 import os
 import sys
+import math
 import networkx as nx
 import numpy
 
@@ -42,8 +43,74 @@ do_pointless = False
  .help = Run pointless for largest group data to determine symmetry
 """
 
+class CellIndex:
+    """
+    Grid index over log of Niggli-reduced cell lengths, to find cells possibly related to a given cell.
+    Cells whose reduced lengths all agree within relative tolerance tol are always in candidates.
+    """
+
+    def __init__(self, tol):
+        self.binw = math.log(1.+tol)
+        self.bins = {} # (ia,ib,ic) -> [key, ...]
+        self.key_bins = {} # key -> (ia,ib,ic)
+    # __init__()
+
+    def _bin(self, cell):
+        return tuple(map(lambda x: int(math.floor(math.log(x)/self.binw)),
+                         cell.niggli_cell().parameters()[:3]))
+    # _bin()
+
+    def add(self, key, cell):
+        b = self._bin(cell)
+        self.bins.setdefault(b, []).append(key)
+        self.key_bins[key] = b
+    # add()
+
+    def candidates(self, cell):
+        ia, ib, ic = self._bin(cell)
+        ret = []
+        for da in (-1,0,1):
+            for db in (-1,0,1):
+                for dc in (-1,0,1):
+                    ret.extend(self.bins.get((ia+da, ib+db, ic+dc), []))
+        return ret
+    # candidates()
+# class CellIndex
+
+class CbopCache:
+    """
+    Persistent cache of results of comparison between two P1 cells.
+    Results are appended to a text file; each line is
+     cell1 ; cell2 ; tol_length tol_angle ; result
+    where result is "similar", "none" (not related), or change-of-basis operator.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.results = {}
+        if filename and os.path.isfile(filename):
+            for l in open(filename):
+                sp = l.rstrip("\n").split(" ; ")
+                if len(sp) == 4: self.results[tuple(sp[:3])] = sp[3]
+    # __init__()
+
+    @staticmethod
+    def make_key(cell1, cell2, tol_length, tol_angle):
+        fmt = lambda c: " ".join(map(lambda x: "%.4f"%x, c.parameters()))
+        return (fmt(cell1), fmt(cell2), "%.4f %.4f" % (tol_length, tol_angle))
+    # make_key()
+
+    def get(self, key): return self.results.get(key)
+
+    def put(self, key, result):
+        self.results[key] = result
+        if self.filename:
+            open(self.filename, "a").write("%s\n" % " ; ".join(key+(result,)))
+    # put()
+# class CbopCache
+
 class CellGraph:
-    def __init__(self, tol_length=None, tol_angle=None):
+    def __init__(self, tol_length=None, tol_angle=None, cbop_cache_file=None):
         self.tol_length = tol_length if tol_length else 0.1
         self.tol_angle = tol_angle if tol_angle else 5
 
@@ -52,8 +119,37 @@ class CellGraph:
         self.dirs = {} # key->xdsdir
         self.symms = {} # key->symms
         self.cbops = {} # (key1,key2) = cbop
+        # Neighbour candidates are searched with twice the tolerance to be safe
+        self.cell_index = CellIndex(2.*self.tol_length)
+        self.cbop_cache = CbopCache(cbop_cache_file)
     # __init__()
 
+    def compare_cells(self, other_cell, p1cell):
+        """
+        Returns "similar" if similar, change-of-basis operator if related by reindexing, otherwise None.
+        Results are cached.
+        """
+        key = self.cbop_cache.make_key(other_cell, p1cell, self.tol_length, self.tol_angle)
+        ret = self.cbop_cache.get(key)
+        if ret is None:
+            if other_cell.is_similar_to(p1cell, self.tol_length, self.tol_angle):
+                ret = "similar"
+            else:
+                cosets = reindex.reindexing_operators(crystal.symmetry(other_cell, 1),
+                                                      crystal.symmetry(p1cell, 1),
+                                                      self.tol_length, self.tol_angle)
+                if cosets.double_cosets is not None:
+                    ret = cosets.combined_cb_ops()[0].as_hkl()
+                else:
+                    ret = "none"
+
+            self.cbop_cache.put(key, ret)
+
+        if ret == "none": return None
+        if ret == "similar": return ret
+        return sgtbx.change_of_basis_op(ret)
+    # compare_cells()
+
     def get_p1cell_and_symm(self, xdsdir):
         dials_hkl = os.path.join(xdsdir, "DIALS.HKL")
         xac_file = util.return_first_found_file(("XDS_ASCII.HKL", "XDS_ASCII.HKL.org",
@@ -109,21 +205,19 @@ class CellGraph:
 
         connected_nodes = []
 
-        for node in list(self.G.nodes()):
+        for node in self.cell_index.candidates(p1cell):
             other_cell = self.p1cells[node]
-            if other_cell.is_similar_to(p1cell, self.tol_length, self.tol_angle):
+            ret = self.compare_cells(other_cell, p1cell)
+            if ret == "similar":
+                connected_nodes.append(node)
+            elif ret is not None:
+                self.cbops[(node,key)] = ret
+                print p1cell, other_cell, self.cbops[(node,key)], other_cell.change_basis(self.cbops[(node,key)])
                 connected_nodes.append(node)
-            else:
-                cosets = reindex.reindexing_operators(crystal.symmetry(other_cell, 1),
-                                                      crystal.symmetry(p1cell, 1),
-                                                      self.tol_length, self.tol_angle)
-                if cosets.double_cosets is not None:
-                    self.cbops[(node,key)] = cosets.combined_cb_ops()[0]
-                    print p1cell, other_cell, self.cbops[(node,key)], other_cell.change_basis(self.cbops[(node,key)])
-                    connected_nodes.append(node)
 
         # Add nodes and edges
         self.G.add_node(key)
+        self.cell_index.add(key, p1cell)
         for node in connected_nodes:
             self.G.add_edge(node, key)
 
@@ -304,6 +398,7 @@ class CellGraph:
 
     def get_subgraph(self, keys):
         copied_obj = CellGraph(self.tol_length, self.tol_angle)
+        for k in keys: copied_obj.cell_index.add(k, self.p1cells[k])
         copied_obj.G = self.G.subgraph(keys)
         copied_obj.p1cells = dict((k, self.p1cells[k]) for k in keys)
         copied_obj.dirs = dict((k, self.dirs[k]) for k in keys)
@@ -70,6 +70,9 @@ add_test_flag = False
 nproc = 1
  .type = int
  .help = number of processors that can be used.
+xds_ascii_cache = False
+ .type = bool
+ .help = "Keep binary cache of reflection data (.XDS_ASCII.HKL.npz) next to each input file for faster re-reading in later runs."
 
 xscale { 
  min_i_over_sigma = 3
@@ -119,6 +122,9 @@ rejection {
   bin = *total outer total-then-outer
   .type = choice(multi=False)
   .help = choice of resolution bin of CC1/2 (when reject_method=delta_cc1/2)
+  method = *internal xscale
+  .type = choice(multi=False)
+  .help = "internal: CC1/2 without each dataset is calculated from xscale.hkl in one pass (remaining datasets are not re-scaled). xscale: XSCALE is run with each dataset removed."
  }
 }
 
@@ -172,6 +178,9 @@ cc_clustering {
  min_common_refs = 3
   .type = int(value_min=3)
   .help = "Minimum number of common reflections between two datasets. Datasets below this limit are excluded in downstream analysis."
+ cc_store = None
+  .type = path
+  .help = "sqlite3 file to store pairwise CCs. CCs of unchanged files are reused in later runs with the same settings."
  min_ios = None
   .type = float
   .help = minimum I/sigma for CC calculation
@@ -552,7 +561,8 @@ def run(params):
             blend_wdir = params.blend.use_old_result
             print >>out, "\nUsing precalculated BLEND result in %s" % params.blend.use_old_result
 
-        blend_clusters = blend.BlendClusters(workdir=blend_wdir, d_min=params.d_min)
+        blend_clusters = blend.BlendClusters(workdir=blend_wdir, d_min=params.d_min,
+                                             use_cache=params.xds_ascii_cache)
         summary_out = os.path.join(blend_wdir, "blend_cluster_summary.dat")
         clusters = blend_clusters.show_cluster_summary(out=open(summary_out, "w"))
         print >>out, "Clusters found by BLEND were summarized in %s" % summary_out
@@ -596,7 +606,8 @@ def run(params):
         os.mkdir(ccc_wdir)
         cc_clusters = cc_clustering.CCClustering(ccc_wdir, xds_ascii_files,
                                                  d_min=params.cc_clustering.d_min if params.cc_clustering.d_min is not None else params.d_min,
-                                                 min_ios=params.cc_clustering.min_ios)
+                                                 min_ios=params.cc_clustering.min_ios,
+                                                 use_cache=params.xds_ascii_cache)
         print >>out, "\nRunning CC-based clustering"
 
         cc_clusters.do_clustering(nproc=params.cc_clustering.nproc,
@@ -605,6 +616,7 @@ def run(params):
                                   cluster_method=params.cc_clustering.method,
                                   distance_eqn=params.cc_clustering.cc_to_distance,
                                   min_common_refs=params.cc_clustering.min_common_refs,
+                                  cc_store_file=params.cc_clustering.cc_store,
                                   html_maker=html_report)
         summary_out = os.path.join(ccc_wdir, "cc_cluster_summary.dat")
         clusters = cc_clusters.show_cluster_summary(d_min=params.d_min, out=open(summary_out, "w"))
@@ -635,9 +647,10 @@ def run(params):
 
         for clno, IDs, clh, cmpl, redun, acmpl, aredun, ccmean, ccmin in clusters: # process largest first
             print >>out, " Cluster_%.4d NumDS= %4d CLh= %5.1f Cmpl= %6.2f Redun= %4.1f ACmpl=%6.2f ARedun=%4.1f CCmean=% .4f CCmin=% .4f" % (clno, len(IDs), clh, cmpl, redun, acmpl, aredun, ccmean, ccmin)
+            LCV, aLCV = cc_clusters.cluster_lcv.get(clno, (float("nan"), float("nan")))
             data_for_merge.append((os.path.join(params.workdir, "cluster_%.4d"%clno),
                                    map(lambda x: xds_ascii_files[x-1], IDs),
-                                   float("nan"),float("nan"),clh))
+                                   LCV, aLCV, clh))
         print >>out
 
         try: html_report.add_clutering_result(clusters, "cc_clustering")
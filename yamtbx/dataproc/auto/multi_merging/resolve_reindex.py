@@ -11,13 +11,12 @@ from cctbx.crystal import reindex
 from cctbx.array_family import flex
 from cctbx import sgtbx
 from libtbx.utils import null_out
-from libtbx import easy_mp
 from libtbx import adopt_init_args
 from cctbx.merging import brehm_diederichs
+from yamtbx.dataproc.auto.cc_matrix import cc_from_sums, reindexed_keys
 
 import os
 import copy
-import multiprocessing
 import time
 import numpy
 
@@ -32,7 +31,7 @@ def calc_cc(a1, a2):
 # calc_cc()
 
 class ReindexResolver:
-    def __init__(self, xac_files, d_min=3, min_ios=3, nproc=1, max_delta=5, log_out=null_out()):
+    def __init__(self, xac_files, d_min=3, min_ios=3, nproc=1, max_delta=5, log_out=null_out(), use_cache=False):
         adopt_init_args(self, locals())
         self.arrays = []
         self.best_operators = None
@@ -68,7 +67,7 @@ class ReindexResolver:
         bad_files, good_files = [], []
         for i, f in enumerate(self.xac_files):
             print >>self.log_out, "%4d %s" % (i, f)
-            xac = XDS_ASCII(f, i_only=True)
+            xac = XDS_ASCII(f, i_only=True, use_cache=self.use_cache)
             self.log_out.write("     d_range: %6.2f - %5.2f" % xac.i_obs().resolution_range())
             self.log_out.write(" n_ref=%6d" % xac.i_obs().size())
             xac.remove_rejected()
@@ -171,36 +170,18 @@ class ReindexResolver:
     # debug_write_mtz()
 # class ReindexResolver
 
-def kabsch_selective_breeding_worker(args):
-    ref, i, tmp, new_ops = args
-    global kabsch_selective_breeding_worker_dict
-    nproc = kabsch_selective_breeding_worker_dict["nproc"]
-    arrays = kabsch_selective_breeding_worker_dict["arrays"]
-    reindexed_arrays = kabsch_selective_breeding_worker_dict["reindexed_arrays"]
-    reidx_ops = kabsch_selective_breeding_worker_dict["reidx_ops"]
-
-    if ref==i: return None
-    
-    if nproc > 1:
-        tmp2 = reindexed_arrays[new_ops[ref]][ref]
-    else:                                
-        if reidx_ops[new_ops[ref]].is_identity_op(): tmp2 = arrays[ref]
-        else: tmp2 = arrays[ref].customized_copy(indices=reidx_ops[new_ops[ref]].apply(arrays[ref].indices())).map_to_asu()
-
-    cc = calc_cc(tmp, tmp2)
-    if cc==cc: return cc
-    return None
-# work_local()
-
 class KabschSelectiveBreeding(ReindexResolver):
     """
     Reference: W. Kabsch "Processing of X-ray snapshots from crystals in random orientations" Acta Cryst. (2014). D70, 2204-2216
     http://dx.doi.org/10.1107/S1399004714013534
     If I understand correctly...
+
+    Each dataset is scored against the running consensus (mean of all other datasets) in one process;
+    the consensus changes after each dataset, so nproc is not used by this method.
     """
 
-    def __init__(self, xac_files, d_min=3, min_ios=3, nproc=1, max_delta=5, from_p1=False, log_out=null_out()):
-        ReindexResolver.__init__(self, xac_files, d_min, min_ios, nproc, max_delta, log_out)
+    def __init__(self, xac_files, d_min=3, min_ios=3, nproc=1, max_delta=5, from_p1=False, log_out=null_out(), use_cache=False):
+        ReindexResolver.__init__(self, xac_files, d_min, min_ios, nproc, max_delta, log_out, use_cache)
         self._final_cc_means = [] # list of [(op_index, cc_mean), ...]
         self._reidx_ops = []
         self.read_xac_files(from_p1=from_p1)
@@ -222,64 +203,52 @@ class KabschSelectiveBreeding(ReindexResolver):
         reidx_ops.sort(key=lambda x: not x.is_identity_op()) # identity op to first
         self._reidx_ops = reidx_ops
 
-        if self.nproc > 1:
-            # consumes much memory.. (but no much benefits)
-            reindexed_arrays = [arrays]
-            for op in reidx_ops[1:]:
-                reindexed_arrays.append(map(lambda x: x.customized_copy(indices=op.apply(x.indices())).map_to_asu(), arrays))
-        else:
-            reindexed_arrays = None
+        # Index maps of reindexed data into common reflection table (per operator)
+        N, nops = len(arrays), len(reidx_ops)
+        keys = map(lambda op: reindexed_keys(arrays, op), reidx_ops)
+        unique_keys = numpy.unique(numpy.concatenate(map(numpy.concatenate, keys)))
+        cols = map(lambda k: map(lambda x: numpy.searchsorted(unique_keys, x), k), keys) # cols[op][i]
+        del keys
+
+        # Standardized intensities; this does not change CC
+        data = []
+        for a in arrays:
+            x = a.data().as_numpy_array()
+            x = x - x.mean()
+            if x.std() > 0: x /= x.std()
+            data.append(x)
+
+        # Consensus: sums and counts of all datasets in their current operators
+        sum_x = numpy.zeros(len(unique_keys))
+        count = numpy.zeros(len(unique_keys))
+        for i in xrange(N):
+            numpy.add.at(sum_x, cols[0][i], data[i])
+            numpy.add.at(count, cols[0][i], 1)
 
         old_ops = map(lambda x:0, xrange(len(arrays)))
         new_ops = map(lambda x:0, xrange(len(arrays)))
 
-        global kabsch_selective_breeding_worker_dict
-        kabsch_selective_breeding_worker_dict = dict(nproc=self.nproc, arrays=arrays,
-                                                     reindexed_arrays=reindexed_arrays,
-                                                     reidx_ops=reidx_ops) # constants during cycles
-        pool = multiprocessing.Pool(self.nproc)
         for ncycle in xrange(max_cycle):
             #new_ops = copy.copy(old_ops) # doesn't matter
             self._final_cc_means = []
 
             for i in xrange(len(arrays)):
+                # take out dataset i from the consensus
+                numpy.subtract.at(sum_x, cols[new_ops[i]][i], data[i])
+                numpy.subtract.at(count, cols[new_ops[i]][i], 1)
+
                 cc_means = []
-                a = arrays[i]
-                #ttt=time.time()
-                for j, op in enumerate(reidx_ops):
-                    cc_list = []
-                    if self.nproc > 1:
-                        tmp = reindexed_arrays[j][i]
-                    else:
-                        if op.is_identity_op(): tmp = a
-                        else: tmp = a.customized_copy(indices=op.apply(a.indices())).map_to_asu()
-                    
-                    """
-                    def work_local(ref): # XXX This function is very slow when nproc>1...
-                        if ref==i: return None
-
-                        if self.nproc > 1:
-                            tmp2 = reindexed_arrays[new_ops[ref]][ref]
-                        else:                                
-                            if reidx_ops[new_ops[ref]].is_identity_op(): tmp2 = arrays[ref]
-                            else: tmp2 = arrays[ref].customized_copy(indices=reidx_ops[new_ops[ref]].apply(arrays[ref].indices())).map_to_asu()
-
-                        cc = calc_cc(tmp, tmp2)
-                        if cc==cc: return cc
-                        return None
-                    # work_local()
-
-                    cc_list = easy_mp.pool_map(fixed_func=work_local,
-                                               args=range(len(arrays)),
-                                               processes=self.nproc)
-                    """
-                    cc_list = pool.map(kabsch_selective_breeding_worker,
-                                       ((k, i, tmp, new_ops) for k in range(len(arrays))))
-                    cc_list = filter(lambda x: x is not None, cc_list)
-
-                    if len(cc_list) > 0:
-                        cc_means.append((j, sum(cc_list)/len(cc_list)))
-                        #print  >>self.log_out, "DEBUG:", i, j, cc_list, cc_means[-1]
+                for j in xrange(nops):
+                    # CC with the mean of all other datasets in their current operators
+                    c = cols[j][i]
+                    sel = count[c] > 0
+                    x, y = data[i][sel], sum_x[c][sel] / count[c][sel]
+                    sums = numpy.array([[x.size, x.sum(), y.sum(), (x*x).sum(), (y*y).sum(), (x*y).sum()]], dtype=numpy.float64)
+                    cc = cc_from_sums(*sums.T)[0] if x.size > 2 else float("nan")
+
+                    if cc == cc:
+                        cc_means.append((j, float(cc)))
+                        #print  >>self.log_out, "DEBUG:", i, j, cc_means[-1]
 
                 if cc_means:
                     max_el = max(cc_means, key=lambda x:x[1])
@@ -291,6 +260,10 @@ class KabschSelectiveBreeding(ReindexResolver):
                     print >>self.log_out, "%3d %s Error! cannot calculate CC" % (i, " ".join(map(lambda x: " %d:    nan" % x, xrange(len(reidx_ops)))))
                     # XXX append something to self._final_cc_means?
 
+                # put back dataset i in (possibly) new operator
+                numpy.add.at(sum_x, cols[new_ops[i]][i], data[i])
+                numpy.add.at(count, cols[new_ops[i]][i], 1)
+
             print >>self.log_out, "In %4d cycle" % (ncycle+1)
             print >>self.log_out, "  old",old_ops
             print >>self.log_out, "  new",new_ops
@@ -309,8 +282,8 @@ class KabschSelectiveBreeding(ReindexResolver):
 # class KabschSelectiveBreeding
 
 class ReferenceBased(ReindexResolver):
-    def __init__(self, xac_files, ref_array, d_min=3, min_ios=3,  nproc=1, max_delta=5, log_out=null_out()):
-        ReindexResolver.__init__(self, xac_files, d_min, min_ios, nproc, max_delta, log_out)
+    def __init__(self, xac_files, ref_array, d_min=3, min_ios=3,  nproc=1, max_delta=5, log_out=null_out(), use_cache=False):
+        ReindexResolver.__init__(self, xac_files, d_min, min_ios, nproc, max_delta, log_out, use_cache)
         self.read_xac_files()
         self.ref_array = ref_array.resolution_filter(d_min=d_min).as_non_anomalous_array().merge_equivalents(use_internal_variance=False).array()
         
@@ -353,8 +326,8 @@ class ReferenceBased(ReindexResolver):
 # class ReferenceBased
 
 class BrehmDiederichs(ReindexResolver):
-    def __init__(self, xac_files, d_min=3, min_ios=3, nproc=1, max_delta=5, log_out=null_out()):
-        ReindexResolver.__init__(self, xac_files, d_min, min_ios, nproc, max_delta, log_out)
+    def __init__(self, xac_files, d_min=3, min_ios=3, nproc=1, max_delta=5, log_out=null_out(), use_cache=False):
+        ReindexResolver.__init__(self, xac_files, d_min, min_ios, nproc, max_delta, log_out, use_cache)
         self.read_xac_files()
     # __init__()
 
@@ -147,7 +147,7 @@ class XscaleCycles:
 
     def cut_resolution(self, cycle_number):
         def est_resol(xscale_hkl, res_params, plt_out):
-            iobs = XDS_ASCII(xscale_hkl, i_only=True).i_obs()
+            iobs = XDS_ASCII(xscale_hkl, i_only=True, use_cache=True).i_obs()
             est = estimate_resolution_based_on_cc_half(iobs, res_params.cc_one_half_min,
                                                        res_params.cc_half_tol,
                                                        res_params.n_bins, log_out=self.out)
@@ -199,7 +199,7 @@ class XscaleCycles:
         last_wd = os.path.join(self.workdir_org, "run_%.2d"%cycle_number)
         xscale_hkl = os.path.abspath(os.path.join(last_wd, "xscale.hkl"))
 
-        i_obs = XDS_ASCII(xscale_hkl, i_only=True).i_obs()
+        i_obs = XDS_ASCII(xscale_hkl, i_only=True, use_cache=True).i_obs()
         d_min_est, _ = initial_estimate_byfit_cchalf(i_obs, cc_half_min=self.res_params.cc_one_half_min,
                                                  anomalous_flag=False, log_out=self.out)
                 
@@ -264,6 +264,43 @@ class XscaleCycles:
         return self.removed_files, self.removed_reason
     # run_cycles()
 
+    def reject_by_delta_cchalf_internal(self, xscale_hkl, d_limits, i_stat, xds_ascii_files):
+        """
+        Remove worst datasets one by one while CC1/2*Nuniq (in the shell of i_stat) increases,
+        without running XSCALE. Returns list of removed indices of input files.
+        """
+        from yamtbx.dataproc.xds.delta_cchalf import DeltaCCHalf
+
+        engine = DeltaCCHalf(xscale_hkl, anomalous_flag=self.anomalous_flag, d_limits=d_limits, use_cache=True)
+        cc, nuniq = engine.calc_cchalf()
+        prev_cchalf, prev_nuniq = cc[i_stat]*100., nuniq[i_stat]
+
+        datout = open(os.path.join(self.workdir, "delta_cchalf.dat"), "w")
+        datout.write("cycle idx exfile cc1/2(%s) Nuniq\n" % self.delta_cchalf_bin)
+        ret = []
+        for i in xrange(len(xds_ascii_files)-1): # if only one file, cannot proceed.
+            cchalf_list = map(lambda x: (x[0], x[1][i_stat]*100., x[2][i_stat]), engine.calc_cchalf_by_removing())
+            for iset, cc_i, nuniq_i in cchalf_list:
+                datout.write("%3d %3d %s %.4f %d\n" % (i, iset-1, xds_ascii_files[iset-1], cc_i, nuniq_i))
+            datout.flush()
+
+            cchalf_list = filter(lambda x: x[1]==x[1], cchalf_list)
+            if not cchalf_list: break
+            iset, cc_i, nuniq_i = max(cchalf_list, key=lambda x: x[1]) # worst one to remove
+            print >>self.out, "DEBUG:: cycle %.3d remove %3d if %.2f*%d > %.2f*%d" % (i, iset-1,
+                                                                                      cc_i, nuniq_i,
+                                                                                      prev_cchalf, prev_nuniq)
+            if cc_i*nuniq_i <= prev_cchalf*prev_nuniq: break
+            print >>self.out, "Removing idx= %3d gained CC1/2 by %.2f" % (iset-1, cc_i-prev_cchalf)
+
+            prev_cchalf, prev_nuniq = cc_i, nuniq_i
+            engine.remove(iset)
+            ret.append(iset-1)
+
+        datout.close()
+        return ret
+    # reject_by_delta_cchalf_internal()
+
     def check_remove_list(self, remove_idxes):
         new_list = []
         skip_num = 0
@@ -435,7 +472,7 @@ class XscaleCycles:
 
             # list of [frame, n_all, n_common, cc] in the same order
             framecc = xscale_cc_against_merged.run(hklin=os.path.join(self.workdir, "xscale.hkl"),
-                                                   output_dir=self.workdir).values()
+                                                   output_dir=self.workdir, nproc=self.nproc).values()
             if self.reject_params.framecc.method == "tukey":
                 ccs = numpy.array(map(lambda x: x[3], reduce(lambda x,y:x+y,framecc)))
                 ccs = ccs[ccs==ccs] # Remove nan
@@ -589,31 +626,40 @@ class XscaleCycles:
             # For consistent resolution limit
             inp_head = self.xscale_inp_head + "SPACE_GROUP_NUMBER= %s\nUNIT_CELL_CONSTANTS= %s\n\n" % (sg, cell)
             count = 0
-            for i in xrange(len(xds_ascii_files)-1): # if only one file, cannot proceed.
-                tmpdir = os.path.join(self.workdir, "reject_test_%.3d" % i)
-
-                cchalf_list = xscale.calc_cchalf_by_removing(wdir=tmpdir, inp_head=inp_head,
-                                                             inpfiles=remaining_files.keys(),
-                                                             stat_bin=self.delta_cchalf_bin,
-                                                             nproc=self.nproc,
-                                                             nproc_each=self.nproc_each,
-                                                             batchjobs=self.batchjobs)
-
-                rem_idx, cc_i, nuniq_i = cchalf_list[0] # First (largest) is worst one to remove.
-                rem_idx_in_org = remaining_files[remaining_files.keys()[rem_idx]]
+            if self.reject_params.delta_cchalf.method == "internal":
+                rem_idxes = self.reject_by_delta_cchalf_internal(os.path.join(self.workdir, "xscale.hkl"),
+                                                                 table["dmin"][:-1], i_stat,
+                                                                 xds_ascii_files)
+                for rem_idx_in_org in rem_idxes:
+                    remove_idxes.append(rem_idx_in_org)
+                    remove_reasons.setdefault(rem_idx_in_org, []).append("bad_cchalf")
+                count = len(rem_idxes)
+            else:
+                for i in xrange(len(xds_ascii_files)-1): # if only one file, cannot proceed.
+                    tmpdir = os.path.join(self.workdir, "reject_test_%.3d" % i)
+
+                    cchalf_list = xscale.calc_cchalf_by_removing(wdir=tmpdir, inp_head=inp_head,
+                                                                 inpfiles=remaining_files.keys(),
+                                                                 stat_bin=self.delta_cchalf_bin,
+                                                                 nproc=self.nproc,
+                                                                 nproc_each=self.nproc_each,
+                                                                 batchjobs=self.batchjobs)
+
+                    rem_idx, cc_i, nuniq_i = cchalf_list[0] # First (largest) is worst one to remove.
+                    rem_idx_in_org = remaining_files[remaining_files.keys()[rem_idx]]
                 
-                # Decision making by CC1/2
-                print >>self.out, "DEBUG:: cycle %.3d remove %3d if %.2f*%d > %.2f*%d" % (i, rem_idx_in_org, 
-                                                                                          cc_i, nuniq_i,
-                                                                                          prev_cchalf, prev_nuniq)
-                if cc_i*nuniq_i <= prev_cchalf*prev_nuniq: break
-                print >>self.out, "Removing idx= %3d gained CC1/2 by %.2f" % (rem_idx_in_org, cc_i-prev_cchalf)
-
-                prev_cchalf, prev_nuniq = cc_i, nuniq_i
-                remove_idxes.append(rem_idx_in_org)
-                remove_reasons.setdefault(rem_idx_in_org, []).append("bad_cchalf")
-                del remaining_files[remaining_files.keys()[rem_idx]] # remove file from table
-                count += 1
+                    # Decision making by CC1/2
+                    print >>self.out, "DEBUG:: cycle %.3d remove %3d if %.2f*%d > %.2f*%d" % (i, rem_idx_in_org, 
+                                                                                              cc_i, nuniq_i,
+                                                                                              prev_cchalf, prev_nuniq)
+                    if cc_i*nuniq_i <= prev_cchalf*prev_nuniq: break
+                    print >>self.out, "Removing idx= %3d gained CC1/2 by %.2f" % (rem_idx_in_org, cc_i-prev_cchalf)
+
+                    prev_cchalf, prev_nuniq = cc_i, nuniq_i
+                    remove_idxes.append(rem_idx_in_org)
+                    remove_reasons.setdefault(rem_idx_in_org, []).append("bad_cchalf")
+                    del remaining_files[remaining_files.keys()[rem_idx]] # remove file from table
+                    count += 1
 
             print >>self.out, " %4d removed by DeltaCC1/2 method" % count
 
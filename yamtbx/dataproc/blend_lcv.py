@@ -16,6 +16,10 @@ def diagonals(cells):
 # diagonals()
 
 def aldists(d):
+    """
+    All pairwise absolute and relative differences (NxN matrices).
+    Not used in calc_lcv() any more; only extrema of diagonals are needed.
+    """
     tmp = numpy.zeros(dtype=numpy.float, shape=(d.size,d.size))
     tmp[:,] = d
     adist = numpy.abs(tmp - tmp.transpose()) # redundant!! don't want to do this.. but for-for loops could be slow..
@@ -24,28 +28,40 @@ def aldists(d):
     return adist, ldist
 # aldists()
 
+def lcv_from_extrema(dmin, dmax):
+    """
+    LCV (%) and aLCV from minimum and maximum of three diagonals, given as arrays of shape (n, 3).
+    The largest difference is max-min, and it is divided by min to give LCV, as in BLEND.
+    Returns arrays (lcv, alcv) of length n.
+    """
+    adist = dmax - dmin
+    midx = numpy.argmax(adist, axis=1)
+    rows = numpy.arange(len(adist))
+    return adist[rows, midx] / dmin[rows, midx] * 100., adist[rows, midx]
+# lcv_from_extrema()
+
 def calc_lcv(cells):
-    Dab, Dbc, Dca = diagonals(numpy.array(cells))
-
-    Mab, Lab = aldists(Dab)
-    Mbc, Lbc = aldists(Dbc)
-    Mca, Lca = aldists(Dca)
-
-
-    # take max of M series
-    iab = numpy.where(Mab==numpy.amax(Mab))
-    ibc = numpy.where(Mbc==numpy.amax(Mbc))
-    ica = numpy.where(Mca==numpy.amax(Mca))
-    Lab = Lab[iab][0]
-    Lbc = Lbc[ibc][0]
-    Lca = Lca[ica][0]
-    Mab = Mab[iab][0]
-    Mbc = Mbc[ibc][0]
-    Mca = Mca[ica][0]
-    
-    midx = numpy.argmax([Mab,Mbc,Mca])
-    lcv = [Lab,Lbc,Lca][midx]
-    alcv = [Mab,Mbc,Mca][midx]
-
-    return lcv*100., alcv
+    D = numpy.column_stack(diagonals(numpy.array(cells, dtype=numpy.float64).reshape(-1, 6)))
+    lcv, alcv = lcv_from_extrema(D.min(axis=0)[None,:], D.max(axis=0)[None,:])
+    return lcv[0], alcv[0]
 # calc_lcv()
+
+def calc_lcv_on_linkage(cells, Z):
+    """
+    LCV and aLCV of all clusters of hierarchical clustering, in one bottom-up pass
+    where extrema of diagonals are propagated from children to parents.
+    cells: unit cell parameters of N datasets in the order used for clustering
+    Z: linkage matrix of scipy.cluster.hierarchy; k-th row makes cluster N+k from two nodes.
+    Returns arrays (lcv, alcv) of length N-1 for the rows of Z.
+    """
+    D = numpy.column_stack(diagonals(numpy.array(cells, dtype=numpy.float64).reshape(-1, 6)))
+    N = len(D)
+    dmin = numpy.empty((2*N-1, 3))
+    dmax = numpy.empty((2*N-1, 3))
+    dmin[:N], dmax[:N] = D, D
+    for k, (i, j) in enumerate(numpy.array(Z)[:,:2].astype(int)):
+        dmin[N+k] = numpy.minimum(dmin[i], dmin[j])
+        dmax[N+k] = numpy.maximum(dmax[i], dmax[j])
+
+    return lcv_from_extrema(dmin[N:], dmax[N:])
+# calc_lcv_on_linkage()
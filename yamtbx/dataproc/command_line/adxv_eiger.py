@@ -485,8 +485,9 @@ class MainFrame(wx.Frame):
         
         is_onlyhits = self.h5file.endswith("_onlyhits.h5")
         try:
-            h5 = h5py.File(self.h5file, "r")
-            h = eiger_hdf5_interpreter.Interpreter().getRawHeadDict(self.h5file)
+            master = eiger.open_master(self.h5file)
+            h5 = master.h5
+            h = master.raw_header()
             self.n_images = h["Nimages"]
             self.n_images_each = h["Nimages_each"]
         except:
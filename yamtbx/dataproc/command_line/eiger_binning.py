@@ -13,50 +13,114 @@ dead_area_treatment = 0
  .help = "0: treat as zero, 1: treat as -inf"
 nproc = 1
  .type = int(value_min=1)
+ .help = number of data files processed at once
+batch_mb = 128
+ .type = int(value_min=1)
+ .help = size of frames read at once (MB per process)
 """
 
-def software_binning(data, binning, dead_area_treatment):
-    assert dead_area_treatment in (0, 1)
+def binned_shape(dimy, dimx, binning):
+    """
+    Returns (u, l, ny, nx); pixels [u:u+ny*binning, l:l+nx*binning] are binned (remainders are cut evenly)
+    """
+    return (dimy%binning)//2, (dimx%binning)//2, dimy//binning, dimx//binning
+# binned_shape()
+
+def dead_bins(frame, binning, dead_area_treatment):
+    """
+    Bins to be flagged as dead: pixels of maximum value (dead area) in frame are counted for each bin.
+    0: bins consisting of dead pixels only, 1: bins including dead pixels
+    """
+    u, l, ny, nx = binned_shape(frame.shape[0], frame.shape[1], binning)
+    maxval = 2**(frame.dtype.itemsize*8)-1
+    count = (frame[u:u+ny*binning, l:l+nx*binning]==maxval).reshape(ny, binning, nx, binning).sum(axis=(1,3))
 
-    u = l = 0
-    b = r = None
-    nframes, dimy, dimx = data.shape
-    if dimy%binning > 0:
-        res = dimy%binning
-        u = res//2 # upper
-        b = -(res - u) # bottom
-    if dimx%binning > 0:
-        res = dimx%binning
-        l = res//2
-        r = -(res - l)
-
-    newdata = data[:, u:b, l:r]
-    
-    # https://gist.github.com/derricw/95eab740e1b08b78c03f
-    newshape = (nframes, dimy//binning, dimx//binning)
-    compression_pairs = [(nframes, 1), (dimy//binning, binning), (dimx//binning, binning)]
-    flattened = reduce(lambda x,y:x+y, compression_pairs)
-
-    mask = numpy.zeros(newshape[1]*newshape[2]*binning*binning, dtype=numpy.uint16).reshape(newshape[1]*binning,newshape[2]*binning)
-    mask[newdata[0,]==2**(newdata.dtype.itemsize*8)-1] = 1
-    mask = mask.reshape(newshape[1], binning, newshape[2], -1).sum(3).sum(1).astype(numpy.uint16)
+    if dead_area_treatment == 0:
+        return count == count.max() if count.max() > 0 else numpy.zeros(count.shape, dtype=bool)
+    elif dead_area_treatment == 1:
+        return count > 0
+# dead_bins()
+
+def bin_frames(data, binning, dead, dead_area_treatment, out):
+    """
+    Bin frames (nframes, dimy, dimx) into preallocated out (nframes, ny, nx) in one reduction without temporary copy.
+    If dead_area_treatment == 0, pixels of maximum value in data are set to 0 (data is modified).
+    Bins of dead (see dead_bins()) are set to maximum value of out.
+    """
+    assert dead_area_treatment in (0, 1)
+    nframes, ny, nx = out.shape
+    u, l, _, _ = binned_shape(data.shape[1], data.shape[2], binning)
 
     if dead_area_treatment == 0:
-        newdata[newdata==2**(newdata.dtype.itemsize*8)-1] = 0
+        data[data==2**(data.dtype.itemsize*8)-1] = 0
 
-    newdata = newdata.reshape(flattened)
-    for i in xrange(len(newshape)): newdata = newdata.sum(-1*(i+1), dtype=numpy.uint32)
+    # splitting axes makes a view, not a copy
+    view = data[:, u:u+ny*binning, l:l+nx*binning].reshape(nframes, ny, binning, nx, binning)
+    view.sum(axis=(2,4), dtype=out.dtype, out=out)
+    out[:, dead] = 2**(out.dtype.itemsize*8)-1
+# bin_frames()
 
-    if dead_area_treatment == 0:
-        newdata[:, mask==numpy.max(mask)] = 2**(newdata.dtype.itemsize*8)-1
-    elif dead_area_treatment == 1:
-        newdata[:, mask>0] = 2**(newdata.dtype.itemsize*8)-1
-        
+def software_binning(data, binning, dead_area_treatment):
+    nframes, dimy, dimx = data.shape
+    u, l, ny, nx = binned_shape(dimy, dimx, binning)
+    dead = dead_bins(data[0], binning, dead_area_treatment)
+    newdata = numpy.empty((nframes, ny, nx), dtype=numpy.uint32)
+    bin_frames(data, binning, dead, dead_area_treatment, newdata)
     return newdata, u, l
 # software_binning()
 
+def bin_data_file(datafile, path, outfile, binning, dead_area_treatment, batch_mb=128):
+    """
+    Bin all frames in a data file and write them to outfile as bslz4-compressed chunks.
+    Frames are read in batches of batch_mb MB into a preallocated buffer, so memory usage does not depend on the number of frames.
+    Returns (u, l); see binned_shape().
+    """
+    h5 = h5py.File(datafile, "r")
+    dataset = h5[path]
+    nframes, dimy, dimx = dataset.shape
+    u, l, ny, nx = binned_shape(dimy, dimx, binning)
+
+    bsize = max(1, min(nframes, int(batch_mb*1024**2 // (dimy*dimx*dataset.dtype.itemsize))))
+    buf = numpy.empty((bsize, dimy, dimx), dtype=dataset.dtype)
+    out = numpy.empty((bsize, ny, nx), dtype=numpy.uint32)
+
+    h5out, dataset_out = eiger.open_data_file(outfile, (nframes, ny, nx), numpy.uint32, (1, ny, nx),
+                                              dataset.attrs["image_nr_low"], dataset.attrs["image_nr_high"])
+    dead = None
+    for i in xrange(0, nframes, bsize):
+        n = min(bsize, nframes-i)
+        dataset.read_direct(buf, numpy.s_[i:i+n], numpy.s_[:n])
+        if dead is None: dead = dead_bins(buf[0], binning, dead_area_treatment)
+        bin_frames(buf[:n], binning, dead, dead_area_treatment, out[:n])
+        dataset_out[i:i+n] = out[:n]
+
+    h5out.close()
+    h5.close()
+    return u, l
+# bin_data_file()
+
 def run(params, h5file):
     outfile = os.path.splitext(h5file)[0] + "_bin%d.h5" % params.bin
+
+    # data files are processed by separate processes with their own handles; master h5 is not kept open while forking
+    h5 = h5py.File(h5file, "r")
+    data_links = map(lambda k: h5["/entry/data"].get(k, getlink=True), h5["/entry/data"].keys())
+    data_links = map(lambda x: (x.filename, x.path), data_links)
+    h5.close()
+
+    def worker(link):
+        filename, path = link
+        print "Converting %s" % filename
+        dfile = os.path.splitext(filename)[0]+"_bin%d.h5"%params.bin
+        return bin_data_file(os.path.join(os.path.dirname(h5file), filename), path,
+                             os.path.join(os.path.dirname(outfile), dfile),
+                             params.bin, params.dead_area_treatment, params.batch_mb)
+    # worker()
+
+    map_res = easy_mp.pool_map(fixed_func=worker,
+                               args=data_links,
+                               processes=params.nproc)
+
     h5 = h5py.File(h5file, "r")
     h5out = h5py.File(outfile, "w")
 
@@ -66,22 +130,6 @@ def run(params, h5file):
     h5out.create_group("/entry/data")
     h5out["/entry/data"].attrs["NX_class"] = "NXdata"
 
-    def worker(k):
-        print "Converting %s" % k
-        data = h5["/entry/data"][k][:]
-        data, u, l = software_binning(data, params.bin, params.dead_area_treatment)
-        dfile = os.path.splitext(h5["/entry/data"].get(k, getlink=True).filename)[0]+"_bin%d.h5"%params.bin
-        eiger.create_data_file(os.path.join(os.path.dirname(outfile), dfile),
-                               data, (1, data.shape[1], data.shape[2]),
-                               h5["/entry/data"][k].attrs["image_nr_low"],
-                               h5["/entry/data"][k].attrs["image_nr_high"])
-        return u, l
-    # worker()
-
-    map_res = easy_mp.pool_map(fixed_func=worker,
-                               args=h5["/entry/data"].keys(),
-                               processes=params.nproc)
-
     f_xyconv = lambda x,y: ((x-map_res[0][0])/params.bin, (y-map_res[0][1])/params.bin)
 
     for k in h5["/entry/data"]:
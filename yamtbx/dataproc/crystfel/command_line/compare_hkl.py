@@ -20,6 +20,9 @@ nshells = 20
 
 fom = *cc *ccano *rsplit
  .type = choice(multi=True)
+anomalous = True
+ .type = bool
+ .help = used when columnar streams are given (merged here)
 """
 
 def calc_cc(a1, a2):
@@ -45,7 +48,7 @@ def calc_rsplit(a1, a2):
 
 
 def run(hklfiles, params):
-    arrays = map(lambda x: crystfel.hkl.HKLfile(symm_source=params.pdb, hklin=x), hklfiles)
+    arrays = map(lambda x: crystfel.hkl.HKLfile(symm_source=params.pdb, hklin=x, anomalous_flag=params.anomalous), hklfiles)
     for a in arrays: a.set_resolution(d_min=params.dmin, d_max=params.dmax)
     
     ofs = open(params.datout, "w")
@@ -100,7 +103,9 @@ if __name__ == "__main__":
     hklfiles = []
 
     for arg in args:
-        if os.path.isfile(arg):
+        if os.path.isdir(arg) and crystfel.stream.is_columnar_stream(arg):
+            hklfiles.append(arg)
+        elif os.path.isfile(arg):
             if ".hkl" in arg: hklfiles.append(arg)
             elif params.pdb is None: params.pdb = arg
 
@@ -108,7 +113,7 @@ if __name__ == "__main__":
         print "Give pdb file"
         quit()
     if len(hklfiles) != 2:
-        print "Give two hkl files."
+        print "Give two hkl files (or columnar streams)."
         quit()
 
     run(hklfiles, params)
@@ -8,6 +8,9 @@ dmin = None
  .type = float
 dmax = None
  .type = float
+anomalous = True
+ .type = bool
+ .help = used when hklin is columnar stream (merged here)
 """
 
 import os
@@ -24,12 +27,13 @@ def run(args):
     symm_source, hklin = cmdline.remaining_args
 
     hklfile = crystfel.hkl.HKLfile(symm_source=symm_source,
-                                   hklin=hklin)
+                                   hklin=hklin,
+                                   anomalous_flag=params.anomalous)
 
     hklfile.set_resolution(d_min=params.dmin, d_max=params.dmax)
 
     if params.prefix is None:
-        params.prefix = os.path.splitext(os.path.basename(hklin))[0]
+        params.prefix = os.path.splitext(os.path.basename(hklin.rstrip("/")))[0]
 
     if "sca" in params.output:
         iotbx.scalepack.merge.write(file_name="%s.sca" % (params.prefix),
@@ -0,0 +1,38 @@
+"""
+Parse indexed chunks of CrystFEL stream in parallel and save as columnar store,
+which can be given to stats_stream_savememory.py, compare_hkl.py and hkl2various.py instead of stream/hkl files.
+"""
+
+import sys
+import time
+from yamtbx.dataproc import crystfel
+import iotbx.phil
+
+master_params_str = """\
+streamin = None
+ .type = path
+ .help = Input stream file (not compressed)
+output = None
+ .type = path
+ .help = Output directory. Default: streamin.cols
+nproc = 1
+ .type = int
+"""
+
+def run(params):
+    t = time.time()
+    index = crystfel.stream.StreamIndex(params.streamin)
+    print "# stream indexed. %d chunks (%d indexed). time: %.1f" % (len(index.entries), len(index.indexed_entries()), time.time()-t)
+
+    outdir = crystfel.stream.make_columnar_stream(params.streamin, outdir=params.output, nproc=params.nproc, index=index)
+    print "# columnar store written: %s. time: %.1f" % (outdir, time.time()-t)
+# run()
+
+if __name__ == "__main__":
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    if params.streamin is None and len(cmdline.remaining_args) == 1:
+        params.streamin = cmdline.remaining_args[0]
+
+    run(params)
@@ -1,7 +1,11 @@
 import cPickle as pickle
 import os
+from yamtbx.dataproc.crystfel.stream import StreamIndex
 
 def run(streamin, pklin, key, stop_after=None, streamout=None):
+    """
+    If pklin is None, chunks are sorted by key scalars in the stream index (e.g. res_lim, n_refl)
+    """
     if streamout is None:
         streamout = os.path.splitext(os.path.basename(streamin))[0] + "_sort_%s.stream" % key
 
@@ -9,8 +13,15 @@ def run(streamin, pklin, key, stop_after=None, streamout=None):
     rev_order = key[-1] == "-"
     key = key[:-1]
 
-    stats = pickle.load(open(pklin))
-    sorted_indices = sorted(range(len(stats["chunk_ranges"])),
+    if pklin is not None:
+        stats = pickle.load(open(pklin))
+        chunk_ranges = stats["chunk_ranges"]
+    else:
+        entries = StreamIndex(streamin).indexed_entries()
+        stats = {key: map(lambda x: getattr(x, key), entries)}
+        chunk_ranges = map(lambda x: (x.start+1, x.end), entries) # same convention as prep_sort_stream
+
+    sorted_indices = sorted(range(len(chunk_ranges)),
                             key=lambda x: stats[key][x],
                             reverse=rev_order)
 
@@ -20,7 +31,7 @@ def run(streamin, pklin, key, stop_after=None, streamout=None):
 
     for i, idx in enumerate(sorted_indices):
         print "writing", stats[key][idx]
-        s, e = stats["chunk_ranges"][idx]
+        s, e = chunk_ranges[idx]
         ifs.seek(s-1)
         ofs.write(ifs.read(e-s+1))
         if stop_after is not None and i+1 >= stop_after: break
@@ -29,5 +40,8 @@ def run(streamin, pklin, key, stop_after=None, streamout=None):
 
 if __name__ == "__main__":
     import sys
-    run(sys.argv[1], sys.argv[2], sys.argv[3], stop_after=int(sys.argv[4]) if len(sys.argv)>4 else None)
+    if len(sys.argv) > 2 and sys.argv[2][-1] in "+-": # sort_stream.py stream key [stop_after]; using stream index
+        run(sys.argv[1], None, sys.argv[2], stop_after=int(sys.argv[3]) if len(sys.argv)>3 else None)
+    else:
+        run(sys.argv[1], sys.argv[2], sys.argv[3], stop_after=int(sys.argv[4]) if len(sys.argv)>4 else None)
     
@@ -45,6 +45,12 @@ halve_method = *alternate random
  .type = choice(multi=False)
 random_seed = 1234
  .type = int
+columnar_out = None
+ .type = path
+ .help = "If given, stream is parsed into columnar store (directory), which is then used. Give it as input for later runs."
+nproc = 1
+ .type = int
+ .help = number of processes to make columnar store
 
 #frame_scaling = False
 # .type = bool
@@ -101,7 +107,12 @@ def merge_obs(indices, iobs, sel, symm, anomalous_flag, d_min, d_max):
     return array.merge_equivalents(algorithm="crystfel") # if sigmas is None, merge_equivalents_real() is used which simply averages.
 # merge_obs()
 
-def read_stream(stream, start_at=0):
+def read_stream(stream, start_at=0, index=None):
+    if index is not None:
+        for chunk in crystfel.stream.stream_iterator(stream, start_at, index=index):
+            yield chunk
+        return
+
     if stream.endswith(".bz2"):
         fin = bz2.BZ2File(stream)
     else:
@@ -125,7 +136,15 @@ def read_stream(stream, start_at=0):
         elif read_flag:
             chunk.parse_line(l)
 
-def show_split_stats(stream, nindexed, symm, params, anoref=None, ref=None, out_prefix="out", start_at=0):
+def columnar_obs(columnar, chunk_ids, adu_cutoff):
+    sel = columnar.reflection_selection(chunk_ids)
+    indices = columnar.miller_indices(sel)
+    iobs = columnar.refls["iobs"][sel].tolist()
+    if adu_cutoff is None: return indices, iobs, []
+    return indices, iobs, (columnar.refls["peak"][sel] <= adu_cutoff).tolist()
+# columnar_obs()
+
+def show_split_stats(stream, nindexed, symm, params, anoref=None, ref=None, out_prefix="out", start_at=0, index=None, columnar=None):
     random.seed(params.random_seed)
     nstep = nindexed // params.nsplit
 
@@ -145,7 +164,10 @@ def show_split_stats(stream, nindexed, symm, params, anoref=None, ref=None, out_
 
     print >>out, "   nframes     red  Rsplit    Rano   CC1/2   CCano  snr  Rano/Rsplit CCanoref CCref"
 
-    chunks = read_stream(stream, start_at)
+    if columnar is not None:
+        chunks = iter(xrange(start_at, columnar.n_chunks())) # chunk ids
+    else:
+        chunks = read_stream(stream, start_at, index)
 
     for i in xrange(params.nsplit):
         e = (i+1)*nstep
@@ -175,19 +197,23 @@ def show_split_stats(stream, nindexed, symm, params, anoref=None, ref=None, out_
         else:
             raise "Not-supported:", params.halve_method
 
-        i1, o1, s1 = [], [], []
-        for x in slc1:
-            i1.extend(x.indices)
-            o1.extend(x.iobs)
-            if params.adu_cutoff is not None:
-                s1.extend((a <= params.adu_cutoff for a in x.peak))
-
-        i2, o2, s2 = [], [], []
-        for x in slc2:
-            i2.extend(x.indices)
-            o2.extend(x.iobs)
-            if params.adu_cutoff is not None:
-                s2.extend((a <= params.adu_cutoff for a in x.peak))
+        if columnar is not None:
+            i1, o1, s1 = columnar_obs(columnar, slc1, params.adu_cutoff)
+            i2, o2, s2 = columnar_obs(columnar, slc2, params.adu_cutoff)
+        else:
+            i1, o1, s1 = [], [], []
+            for x in slc1:
+                i1.extend(x.indices)
+                o1.extend(x.iobs)
+                if params.adu_cutoff is not None:
+                    s1.extend((a <= params.adu_cutoff for a in x.peak))
+
+            i2, o2, s2 = [], [], []
+            for x in slc2:
+                i2.extend(x.indices)
+                o2.extend(x.iobs)
+                if params.adu_cutoff is not None:
+                    s2.extend((a <= params.adu_cutoff for a in x.peak))
 
         # Concatenate and sort
         indices1 = indices1.concatenate(flex.miller_index(i1))
@@ -270,21 +296,43 @@ def run(streamin, symm_source, params):
     # how many frames indexed?
     nindexed = 0
     t = time.time()
-
-    for l in bz2.BZ2File(streamin) if streamin.endswith(".bz2") else open(streamin):
-        if l.startswith("indexed_by =") and l[l.index("=")+1:].strip() != "none":
-            nindexed += 1
-        if params.stop_after is not None and params.stop_after <= (nindexed-params.start_at):
-            break
+    index, columnar = None, None
+    stream_name = streamin
+
+    if not os.path.isdir(streamin) and not streamin.endswith(".bz2") and params.columnar_out:
+        index = crystfel.stream.StreamIndex(streamin)
+        streamin = crystfel.stream.make_columnar_stream(streamin, outdir=params.columnar_out,
+                                                        nproc=params.nproc, index=index)
+        print >> sys.stderr, "# columnar store written: %s. time:" % streamin, time.time() - t
+
+    if os.path.isdir(streamin):
+        columnar = crystfel.stream.ColumnarStream(streamin)
+        nindexed = columnar.n_chunks()
+        if params.stop_after is not None: nindexed = min(nindexed, params.stop_after+params.start_at)
+    else:
+        if not streamin.endswith(".bz2"):
+            # with stop_after, existing index is used but not made, as only the beginning is read
+            index = crystfel.stream.StreamIndex(streamin, create=params.stop_after is None)
+            if not index.entries and params.stop_after is not None: index = None
+
+        if index is not None:
+            nindexed = len(index.indexed_entries())
+            if params.stop_after is not None: nindexed = min(nindexed, params.stop_after+params.start_at)
+        else:
+            for l in bz2.BZ2File(streamin) if streamin.endswith(".bz2") else open(streamin):
+                if l.startswith("indexed_by =") and l[l.index("=")+1:].strip() != "none":
+                    nindexed += 1
+                if params.stop_after is not None and params.stop_after <= (nindexed-params.start_at):
+                    break
 
     print >> sys.stderr, "# nframes checked (%d). time:" % nindexed, time.time() - t
 
     nindexed -= params.start_at
     
     if params.output_prefix is None:
-        params.output_prefix = "stats_%s" % os.path.splitext(os.path.basename(streamin))[0]
+        params.output_prefix = "stats_%s" % os.path.splitext(os.path.basename(stream_name.rstrip("/")))[0]
 
-    show_split_stats(streamin, nindexed, symm, params, anoref=anoref, ref=ref, out_prefix=params.output_prefix, start_at=params.start_at)
+    show_split_stats(streamin, nindexed, symm, params, anoref=anoref, ref=ref, out_prefix=params.output_prefix, start_at=params.start_at, index=index, columnar=columnar)
 # run()
 
 if __name__ == "__main__":
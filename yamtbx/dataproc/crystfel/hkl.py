@@ -7,6 +7,9 @@ Symmetry: 422
    0    0    1      -9.83        -      12.58       5
    0    0    2      -3.89        -       8.33     376
 ...
+
+A columnar stream (see stream.make_columnar_stream()) can be given instead;
+observations are then merged in the same way as process_hkl (simple averaging).
 """
 
 from iotbx import crystal_symmetry_from_any
@@ -14,9 +17,14 @@ from cctbx import miller
 from cctbx import crystal
 from cctbx.array_family import flex
 from libtbx.utils import Sorry
+import os
+from yamtbx.dataproc.crystfel import stream
 
 class HKLfile:
-    def __init__(self, symm_source=None, hklin=None):
+    def __init__(self, symm_source=None, hklin=None, anomalous_flag=True):
+        """
+        anomalous_flag is used only for merging columnar stream.
+        """
         self.symm = None
 
         if symm_source is not None:
@@ -26,9 +34,23 @@ class HKLfile:
             print self.symm.show_summary(prefix=" ")
 
         if hklin is not None:
-            self.read_file(hklin)
+            if os.path.isdir(hklin):
+                self.read_columnar_stream(hklin, anomalous_flag)
+            else:
+                self.read_file(hklin)
     # __init__()
 
+    def read_columnar_stream(self, dirin, anomalous_flag):
+        assert self.symm is not None
+
+        obs = stream.ColumnarStream(dirin).miller_array(self.symm, anomalous_flag)
+        print "Merging %d observations in columnar stream. Anomalous:" % obs.size(), anomalous_flag
+        obs = obs.customized_copy(sigmas=None).map_to_asu() # merge as process_hkl does, not using sigmas
+        merged = obs.merge_equivalents(algorithm="crystfel")
+        self.array = merged.array().set_observation_type_xray_intensity()
+        self.redundancies = merged.redundancies()
+    # read_columnar_stream()
+
     def read_file(self, hklin):
         assert self.symm is not None # XXX more careful check
         fin = open(hklin)
@@ -54,11 +54,19 @@ import re
 from libtbx import adopt_init_args
 from cctbx import miller
 from cctbx import crystal
+from cctbx import sgtbx
 from cctbx.array_family import flex
 
 import cPickle as pickle
+import os
 import sys
+import bz2
+import collections
+import tempfile
+import stat
+import glob
 import numpy
+from yamtbx.util.shm import run_tasks
 #import msgpack
 
 re_abcstar = re.compile("([-\+][0-9\.]+ )([-\+][0-9\.]+ )([-\+][0-9\.]+ )")
@@ -328,7 +336,167 @@ class Streamfile:
     """
 # class Streamfile
 
-def stream_iterator(stream, start_at=0, read_reflections=True):
+StreamIndexEntry = collections.namedtuple("StreamIndexEntry", ("start", "end", "filename", "event", "indexed_by",
+                                                                 "res_lim", "n_refl", "cell"))
+
+class StreamIndex:
+    """
+    Byte-offset index of chunks in a stream file, with key scalars of each chunk.
+    start is the offset of "----- Begin chunk -----" line and end is the offset just after "----- End chunk -----" line.
+    Unclosed chunks are not included.
+
+    Saved as tab-separated text file (default: stream+".idx"). The first line records size and mtime
+    of the stream file, and the index is rebuilt when they do not match.
+    The file is written to a temporary file and renamed, so readers never see incomplete index.
+    If it cannot be written (e.g. read-only directory), the index is only kept in memory.
+    bz2-compressed streams are not supported.
+    """
+
+    version = 1
+
+    def __init__(self, stream, indexfile=None, create=True):
+        self.stream = stream
+        self.indexfile = indexfile if indexfile else stream + ".idx"
+        self.entries = []
+        self._built_key = None
+
+        if not self.load() and create:
+            self.build()
+            self.save()
+    # __init__()
+
+    def _stream_key(self):
+        st = os.stat(self.stream)
+        return "size=%d mtime=%.6f" % (st.st_size, st.st_mtime)
+    # _stream_key()
+
+    def build(self):
+        assert not self.stream.endswith(".bz2")
+        self.entries = []
+        self._built_key = self._stream_key() # taken before reading, as the stream may grow
+        fin = open(self.stream)
+        chunk, start = None, None
+
+        while True:
+            pos = fin.tell()
+            l = fin.readline()
+            if l == "": break
+
+            if "----- Begin chunk -----" in l:
+                chunk, start = Chunk(read_reflections=False), pos
+            elif chunk is not None and "----- End chunk -----" in l:
+                self.entries.append(StreamIndexEntry(start, fin.tell(), chunk.filename, chunk.event, chunk.indexed_by,
+                                                     chunk.res_lim, chunk.n_refl, chunk.cell))
+                chunk = None
+            elif chunk is not None:
+                chunk.parse_line(l)
+    # build()
+
+    def save(self):
+        """
+        Returns True if written.
+        """
+        tmp = None
+        try:
+            tmpfd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.indexfile)+".",
+                                          dir=os.path.dirname(os.path.abspath(self.indexfile)))
+            with os.fdopen(tmpfd, "w") as ofs:
+                ofs.write("# stream index version %d %s\n" % (self.version, self._built_key or self._stream_key()))
+                ofs.write("\t".join(StreamIndexEntry._fields) + "\n")
+                tostr = lambda x: "" if x is None else str(x)
+                for e in self.entries:
+                    cell = " ".join(map(lambda x: "%.5f"%x, e.cell)) if e.cell else ""
+                    ofs.write("\t".join(map(tostr, e[:-1]) + [cell]) + "\n")
+            os.chmod(tmp, stat.S_IMODE(os.stat(self.stream).st_mode) & 0666)
+            os.rename(tmp, self.indexfile)
+            return True
+        except (IOError, OSError):
+            if tmp is not None and os.path.isfile(tmp): os.remove(tmp)
+            return False
+    # save()
+
+    def load(self):
+        if not os.path.isfile(self.indexfile): return False
+
+        ifs = open(self.indexfile)
+        if ifs.readline().strip() != "# stream index version %d %s" % (self.version, self._stream_key()):
+            return False
+        ifs.readline() # column names
+
+        fromstr = lambda x, t: None if x == "" else t(x)
+        self.entries = []
+        for l in ifs:
+            sp = l.rstrip("\n").split("\t")
+            self.entries.append(StreamIndexEntry(int(sp[0]), int(sp[1]),
+                                                 fromstr(sp[2], str), fromstr(sp[3], str), fromstr(sp[4], str),
+                                                 fromstr(sp[5], float), int(sp[6]),
+                                                 tuple(map(float, sp[7].split())) if sp[7] else None))
+        return True
+    # load()
+
+    def indexed_entries(self):
+        return filter(lambda x: x.indexed_by is not None, self.entries)
+    # indexed_entries()
+
+    def select(self, func):
+        return filter(func, self.entries)
+    # select()
+
+    def read_header(self):
+        """
+        Lines before the first chunk
+        """
+        fin = open(self.stream)
+        end = self.entries[0].start if self.entries else os.path.getsize(self.stream)
+        return fin.read(end)
+    # read_header()
+
+    def read_raw(self, entry, fin=None):
+        if fin is None: fin = open(self.stream)
+        fin.seek(entry.start)
+        return fin.read(entry.end - entry.start)
+    # read_raw()
+
+    def read_chunk(self, entry, read_reflections=True, fin=None):
+        chunk = Chunk(read_reflections=read_reflections)
+        for l in self.read_raw(entry, fin).splitlines(True)[1:-1]:
+            chunk.parse_line(l)
+        return chunk
+    # read_chunk()
+
+    def iter_chunks(self, entries, read_reflections=True):
+        fin = open(self.stream)
+        for e in entries:
+            yield self.read_chunk(e, read_reflections, fin)
+    # iter_chunks()
+
+    def split_byte_ranges(self, entries, nsplit):
+        """
+        Split entries into at most nsplit groups of consecutive entries with similar total size.
+        Returns list of lists of entries.
+        """
+        if not entries: return []
+        total = sum(map(lambda x: x.end-x.start, entries))
+        target = float(total) / max(1, nsplit)
+        ret, acc = [[]], 0
+        for e in entries:
+            if ret[-1] and acc >= target * len(ret) and len(ret) < nsplit: ret.append([])
+            ret[-1].append(e)
+            acc += e.end - e.start
+        return ret
+    # split_byte_ranges()
+# class StreamIndex
+
+def stream_iterator(stream, start_at=0, read_reflections=True, index=None):
+    """
+    Iterate indexed chunks (indexed_by is not None) from start_at-th one.
+    If index (StreamIndex) is given, unwanted chunks are skipped without parsing.
+    """
+    if index is not None:
+        for chunk in index.iter_chunks(index.indexed_entries()[start_at:], read_reflections):
+            yield chunk
+        return
+
     if stream.endswith(".bz2"):
         fin = bz2.BZ2File(stream)
     else:
@@ -354,6 +522,229 @@ def stream_iterator(stream, start_at=0, read_reflections=True):
             chunk.parse_line(l)
 # stream_iterator()
 
+columnar_version = 1
+refl_dtypes = collections.OrderedDict((("h", numpy.int32), ("k", numpy.int32), ("l", numpy.int32),
+                                       ("iobs", numpy.float64), ("sigma", numpy.float64),
+                                       ("peak", numpy.float32), ("background", numpy.float32),
+                                       ("fs", numpy.float32), ("ss", numpy.float32), ("panel", numpy.int16)))
+chunk_columns = ("start", "filename", "event", "indexed_by", "res_lim", "n_refl", "cell", "nobs")
+
+def decode_reflections(block, has_panel, panel_ids):
+    """
+    Decode lines of a reflection block at once into dict of numpy columns (keys of refl_dtypes).
+    Panel names are converted to ids using panel_ids (dict; updated for new names). -1 if no panel column.
+    """
+    ncol = 10 if has_panel else 9
+    tokens = numpy.array(block.split())
+    if tokens.size % ncol != 0: raise RuntimeError("Irregular reflection block")
+    tokens = tokens.reshape(-1, ncol)
+
+    ret = {}
+    for i, k in enumerate(refl_dtypes.keys()[:9]):
+        ret[k] = tokens[:,i].astype(refl_dtypes[k])
+
+    if has_panel:
+        names, inv = numpy.unique(tokens[:,9], return_inverse=True)
+        lut = numpy.array(map(lambda x: panel_ids.setdefault(str(x), len(panel_ids)), names), dtype=numpy.int16)
+        ret["panel"] = lut[inv]
+    else:
+        ret["panel"] = numpy.empty(len(tokens), dtype=numpy.int16)
+        ret["panel"].fill(-1)
+    return ret
+# decode_reflections()
+
+def concatenate_columns(columns_list, dtypes=refl_dtypes):
+    if not columns_list: return dict((k, numpy.zeros(0, dtype=dtypes[k])) for k in dtypes)
+    return dict((k, numpy.concatenate(map(lambda x: x[k], columns_list))) for k in dtypes)
+# concatenate_columns()
+
+def parse_chunk_columnar(raw, panel_ids):
+    """
+    Parse raw text of a chunk. Reflection blocks are decoded by decode_reflections() and
+    other lines by Chunk.parse_line(). Reflections of all crystals are concatenated, as Chunk does.
+    Returns (Chunk without reflections, dict of reflection columns)
+    """
+    chunk = Chunk(read_reflections=False)
+    blocks = []
+    pos = 0
+    while True:
+        i = raw.find("\n   h    k    l", pos)
+        if i < 0: break
+        j = raw.find("\n", i+1)
+        k = raw.find("\nEnd of reflections", j)
+        if j < 0 or k < 0: raise RuntimeError("Unterminated reflection block")
+        for l in raw[pos:i+1].splitlines(): chunk.parse_line(l)
+        blocks.append(decode_reflections(raw[j+1:k+1], "panel" in raw[i:j], panel_ids))
+        pos = k + 1
+
+    for l in raw[pos:].splitlines(): chunk.parse_line(l)
+    return chunk, concatenate_columns(blocks)
+# parse_chunk_columnar()
+
+def write_columnar_part(index, entries, partfile):
+    fin = open(index.stream)
+    panel_ids = {}
+    chunks, refls = [], []
+    for e in entries:
+        chunk, cols = parse_chunk_columnar(index.read_raw(e, fin), panel_ids)
+        chunks.append(chunk)
+        refls.append(cols)
+
+    nobs = map(lambda x: len(x["h"]), refls)
+    refls = concatenate_columns(refls)
+    tostr = lambda x: "" if x is None else x
+    nan6 = (float("nan"),)*6
+    numpy.savez(partfile,
+                start=numpy.array(map(lambda x: x.start, entries), dtype=numpy.int64),
+                filename=numpy.array(map(lambda x: tostr(x.filename), chunks), dtype=str),
+                event=numpy.array(map(lambda x: tostr(x.event), chunks), dtype=str),
+                indexed_by=numpy.array(map(lambda x: tostr(x.indexed_by), chunks), dtype=str),
+                res_lim=numpy.array(map(lambda x: float("nan") if x.res_lim is None else x.res_lim, chunks), dtype=numpy.float64),
+                n_refl=numpy.array(map(lambda x: x.n_refl, chunks), dtype=numpy.int64),
+                cell=numpy.array(map(lambda x: x.cell if x.cell else nan6, chunks), dtype=numpy.float64).reshape(-1, 6),
+                nobs=numpy.array(nobs, dtype=numpy.int64),
+                panel_names=numpy.array(sorted(panel_ids, key=lambda x: panel_ids[x]), dtype=str),
+                **refls)
+    return len(entries), len(refls["h"])
+# write_columnar_part()
+
+def make_columnar_stream(stream, outdir=None, nproc=1, index=None):
+    """
+    Parse indexed chunks of stream into columnar store (directory; default: stream+".cols").
+    The stream is split at chunk boundaries using StreamIndex and the pieces are parsed in parallel;
+    each piece is saved as partNNNN.npz. info.txt is written at last and records size and mtime of the stream.
+    Returns outdir.
+    """
+    if index is None: index = StreamIndex(stream)
+    if outdir is None: outdir = stream + ".cols"
+    if not os.path.exists(outdir): os.makedirs(outdir)
+
+    infofile = os.path.join(outdir, "info.txt")
+    if os.path.isfile(infofile): os.remove(infofile)
+    for f in glob.glob(os.path.join(outdir, "part*.npz")): os.remove(f)
+
+    # more pieces than processes to balance loads
+    groups = index.split_byte_ranges(index.indexed_entries(), nproc*4 if nproc > 1 else 1)
+    if not groups: groups = [[]]
+
+    def work(i):
+        return write_columnar_part(index, groups[i], os.path.join(outdir, "part%.4d.npz" % i))
+    # work()
+
+    ret = run_tasks(work, xrange(len(groups)), nproc)
+
+    ofs = open(infofile, "w")
+    ofs.write("# columnar stream version %d %s\n" % (columnar_version, index._stream_key()))
+    ofs.write("stream %s\n" % os.path.abspath(stream))
+    ofs.write("nparts %d\n" % len(groups))
+    ofs.write("nchunks %d\n" % sum(map(lambda x: x[0], ret)))
+    ofs.write("nobs %d\n" % sum(map(lambda x: x[1], ret)))
+    ofs.close()
+    return outdir
+# make_columnar_stream()
+
+def is_columnar_stream(path):
+    return os.path.isfile(os.path.join(path, "info.txt"))
+# is_columnar_stream()
+
+class ColumnarStream:
+    """
+    Indexed chunks and their reflections saved by make_columnar_stream().
+    chunks and refls are dicts of numpy columns (chunk_columns and keys of refl_dtypes).
+    Reflections of i-th chunk are refls[key][offsets[i]:offsets[i+1]].
+    panel ids refer to panel_names.
+    """
+
+    def __init__(self, dirname):
+        ifs = open(os.path.join(dirname, "info.txt"))
+        header = ifs.readline()
+        if not header.startswith("# columnar stream version %d " % columnar_version):
+            raise RuntimeError("Unsupported columnar stream: %s" % dirname)
+        info = dict(map(lambda x: x.rstrip("\n").split(" ", 1), ifs))
+        self.stream = info["stream"]
+
+        self.panel_names = []
+        chunks, refls = [], []
+        for i in xrange(int(info["nparts"])):
+            p = numpy.load(os.path.join(dirname, "part%.4d.npz" % i))
+            chunks.append(dict(map(lambda k: (k, p[k]), chunk_columns)))
+            refls.append(dict(map(lambda k: (k, p[k]), refl_dtypes)))
+
+            # panel ids are local to each part. the last element maps -1 (no panel) to itself.
+            lut = []
+            for n in map(str, p["panel_names"]):
+                if n not in self.panel_names: self.panel_names.append(n)
+                lut.append(self.panel_names.index(n))
+            refls[-1]["panel"] = numpy.array(lut + [-1], dtype=numpy.int16)[refls[-1]["panel"]]
+
+        self.chunks = dict(map(lambda k: (k, numpy.concatenate(map(lambda x: x[k], chunks))), chunk_columns))
+        self.refls = concatenate_columns(refls)
+        self.offsets = numpy.concatenate(([0], numpy.cumsum(self.chunks["nobs"])))
+    # __init__()
+
+    def n_chunks(self):
+        return len(self.chunks["nobs"])
+    # n_chunks()
+
+    def reflection_selection(self, chunk_ids):
+        """
+        Positions of reflections of the chunks (in the given order)
+        """
+        chunk_ids = numpy.asarray(chunk_ids, dtype=int)
+        counts = self.chunks["nobs"][chunk_ids]
+        if counts.sum() == 0: return numpy.zeros(0, dtype=int)
+        shifts = self.offsets[chunk_ids] - numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        return numpy.repeat(shifts, counts) + numpy.arange(counts.sum())
+    # reflection_selection()
+
+    def miller_indices(self, sel=None):
+        """
+        List of (h,k,l)
+        """
+        h, k, l = map(lambda x: self.refls[x] if sel is None else self.refls[x][sel], "hkl")
+        return zip(h.tolist(), k.tolist(), l.tolist())
+    # miller_indices()
+
+    def miller_array(self, symm, anomalous_flag, chunk_ids=None, peak_max=None):
+        """
+        Unmerged intensities of given chunks (all if None).
+        Observations with peak > peak_max are excluded if peak_max is given.
+        """
+        sel = self.reflection_selection(chunk_ids) if chunk_ids is not None else numpy.arange(len(self.refls["h"]))
+        if peak_max is not None: sel = sel[self.refls["peak"][sel] <= peak_max]
+
+        miller_set = miller.set(crystal_symmetry=symm,
+                                indices=flex.miller_index(self.miller_indices(sel)),
+                                anomalous_flag=anomalous_flag)
+        return miller.array(miller_set=miller_set,
+                            data=flex.double(self.refls["iobs"][sel]),
+                            sigmas=flex.double(self.refls["sigma"][sel])).set_observation_type_xray_intensity()
+    # miller_array()
+
+    def get_chunk(self, i):
+        """
+        Chunk object of i-th chunk (only items saved in columnar store)
+        """
+        chunk = Chunk()
+        fromstr = lambda x: None if x == "" else str(x)
+        chunk.filename = fromstr(self.chunks["filename"][i])
+        chunk.event = fromstr(self.chunks["event"][i])
+        chunk.indexed_by = fromstr(self.chunks["indexed_by"][i])
+        res_lim = float(self.chunks["res_lim"][i])
+        chunk.res_lim = None if res_lim != res_lim else res_lim
+        chunk.n_refl = int(self.chunks["n_refl"][i])
+        cell = tuple(self.chunks["cell"][i].tolist())
+        chunk.cell = None if cell[0] != cell[0] else cell
+
+        slc = slice(self.offsets[i], self.offsets[i+1])
+        chunk.indices = self.miller_indices(slc)
+        for k in ("iobs", "sigma", "peak", "background", "fs", "ss"):
+            setattr(chunk, k, self.refls[k][slc].tolist())
+        chunk.panel = map(lambda x: self.panel_names[x], self.refls["panel"][slc].tolist()) if self.panel_names else []
+        return chunk
+    # get_chunk()
+# class ColumnarStream
+
 if __name__ == "__main__":
     import sys
     import time
@@ -4,10 +4,13 @@ Author: Keitaro Yamashita
 
 This software is released under the new BSD License; see LICENSE.
 """
-import os, glob, re
+import os, glob, re, fnmatch
 from yamtbx.dataproc import XIO
 from yamtbx.util import directory_included
 import traceback
+import threading
+import time
+import cPickle as pickle
 
 IMG_EXTENSIONS = ".img", ".osc", ".cbf", ".mccd", ".mar1600", "_master.h5"
 COMPRESS_EXTENSIONS = ".bz2", ".gz"
@@ -15,22 +18,30 @@ COMPRESS_EXTENSIONS = ".bz2", ".gz"
 re_pref_num_ext = re.compile("(.*[^0-9])([0-9]+)\.(.*)")
 re_pref_num = re.compile("(.*\.)([0-9]+)(\.)?((?(3).+))$") # .0001 style
 
+re_including_digits = re.compile("[0-9]")
+re_noext = re.compile(".*\.[0-9]+(?:\.gz|\.bz2)?$")
+possible_extensions = tuple([ i+c for i in IMG_EXTENSIONS for c in COMPRESS_EXTENSIONS+("",) ])
+
+def is_img_filename(filename):
+    """
+    True if filename ends with IMG_EXTENSIONS and includes digits
+    """
+    return (filename.endswith(possible_extensions) and re_including_digits.search(filename) is not None) or re_noext.search(filename) is not None
+# is_img_filename()
+
 def find_img_files(parentdir, recursive=True, skip_symlinks=False):
     """
     find files ending with IMG_EXTENSIONS and including digits
     @return image file names
     """
     matches = []
-    re_including_digits = re.compile("[0-9]")
-    re_noext = re.compile(".*\.[0-9]+(?:\.gz|\.bz2)?$")
-    possible_extensions = tuple([ i+c for i in IMG_EXTENSIONS for c in COMPRESS_EXTENSIONS+("",) ])
 
     for root, dirnames, filenames in os.walk(parentdir, followlinks=not skip_symlinks):
         if not recursive and root != parentdir:
             continue
 
         for filename in filenames:
-            if (filename.endswith(possible_extensions) and re_including_digits.search(filename)) or re_noext.search(filename):
+            if is_img_filename(filename):
                 if skip_symlinks and os.path.islink(os.path.join(root, filename)):
                     continue
                 matches.append(os.path.join(root, filename))
@@ -299,25 +310,212 @@ def find_data_sets(wdir, skip_symlinks=True, skip_0=False, split_hdf_miniset=Tru
             ret.append([img_template, minf, maxf])
 
     for f in h5files:
-        try:
-            im = XIO.Image(f)
-        except:
-            print "Error on reading", f
-            print traceback.format_exc()
-            continue
+        ret.extend(find_data_sets_in_master_h5(f, split_hdf_miniset))
 
-        if not split_hdf_miniset:
-            ret.append([f.replace("_master.h5","_??????.h5"), 1, im.header["Nimages"]])
-            continue
+    return ret
+# find_data_sets()
 
-        for i in xrange(im.header["Nimages"]//im.header["Nimages_each"]+1):
-            nr0, nr1 = im.header["Nimages_each"]*i+1, im.header["Nimages_each"]*(i+1)
-            if nr1 > im.header["Nimages"]: nr1 = im.header["Nimages"]
-            ret.append([f.replace("_master.h5","_??????.h5"), nr0, nr1])
-            if nr1 == im.header["Nimages"]: break
+def find_data_sets_in_master_h5(f, split_hdf_miniset=True):
+    """
+    Returns datasets ([template, first, last]) of master h5 file, or None if it cannot be read.
+    """
+    ret = []
+    try:
+        im = XIO.Image(f)
+    except:
+        print "Error on reading", f
+        print traceback.format_exc()
+        return None
+
+    if not split_hdf_miniset:
+        return [[f.replace("_master.h5","_??????.h5"), 1, im.header["Nimages"]]]
+
+    for i in xrange(im.header["Nimages"]//im.header["Nimages_each"]+1):
+        nr0, nr1 = im.header["Nimages_each"]*i+1, im.header["Nimages_each"]*(i+1)
+        if nr1 > im.header["Nimages"]: nr1 = im.header["Nimages"]
+        ret.append([f.replace("_master.h5","_??????.h5"), nr0, nr1])
+        if nr1 == im.header["Nimages"]: break
 
     return ret
-# find_data_sets()
+# find_data_sets_in_master_h5()
+
+class DatasetCatalog:
+    """
+    Incremental find_data_sets() for a directory tree watched repeatedly.
+
+    Modification times and subdirectories of all directories are remembered, and only directories
+    whose mtime changed (or which inotify reported, if use_inotify=True and the inotify module is
+    available) are listed again. Datasets are re-evaluated (headers are read) only for templates
+    whose frame range or number of files changed, and for master h5 files whose size or mtime changed.
+    Note that inotify does not see files written by other hosts on network file systems.
+
+    The state can be saved to cache_file, so that a restarted program does not need to read headers again.
+    """
+
+    def __init__(self, topdir, skip_symlinks=True, skip_0=False, split_hdf_miniset=True,
+                 cache_file=None, use_inotify=False):
+        self.topdir = os.path.abspath(topdir)
+        self.skip_symlinks = skip_symlinks
+        self.skip_0 = skip_0
+        self.split_hdf_miniset = split_hdf_miniset
+        self.cache_file = cache_file
+
+        self.dirs = {} # {dirname: (mtime, subdirs)}
+        self.dir_entries = {} # {dirname: set of templates and master h5 files}
+        self.entries = {} # {template or master h5: (state, datasets)}
+        self._retry = set() # directories to be listed again anyway
+        self._dirty = None # directories reported by inotify; None if not watched
+        self._lock = threading.Lock()
+
+        if self.cache_file and os.path.isfile(self.cache_file):
+            try:
+                tmp = pickle.load(open(self.cache_file, "rb"))
+                if tmp["topdir"] == self.topdir and tmp["params"] == self.params():
+                    self.dirs, self.dir_entries, self.entries = tmp["dirs"], tmp["dir_entries"], tmp["entries"]
+            except:
+                print "Error on reading", self.cache_file
+                print traceback.format_exc()
+
+        if use_inotify: self.start_inotify()
+    # __init__()
+
+    def params(self): return (self.skip_symlinks, self.skip_0, self.split_hdf_miniset)
+
+    def start_inotify(self):
+        """
+        Start a thread to collect directories with events. Returns False if inotify is not available.
+        """
+        try:
+            import inotify.adapters # use yamtbx.python -mpip install inotify
+            import inotify.constants
+        except ImportError:
+            return False
+
+        mask = (inotify.constants.IN_CREATE | inotify.constants.IN_DELETE | inotify.constants.IN_MOVED_TO |
+                inotify.constants.IN_MOVED_FROM | inotify.constants.IN_CLOSE_WRITE)
+        itree = inotify.adapters.InotifyTree(self.topdir, mask=mask)
+        self._dirty = set(self.dirs) # changes before watch started
+
+        def collect():
+            for header, type_names, path, filename in itree.event_gen(yield_nones=False):
+                with self._lock: self._dirty.add(os.path.normpath(path))
+        # collect()
+
+        t = threading.Thread(None, collect)
+        t.daemon = True
+        t.start()
+        return True
+    # start_inotify()
+
+    def dirs_to_scan(self):
+        if not self.dirs: return set([self.topdir])
+
+        ret = set(self._retry)
+        if self._dirty is not None:
+            with self._lock:
+                ret.update(self._dirty)
+                self._dirty = set()
+            return ret
+
+        for d in self.dirs:
+            try: mtime = os.stat(d).st_mtime
+            except OSError: mtime = None
+            if mtime != self.dirs[d][0]: ret.add(d)
+        return ret
+    # dirs_to_scan()
+
+    def forget_dir(self, d):
+        if d not in self.dirs: return
+        for sd in self.dirs.pop(d)[1]: self.forget_dir(sd)
+        for e in self.dir_entries.pop(d, ()): self.entries.pop(e, None)
+    # forget_dir()
+
+    def scan_dir(self, d, changed):
+        """
+        List d and re-evaluate its datasets. Templates and files whose datasets changed are added to changed.
+        Returns new subdirectories.
+        """
+        try:
+            mtime = os.stat(d).st_mtime
+            names = os.listdir(d)
+        except OSError:
+            self.forget_dir(d)
+            return []
+
+        if time.time() - mtime < 2: self._retry.add(d) # files may be added within the mtime resolution
+        else: self._retry.discard(d)
+
+        img_files, subdirs = [], []
+        for n in names:
+            f = os.path.join(d, n)
+            if self.skip_symlinks and os.path.islink(f): continue
+            if is_img_filename(n): img_files.append(f)
+            elif os.path.isdir(f): subdirs.append(f)
+
+        old_subdirs = self.dirs[d][1] if d in self.dirs else []
+        for sd in set(old_subdirs).difference(subdirs): self.forget_dir(sd)
+        self.dirs[d] = (mtime, subdirs)
+
+        entries = set()
+        other_files = filter(lambda x: not x.endswith(".h5"), img_files)
+        for img_template, min_frame, max_frame in group_img_files_template(other_files, skip_0=self.skip_0):
+            entries.add(img_template)
+            if min_frame == max_frame: continue
+            state = (min_frame, max_frame, len(fnmatch.filter(other_files, img_template)))
+            if self.entries.get(img_template, (None,))[0] == state: continue
+            ranges = takeout_datasets(img_template, min_frame, max_frame)
+            if not ranges: # failed to read some header
+                self._retry.add(d)
+                continue
+            self.entries[img_template] = (state, map(lambda x: [img_template]+list(x), ranges))
+            changed.add(img_template)
+
+        for f in filter(lambda x: x.endswith(".h5"), img_files):
+            entries.add(f)
+            try: st = os.stat(f)
+            except OSError: continue
+            state = (st.st_mtime, st.st_size)
+            if self.entries.get(f, (None,))[0] == state: continue
+            ds = find_data_sets_in_master_h5(f, self.split_hdf_miniset)
+            if ds is None: # may be being written
+                self._retry.add(d)
+                continue
+            self.entries[f] = (state, ds)
+            changed.add(f)
+
+        for e in self.dir_entries.get(d, set()).difference(entries): self.entries.pop(e, None)
+        self.dir_entries[d] = entries
+
+        return filter(lambda x: x not in self.dirs, subdirs)
+    # scan_dir()
+
+    def update(self):
+        """
+        Returns (all datasets, datasets new or changed since the last update).
+        Datasets are [template, first frame, last frame] as find_data_sets() returns.
+        """
+        changed = set()
+        queue = list(self.dirs_to_scan())
+        while queue:
+            queue.extend(self.scan_dir(os.path.normpath(queue.pop()), changed))
+
+        if changed and self.cache_file: self.save()
+
+        all_ds, new_ds = [], []
+        for e in sorted(self.entries):
+            all_ds.extend(self.entries[e][1])
+            if e in changed: new_ds.extend(self.entries[e][1])
+        return all_ds, new_ds
+    # update()
+
+    def save(self):
+        tmp = self.cache_file + ".tmp"
+        pickle.dump(dict(topdir=self.topdir, params=self.params(), dirs=self.dirs,
+                         dir_entries=self.dir_entries, entries=self.entries), open(tmp, "wb"), -1)
+        os.rename(tmp, self.cache_file)
+    # save()
+
+# class DatasetCatalog
 
 def find_data_sets_from_dataset_paths_txt(input_file, include_dir=[], shorten_frame_range=False, logger=None):
 
@@ -14,101 +14,309 @@ import json
 import struct
 import numpy
 import os
+import collections
+import threading
 from yamtbx.dataproc import software_binning
 
-def read_stream_data(frames, bss_job_mode=4):
+# bitshuffle.h5.H5FILTER and H5_COMPRESS_LZ4, to check filters of datasets without importing bitshuffle
+BSHUF_H5FILTER = 32008
+BSHUF_H5_COMPRESS_LZ4 = 2
+
+# compressed chunk of a frame, written to a dataset having the same filter and chunk shape as it is
+CompressedFrame = collections.namedtuple("CompressedFrame", ("filter_mask", "data", "shape", "dtype"))
+
+def frame_buffer(frame):
+    """
+    Buffer of zmq.Frame (received with copy=False) without copying, or frame itself if it is str.
+    """
+    return getattr(frame, "buffer", frame)
+# frame_buffer()
+
+def lz4_decompress(buf, size):
     import lz4
-    import bitshuffle
-    if len(frames) != 5:
-        return None, None
-
-    header = json.loads(frames[0].bytes)
-    for i in (1,3,4): header.update(json.loads(frames[i].bytes))
-
-    if header.get("bss_job_mode", 4) != bss_job_mode:
-        return None, None
-
-    dtype = header["type"]
-    shape = header["shape"][::-1]
-
-    if dtype in ("int32","uint32"): byte = 4
-    elif dtype in ("int16","uint16"): byte = 2
-    else: raise RuntimeError("Unknown dtype (%s)"%dtype)
-
-    size = byte*shape[0]*shape[1]
-
-    if header["encoding"] == "lz4<":
-        data = lz4.loads(struct.pack('<I', size) + frames[2].bytes)
-        data = numpy.fromstring(data, dtype=dtype).reshape(shape)
-        assert data.size * data.dtype.itemsize == size
-    elif header["encoding"] == "bs32-lz4<":
-        data = frames[2].bytes
-        blob = numpy.fromstring(data[12:],dtype=numpy.uint8)
-        # blocksize is big endian uint32 starting at byte 8, divided by element size
-        blocksize = numpy.ndarray(shape=(),dtype=">u4", buffer=data[8:12])/4
-        data = bitshuffle.decompress_lz4(blob, shape, numpy.dtype(dtype), blocksize)
-        data = data.reshape(shape)
-    elif header["encoding"] == "bs16-lz4<":
-        data = frames[2].bytes
-        blob = numpy.fromstring(data[12:],dtype=numpy.uint8)
-        data = bitshuffle.decompress_lz4(blob, shape, numpy.dtype(dtype))
-        data = data.reshape(shape)
-    else:
-        RuntimeError("Unknown encoding (%s)"%header["encoding"])
+    if hasattr(lz4, "block"): # python-lz4 >= 0.10 accepts buffer and size
+        return lz4.block.decompress(buf, uncompressed_size=size)
+    return lz4.loads(struct.pack('<I', size) + str(buf))
+# lz4_decompress()
 
-    bad_sel = data==2**(byte*8)-1
-    data = data.astype(numpy.int32)
-    data[bad_sel] = -1
-    return header, data
+class StreamDecoder:
+    """
+    Decoder of EIGER stream frames, to be kept by each receiver (worker).
+    Compressed data are read from the zmq frame without copying, and decode() returns the data
+    in the native dtype. Neither lz4.block nor bitshuffle.decompress_lz4 can write into a given
+    buffer, so the decompressed data are still allocated for each frame; allocation is only reduced.
+    Conversion to int32 (as_int32()) is done in buffers reused for all frames of the same shape;
+    returned int32 arrays are overwritten by the next call.
+    """
+    def __init__(self):
+        self._buffers = {}
+    # __init__()
+
+    def get_buffer(self, name, shape, dtype):
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = self._buffers[name] = numpy.empty(shape, dtype=dtype)
+        return buf
+    # get_buffer()
+
+    def decode(self, frames, bss_job_mode=4):
+        """
+        Returns header and data in the native dtype (may be read-only), or (None, None)
+        if frames are not an image of the bss job mode.
+        """
+        import bitshuffle
+        if len(frames) != 5:
+            return None, None
+
+        header = json.loads(frames[0].bytes)
+        for i in (1,3,4): header.update(json.loads(frames[i].bytes))
+
+        if header.get("bss_job_mode", 4) != bss_job_mode:
+            return None, None
+
+        dtype = numpy.dtype(str(header["type"]))
+        shape = header["shape"][::-1]
+
+        if dtype.name not in ("int32","uint32","int16","uint16"):
+            raise RuntimeError("Unknown dtype (%s)"%dtype)
+
+        size = dtype.itemsize*shape[0]*shape[1]
+        buf = frame_buffer(frames[2])
+
+        if header["encoding"] == "lz4<":
+            data = numpy.frombuffer(lz4_decompress(buf, size), dtype=dtype).reshape(shape)
+            assert data.size * data.dtype.itemsize == size
+        elif header["encoding"] in ("bs32-lz4<", "bs16-lz4<"):
+            blob = numpy.frombuffer(buf, dtype=numpy.uint8, offset=12)
+            blocksize = 0
+            if header["encoding"] == "bs32-lz4<":
+                # blocksize is big endian uint32 starting at byte 8, divided by element size
+                blocksize = int(numpy.frombuffer(buf, dtype=">u4", count=1, offset=8)[0])//4
+            data = bitshuffle.decompress_lz4(blob, shape, dtype, blocksize).reshape(shape)
+        else:
+            raise RuntimeError("Unknown encoding (%s)"%header["encoding"])
+
+        return header, data
+    # decode()
+
+    def as_int32(self, data, bad_value=-1):
+        """
+        int32 copy of data in the reused buffer, where saturated (bad) pixels are set to bad_value.
+        """
+        out = self.get_buffer("int32", data.shape, numpy.int32)
+        numpy.copyto(out, data, casting="unsafe")
+        if data.dtype.kind == "u":
+            bad_sel = self.get_buffer("bad_sel", data.shape, numpy.bool_)
+            numpy.equal(data, numpy.iinfo(data.dtype).max, out=bad_sel)
+            numpy.putmask(out, bad_sel, bad_value)
+        return out
+    # as_int32()
+
+# class StreamDecoder
+
+def read_stream_data(frames, bss_job_mode=4, decoder=None):
+    """
+    Returns header and int32 data where bad pixels are -1, as needed by the spot finder;
+    every frame is converted. Use StreamDecoder.decode() for the native dtype.
+    Give decoder (StreamDecoder) to reuse its buffers; then data are overwritten by the next call.
+    Raises RuntimeError for unknown dtype or encoding.
+    """
+    if decoder is None: decoder = StreamDecoder()
+    header, data = decoder.decode(frames, bss_job_mode)
+    if data is None: return None, None
+    return header, decoder.as_int32(data)
 # read_stream_data()
 
-def data_as_int32_masked(data, apply_pixel_mask, h5handle):
+def mask_data_as_int32(data, pixel_mask=None):
     bad_sel = data == 2**(data.dtype.itemsize*8)-1
     data = data.astype(numpy.int32)
     data[bad_sel] = -3 # To see pixels not masked by pixel mask.
+    if pixel_mask is not None:
+        data[pixel_mask==1] = -1
+        data[pixel_mask>1] = -2
+
+    return data
+# mask_data_as_int32()
+
+def data_as_int32_masked(data, apply_pixel_mask, h5handle):
+    mask = None
     if apply_pixel_mask and "/entry/instrument/detector/detectorSpecific/pixel_mask" in h5handle:
         mask = h5handle["/entry/instrument/detector/detectorSpecific/pixel_mask"][:]
-        data[mask==1] = -1
-        data[mask>1] = -2
 
-    return data
+    return mask_data_as_int32(data, mask)
 # data_as_int32()
 
+class EigerMaster:
+    """
+    Reader of master h5 file.
+    Frame numbers are indexed once (frameno -> (key in /entry/data, index in data file)),
+    data files are kept open (up to max_open_files, least recently used ones are closed),
+    and pixel mask is read only once.
+    Data files not yet existing (during data collection) are checked again when a frame is not found.
+    Use open_master() to share the objects; index and open datasets are guarded by a lock for threads.
+    """
+
+    def __init__(self, h5master, max_open_files=16):
+        self.filename = h5master
+        self.h5 = h5py.File(h5master, "r")
+        self.max_open_files = max_open_files
+        self._datasets = collections.OrderedDict() # {key: dataset}, in order of use
+        self._lock = threading.RLock()
+        self._pixel_mask = None
+        self._raw_header = None
+        self.frame_index = {} # {frameno: (key, idx)}
+        self.unresolved_keys = sorted(self.h5["/entry/data"].keys())
+        self.update_index()
+    # __init__()
+
+    def update_index(self):
+        """
+        Index frames of data files not indexed yet. Returns True if any added.
+        """
+        with self._lock:
+            return self._update_index()
+    # update_index()
+
+    def _update_index(self):
+        unresolved = []
+        for k in self.unresolved_keys:
+            dataset = self.get_dataset(k)
+            if dataset is None:
+                unresolved.append(k)
+                continue
+            if not isinstance(dataset, h5py.Dataset) or "image_nr_low" not in dataset.attrs:
+                continue # e.g. groups in onlyhits.h5
+            image_nr_low = dataset.attrs["image_nr_low"]
+            image_nr_high = dataset.attrs["image_nr_high"]
+            for i in xrange(image_nr_high-image_nr_low+1):
+                self.frame_index[image_nr_low+i] = (k, i)
+
+        added = len(unresolved) < len(self.unresolved_keys)
+        self.unresolved_keys = unresolved
+        return added
+    # _update_index()
+
+    def get_dataset(self, key):
+        with self._lock:
+            if key in self._datasets:
+                self._datasets[key] = self._datasets.pop(key)
+                return self._datasets[key]
+
+            dataset = self.h5["/entry/data"].get(key)
+            if dataset is None: return None
+            self._datasets[key] = dataset
+            while len(self._datasets) > self.max_open_files: self._datasets.popitem(last=False)
+            return dataset
+    # get_dataset()
+
+    def frame_numbers(self):
+        with self._lock:
+            return sorted(self.frame_index)
+    # frame_numbers()
+
+    def locate(self, frameno):
+        """
+        Returns (key, index in data file), or None if not found
+        """
+        if frameno not in self.frame_index and self.unresolved_keys: self.update_index()
+        return self.frame_index.get(frameno)
+    # locate()
+
+    def group_frames(self, framenos):
+        """
+        Returns list of (key, [(frameno, idx), ..]) in file order. Frames not found are not included.
+        """
+        groups = {}
+        for frameno in sorted(set(framenos)):
+            loc = self.locate(frameno)
+            if loc is None: continue
+            groups.setdefault(loc[0], []).append((frameno, loc[1]))
+        return sorted(groups.items())
+    # group_frames()
+
+    def pixel_mask(self):
+        if self._pixel_mask is None:
+            path = "/entry/instrument/detector/detectorSpecific/pixel_mask"
+            self._pixel_mask = self.h5[path][:] if path in self.h5 else False
+        return self._pixel_mask if self._pixel_mask is not False else None
+    # pixel_mask()
+
+    def raw_header(self):
+        """
+        Copy of header dict by eiger_hdf5_interpreter (read once)
+        """
+        if self._raw_header is None:
+            from yamtbx.dataproc.XIO.plugins import eiger_hdf5_interpreter
+            self._raw_header = eiger_hdf5_interpreter.Interpreter().getRawHeadDict(self.filename)
+        return dict(self._raw_header)
+    # raw_header()
+
+    def get_raw(self, frameno):
+        loc = self.locate(frameno)
+        if loc is None: return None
+        return self.get_dataset(loc[0])[loc[1],]
+    # get_raw()
+
+    def get_data(self, frameno, apply_pixel_mask=True):
+        data = self.get_raw(frameno)
+        if data is None: return None
+        return mask_data_as_int32(data, self.pixel_mask() if apply_pixel_mask else None)
+    # get_data()
+
+    def iter_frames(self, framenos=None, apply_pixel_mask=True, return_raw=False):
+        """
+        Yields (frameno, data) in file order. All frames if framenos is None.
+        """
+        if framenos is None: framenos = self.frame_numbers()
+        for k, frames in self.group_frames(framenos):
+            dataset = self.get_dataset(k)
+            for frameno, idx in frames:
+                data = dataset[idx,]
+                if not return_raw: data = mask_data_as_int32(data, self.pixel_mask() if apply_pixel_mask else None)
+                yield frameno, data
+    # iter_frames()
+
+    def close(self):
+        with self._lock:
+            self._datasets.clear()
+            self.h5.close()
+    # close()
+# class EigerMaster
+
+_masters = collections.OrderedDict() # {filename: (key, EigerMaster)}
+_masters_lock = threading.Lock()
+
+def open_master(h5master, max_cached=4):
+    """
+    Shared EigerMaster object. Recreated when the master file is modified.
+    Objects dropped from the cache are not closed, as callers may still use them;
+    the files are closed when they are no longer referenced.
+    """
+    h5master = os.path.abspath(h5master)
+    st = os.stat(h5master)
+    key = (st.st_size, st.st_mtime, st.st_ino)
+
+    with _masters_lock:
+        if h5master in _masters:
+            cached_key, master = _masters.pop(h5master)
+            if cached_key == key:
+                _masters[h5master] = (key, master)
+                return master
+
+        master = EigerMaster(h5master)
+        _masters[h5master] = (key, master)
+        while len(_masters) > max_cached: _masters.popitem(last=False)
+        return master
+# open_master()
+
 def data_iter(h5master, apply_pixel_mask=True, return_raw=False):
-    h5 = h5py.File(h5master, "r")
-    data = None
-
-    for k in sorted(h5["/entry/data"].keys()):
-        if not h5["/entry/data"].get(k): continue
-        for data in h5["/entry/data"][k]:
-            if not return_raw:
-                data = data_as_int32_masked(data, apply_pixel_mask, h5)
-            yield data
+    for frameno, data in open_master(h5master).iter_frames(None, apply_pixel_mask, return_raw):
+        yield data
 # extract_data()
 
 def extract_data(h5master, frameno, apply_pixel_mask=True, return_raw=False):
-    h5 = h5py.File(h5master, "r")
-    data = None
-
-    if 0:
-        i_seen = 0
-        for k in sorted(h5["/entry/data"].keys()):
-            try:
-                for i in xrange(h5["/entry/data"][k].shape[0]):
-                    i_seen += 1
-                    if i_seen == frameno:
-                        data = h5["/entry/data"][k][i,]
-            except KeyError:
-                break
-    else:
-        for k in sorted(h5["/entry/data"].keys()):
-            if not h5["/entry/data"].get(k): continue
-            image_nr_low = h5["/entry/data"][k].attrs["image_nr_low"]
-            image_nr_high = h5["/entry/data"][k].attrs["image_nr_high"]
-            if image_nr_low <= frameno <= image_nr_high:
-                idx = frameno - image_nr_low
-                data = h5["/entry/data"][k][idx,]
-                break
+    master = open_master(h5master)
+    data = master.get_raw(frameno)
 
     if data is None:
         print "Data not found."
@@ -117,23 +325,65 @@ def extract_data(h5master, frameno, apply_pixel_mask=True, return_raw=False):
     if return_raw:
         return data
 
-    return data_as_int32_masked(data, apply_pixel_mask, h5)
+    return mask_data_as_int32(data, master.pixel_mask() if apply_pixel_mask else None)
 # extract_data()
 
+def is_bslz4_framewise(dataset):
+    """
+    True if each frame of the dataset is one bitshuffle+LZ4 chunk, which can be copied without decompression.
+    Needs direct chunk read (h5py>=2.10).
+    """
+    if not hasattr(dataset.id, "read_direct_chunk"): return False
+    if dataset.ndim != 3 or dataset.chunks != (1,)+dataset.shape[1:]: return False
+
+    plist = dataset.id.get_create_plist()
+    if plist.get_nfilters() != 1: return False
+    code, flags, values, name = plist.get_filter(0)
+    return code == BSHUF_H5FILTER and len(values) > 4 and values[4] == BSHUF_H5_COMPRESS_LZ4
+# is_bslz4_framewise()
+
+def iter_frames_raw(h5master, framenos, allow_compressed=True):
+    """
+    Yields (frameno, frame) in file order, opening each data file only once.
+    frame is CompressedFrame if allow_compressed=True and the data file allows it;
+    otherwise raw numpy array (not masked).
+    """
+    master = open_master(h5master)
+    for k, frames in master.group_frames(framenos):
+        dataset = master.get_dataset(k)
+        if allow_compressed and is_bslz4_framewise(dataset):
+            for frameno, idx in frames:
+                filter_mask, data = dataset.id.read_direct_chunk((idx, 0, 0))
+                yield frameno, CompressedFrame(filter_mask, data, dataset.shape[1:], dataset.dtype)
+        else:
+            for frameno, idx in frames:
+                yield frameno, dataset[idx,]
+# iter_frames_raw()
+
+def write_frame(h5obj, path, frame, compression="bslz4"):
+    """
+    Write a frame from iter_frames_raw() as 2d dataset.
+    CompressedFrame is written as it is (bslz4, one chunk); otherwise compressed by compress_h5data().
+    """
+    if not isinstance(frame, CompressedFrame):
+        return compress_h5data(h5obj, path, frame, chunks=None, compression=compression)
+
+    # the filter needs to be registered (by importing bitshuffle.h5) to create the dataset
+    dataset = create_compressed_dataset(h5obj, path, frame.shape, frame.dtype, chunks=frame.shape,
+                                        compression="bslz4")
+    dataset.id.write_direct_chunk((0,)*len(frame.shape), frame.data, frame.filter_mask)
+    return dataset
+# write_frame()
+
 def get_available_frame_numbers(h5master):
-    h5 = h5py.File(h5master, "r")
-    ret = []
-    for k in sorted(h5["/entry/data"].keys()):
-        if not h5["/entry/data"].get(k): continue
-        image_nr_low = h5["/entry/data"][k].attrs["image_nr_low"]
-        image_nr_high = h5["/entry/data"][k].attrs["image_nr_high"]
-        ret.extend(range(image_nr_low, image_nr_high+1))
-    return ret
+    master = open_master(h5master)
+    master.update_index() # data files may be added during data collection
+    return master.frame_numbers()
 # get_available_frame_numbers()
 
 def extract_data_path(h5master, path, apply_pixel_mask=True, return_raw=False):
-    h5 = h5py.File(h5master, "r")
-    data = h5.get(path)
+    master = open_master(h5master)
+    data = master.h5.get(path)
     print path
     if data is None:
         print "Data not found."
@@ -143,47 +393,69 @@ def extract_data_path(h5master, path, apply_pixel_mask=True, return_raw=False):
         return data
 
     data = data[:]
-    return data_as_int32_masked(data, apply_pixel_mask, h5)
+    return mask_data_as_int32(data, master.pixel_mask() if apply_pixel_mask else None)
 # extract_data()
 
-def extract_data_range_sum(h5master, frames):
-    h5 = h5py.File(h5master, "r")
-    i_seen = 0
-    i_found = 0
-    data = None
-    for k in sorted(h5["/entry/data"].keys()):
-        try:
-            for i in xrange(h5["/entry/data"][k].shape[0]):
-                i_seen += 1
-                if i_seen in frames:
-                    i_found += 1
-                    tmp = h5["/entry/data"][k][i,]
-                    bad_sel = tmp == 2**(tmp.dtype.itemsize*8)-1
-                    tmp = tmp.astype(numpy.int32)
-                    tmp[bad_sel] = -1 # XXX if not always 'bad' pixel...
-                    if data is None: data = tmp.astype(numpy.int32)
-                    else: data += tmp
-        except KeyError:
-            break
+def contiguous_runs(indices):
+    """
+    Split sorted indices into (start, end) of contiguous runs (end is exclusive)
+    """
+    ret = []
+    for i in indices:
+        if ret and ret[-1][1] == i: ret[-1][1] = i+1
+        else: ret.append([i, i+1])
+    return map(tuple, ret)
+# contiguous_runs()
 
-    if data is None:
-        print "Data not found."
-        return data
+def extract_data_range_sum(h5master, frames, batch_mb=64):
+    """
+    frames are serial numbers (from 1) of frames in data files.
+    Frames are read as hyperslabs of contiguous frames (up to batch_mb MB at once) and summed in place,
+    in int32 if it cannot overflow and in int64 otherwise (clipped to int32 at last).
+    Pixels having the bad-pixel value in any frame are set to -3, and then pixel mask is applied.
+    Returns None unless all frames are found.
+    """
+    master = open_master(h5master)
+    framenos = master.frame_numbers()
+    groups = master.group_frames(map(lambda i: framenos[i-1], filter(lambda i: 0 < i <= len(framenos), frames)))
+    n_found = sum(map(lambda x: len(x[1]), groups))
 
-    data[data<0] = -3 # To see pixels not masked by pixel mask.
+    if n_found == 0:
+        print "Data not found."
+        return None
+    if n_found != len(frames): return None
+
+    data, bad = None, None
+    for k, frames_in_file in groups:
+        dataset = master.get_dataset(k)
+        badval = 2**(dataset.dtype.itemsize*8)-1
+        if data is None:
+            sum_dtype = numpy.int32 if (badval-1) * n_found < 2**31 else numpy.int64
+            data = numpy.zeros(dataset.shape[1:], dtype=sum_dtype)
+            bad = numpy.zeros(dataset.shape[1:], dtype=bool)
+
+        bsize = max(1, int(batch_mb*1024**2 // (data.size*dataset.dtype.itemsize)))
+        for s, e in contiguous_runs(map(lambda x: x[1], frames_in_file)):
+            for i in xrange(s, e, bsize):
+                tmp = dataset[i:min(e, i+bsize)]
+                data += tmp.sum(axis=0, dtype=sum_dtype)
+                bad |= tmp.max(axis=0) == badval
+
+    if data.dtype != numpy.int32:
+        data = numpy.minimum(data, 2**31-1).astype(numpy.int32)
+
+    data[bad] = -3 # To see pixels not masked by pixel mask.
     # Apply pixel mask
-    if "/entry/instrument/detector/detectorSpecific/pixel_mask" in h5:
-        mask = h5["/entry/instrument/detector/detectorSpecific/pixel_mask"][:]
+    mask = master.pixel_mask()
+    if mask is not None:
         data[mask==1] = -1
         data[mask>1] = -2
 
-    if i_found != len(frames): return None
     return data
 # extract_data()
 
 def extract_to_minicbf(h5master, frameno_or_path, cbfout, binning=1):
     from yamtbx.dataproc import cbf
-    from yamtbx.dataproc.XIO.plugins import eiger_hdf5_interpreter
 
     if type(frameno_or_path) in (tuple, list):
         data = extract_data_range_sum(h5master, frameno_or_path)
@@ -199,8 +471,9 @@ def extract_to_minicbf(h5master, frameno_or_path, cbfout, binning=1):
     if data is None:
         raise RuntimeError("Cannot extract frame %s from %s"%(frameno_or_path, h5master))
 
-    h = eiger_hdf5_interpreter.Interpreter().getRawHeadDict(h5master)
-    h5 = h5py.File(h5master, "r")
+    master = open_master(h5master)
+    h = master.raw_header()
+    h5 = master.h5
 
     if binning>1:
         beamxy = h["BeamX"], h["BeamY"]
@@ -229,24 +502,28 @@ def extract_to_minicbf(h5master, frameno_or_path, cbfout, binning=1):
 """ % h)
 # extract_to_minicbf()
 
-def compress_h5data(h5obj, path, data, chunks, compression="bslz4"):
+def create_compressed_dataset(h5obj, path, shape, dtype, chunks, compression="bslz4"):
+    """
+    Empty dataset to be filled later (e.g. frame by frame)
+    """
     import bitshuffle.h5
 
     if compression is None:
-        dataset = h5obj.create_dataset(path, data.shape,
-                                       chunks=chunks, dtype=data.dtype, data=data)        
+        kwds = {}
     elif compression=="bslz4":
-        dataset = h5obj.create_dataset(path, data.shape,
-                                       compression=bitshuffle.h5.H5FILTER,
-                                       compression_opts=(0, bitshuffle.h5.H5_COMPRESS_LZ4),
-                                       chunks=chunks, dtype=data.dtype, data=data)
+        kwds = dict(compression=bitshuffle.h5.H5FILTER,
+                    compression_opts=(0, bitshuffle.h5.H5_COMPRESS_LZ4))
     elif compression=="shuf+gz":
-        dataset = h5obj.create_dataset(path, data.shape,
-                                       compression="gzip",shuffle=True,
-                                       chunks=chunks, dtype=data.dtype, data=data)
+        kwds = dict(compression="gzip", shuffle=True)
     else:
         raise "Unknwon compression name (%s)" % compression
 
+    return h5obj.create_dataset(path, shape, chunks=chunks, dtype=dtype, **kwds)
+# create_compressed_dataset()
+
+def compress_h5data(h5obj, path, data, chunks, compression="bslz4"):
+    dataset = create_compressed_dataset(h5obj, path, data.shape, data.dtype, chunks, compression)
+    dataset[...] = data
     return dataset
 # compress_h5data()
 
@@ -256,17 +533,26 @@ def get_data_file_nr_range(data_h5):
     return (data.attrs["image_nr_low"], data.attrs["image_nr_high"])
 # get_data_file_nr_range()
 
-def create_data_file(outfile, data, chunks, nrlow, nrhigh, compression="bslz4"):
+def open_data_file(outfile, shape, dtype, chunks, nrlow, nrhigh, compression="bslz4"):
+    """
+    Create data file with empty /entry/data/data.
+    Returns (h5py.File, dataset); frames are written to the dataset incrementally and the file should be closed.
+    """
     h5 = h5py.File(outfile, "w")
     h5.create_group("/entry")
     h5["/entry"].attrs["NX_class"] = "NXentry"
     h5.create_group("/entry/data")
     h5["/entry/data"].attrs["NX_class"] = "NXdata"
 
-    dataset = compress_h5data(h5, "/entry/data/data", data, chunks, compression)
+    dataset = create_compressed_dataset(h5, "/entry/data/data", shape, dtype, chunks, compression)
     dataset.attrs["image_nr_low"] = nrlow
     dataset.attrs["image_nr_high"] = nrhigh
+    return h5, dataset
+# open_data_file()
 
+def create_data_file(outfile, data, chunks, nrlow, nrhigh, compression="bslz4"):
+    h5, dataset = open_data_file(outfile, data.shape, data.dtype, chunks, nrlow, nrhigh, compression)
+    dataset[...] = data
     h5.close()
 # create_data_file()
 
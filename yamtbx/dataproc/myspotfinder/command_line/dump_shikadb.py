@@ -1,5 +1,5 @@
 import  sqlite3
-import cPickle as pickle
+from yamtbx.dataproc.myspotfinder import shikadb
 import datetime
 
 def read_db(dbfile):
@@ -17,9 +17,8 @@ def read_db(dbfile):
     except sqlite3.OperationalError:
          print "TABLE updates does not exist\n"
 
-    print "TABLE spots"
-    c = con.execute("select filename,spots from spots")
-    results = dict(map(lambda x: (str(x[0]), pickle.loads(str(x[1]))), c.fetchall()))
+    print "TABLE results (schema version %d)" % con.execute("pragma user_version").fetchone()[0]
+    results = shikadb.fetch_results(con)[0]
     for filename in sorted(results):
         msg = results[filename]
         spots = msg["spots"]
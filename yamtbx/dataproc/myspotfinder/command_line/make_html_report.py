@@ -5,7 +5,6 @@ import datetime
 import collections
 import glob
 import pysqlite2.dbapi2 as sqlite3
-import cPickle as pickle
 import numpy
 import matplotlib
 matplotlib.use('Agg') # Allow to work without X
@@ -13,6 +12,7 @@ from PIL import Image
 import iotbx.phil
 from yamtbx.util import rotate_file
 from yamtbx.dataproc.myspotfinder import shikalog
+from yamtbx.dataproc.myspotfinder import shikadb
 from yamtbx.dataproc.myspotfinder.command_line.spot_finder_gui import Stat
 from yamtbx.dataproc.dataset import re_pref_num_ext
 from yamtbx.dataproc import bl_logfiles
@@ -257,8 +257,7 @@ def make_html_report(current_stats, wdir, htmlout, zoo_mode, rotate=False, plot_
     con = sqlite3.connect(dbfile, timeout=10, isolation_level=None)
     con.execute('pragma query_only = ON;')
     print "Reading data from DB for making report html."
-    c = con.execute("select filename,spots from spots")
-    dbspots = dict(map(lambda x: (str(x[0]), pickle.loads(str(x[1]))), c.fetchall()))
+    dbspots = shikadb.fetch_results(con)[0]
     spot_data = "var spot_data = {"
     for i, (f, stat) in enumerate(result):
         if stat is None: continue
@@ -479,8 +478,7 @@ def load_results(target_dir):
 
     for itrial in xrange(60):
         try:
-            c = con.execute("select filename,spots from spots")
-            results = dict(map(lambda x: (str(x[0]), pickle.loads(str(x[1]))), c.fetchall()))
+            results = shikadb.fetch_results(con)[0]
             break
         except sqlite3.DatabaseError:
             shikalog.warning("DB failed. retrying (%d)" % itrial)
@@ -1,19 +1,18 @@
 from yamtbx.dataproc.myspotfinder.command_line.spot_finder_gui import Stat
 from yamtbx.dataproc import bl_logfiles
 import pysqlite2.dbapi2 as sqlite3
-import cPickle as pickle
+from yamtbx.dataproc.myspotfinder import shikadb
 import os
 import numpy
 
 def read_db(scanlog, dbfile):
     con = sqlite3.connect(dbfile, timeout=10)
     try:
-        c = con.execute("select filename,spots from spots")
+        results = shikadb.fetch_results(con)[0]
     except sqlite3.OperationalError:
         print "# DB Error (%s)" % dbfile
         return None
 
-    results = dict(map(lambda x: (str(x[0]), pickle.loads(str(x[1]))), c.fetchall()))
     ret = []
 
     slog = bl_logfiles.BssDiffscanLog(scanlog)
@@ -30,6 +30,7 @@ from multiprocessing import Process
 
 from yamtbx.dataproc.myspotfinder import shikalog
 from yamtbx.dataproc.myspotfinder import config_manager
+from yamtbx.dataproc.myspotfinder import shikadb
 from yamtbx.dataproc.myspotfinder import spot_finder_for_grid_scan
 from yamtbx.dataproc import bl_logfiles
 from yamtbx.dataproc import eiger
@@ -67,6 +68,9 @@ ports = 5557,5558,5559
 dbdir = /isilon/cluster/log/shika/db
  .type = path
  .help = location to write sqlite3 db file.
+db_journal_mode = wal *delete
+ .type = choice(multi=False)
+ .help = "sqlite3 journal mode of shika.db. wal lets readers work while results are written, but works only when all readers are on the same host. It is used only when shika.db is on a local file system; otherwise delete is used."
 logroot = /isilon/cluster/log/shika/
  .type = path
 mode = *eiger_streaming bsslog zoo watch_ramdisk
@@ -666,17 +670,168 @@ class WatchRamdiskThread:
     # run()
 # class WatchRamdiskThread
 
+class ThumbnailMontages:
+    """
+    Thumbnail montages of 100 frames (10x10 tiles) for each (wdir, prefix, block), kept in memory
+    as numpy arrays. JPEG of a montage is written when the block is completed, otherwise at most
+    once per jpeg_interval seconds. Incomplete montages are spilled to ~/.shikatmp when evicted
+    (least recently used first, beyond max_blocks) or at close(), and taken up again when more
+    thumbnails of the block arrive.
+    """
+    def __init__(self, max_blocks=20, jpeg_interval=10.):
+        self.max_blocks = max_blocks
+        self.jpeg_interval = jpeg_interval
+        self.tmpdir = os.path.join(os.path.expanduser("~"), ".shikatmp")
+        self.blocks = collections.OrderedDict() # {(wdir, prefix, block): dict}
+    # __init__()
+
+    def spill_file(self, key):
+        wdir, prefix, block = key
+        return os.path.join(self.tmpdir, "%s_%s_%.3d.npz" % (hashlib.sha256(wdir).hexdigest(), prefix, block))
+    # spill_file()
+
+    def get_block(self, key, thumbw, n_tiles):
+        if key in self.blocks:
+            b = self.blocks.pop(key)
+            self.blocks[key] = b # most recently used
+            return b
+
+        b = dict(canvas=None, filled=None, n_tiles=n_tiles, dirty=False, jpeg_time=0.)
+        spill = self.spill_file(key)
+        if os.path.isfile(spill):
+            shikalog.debug("loading thumbnail data from %s" % spill)
+            try:
+                tmp = numpy.load(spill)
+                b["canvas"], b["filled"] = tmp["canvas"], tmp["filled"]
+            except:
+                shikalog.error("Error in loading %s\n%s" % (spill, traceback.format_exc()))
+            os.remove(spill)
+
+        if b["canvas"] is None or b["canvas"].shape != (thumbw*10, thumbw*10, 3):
+            b["canvas"] = numpy.zeros((thumbw*10, thumbw*10, 3), dtype=numpy.uint8)
+            b["filled"] = numpy.zeros(100, dtype=numpy.bool_)
+
+        self.blocks[key] = b
+        while len(self.blocks) > self.max_blocks:
+            self.evict(self.blocks.keys()[0])
+        return b
+    # get_block()
+
+    def add(self, wdir, prefix, idx, thumbdata, n_max):
+        """
+        idx: frame number starting from 1. n_max: number of frames in the scan.
+        """
+        thumbw = int(numpy.sqrt(len(thumbdata)/3))
+        assert len(thumbdata) == 3*thumbw*thumbw
+        block, i = (idx-1)//100, (idx-1)%100
+        n_tiles = min(100, n_max - block*100)
+        b = self.get_block((wdir, prefix, block), thumbw, n_tiles)
+        x, y = i%10, i//10
+        b["canvas"][y*thumbw:(y+1)*thumbw, x*thumbw:(x+1)*thumbw] = numpy.frombuffer(thumbdata, dtype=numpy.uint8).reshape(thumbw, thumbw, 3)
+        b["filled"][i] = True
+        b["dirty"] = True
+    # add()
+
+    def is_complete(self, b): return b["filled"].sum() >= b["n_tiles"]
+
+    def write_jpeg(self, key, b):
+        wdir, prefix, block = key
+        jpgdir = os.path.join(wdir, "thumb_%s" % prefix)
+        if not os.path.exists(jpgdir): os.mkdir(jpgdir)
+        jpgout = os.path.join(jpgdir, "%s_%.6d-%.6d.jpg" % (prefix, block*100+1, (block+1)*100))
+        jpgtmp = os.path.join(jpgdir, ".tmp-%s_%.6d-%.6d.jpg" % (prefix, block*100+1, (block+1)*100))
+
+        shikalog.info("saving thumbnail jpeg as %s" % jpgout)
+        Image.fromarray(b["canvas"]).save(jpgtmp, "JPEG", quality=50, optimize=True)
+        os.rename(jpgtmp, jpgout) # as it may take time
+        b["dirty"], b["jpeg_time"] = False, time.time()
+    # write_jpeg()
+
+    def try_write_jpeg(self, key, b):
+        """
+        write_jpeg() but errors are only logged. The block is marked as clean anyway,
+        so that it is written again only after it is updated.
+        """
+        try:
+            self.write_jpeg(key, b)
+        except:
+            shikalog.error("Error in writing thumbnail jpeg for %s\n%s" % (key, traceback.format_exc()))
+            b["dirty"], b["jpeg_time"] = False, time.time()
+    # try_write_jpeg()
+
+    def evict(self, key):
+        b = self.blocks.pop(key)
+        if b["dirty"]: self.try_write_jpeg(key, b)
+        if not self.is_complete(b):
+            spill = self.spill_file(key)
+            shikalog.info("saving thumbnail data to %s" % spill)
+            try:
+                if not os.path.exists(self.tmpdir): os.mkdir(self.tmpdir)
+                numpy.savez(spill, canvas=b["canvas"], filled=b["filled"])
+            except:
+                shikalog.error("Error in saving %s\n%s" % (spill, traceback.format_exc()))
+    # evict()
+
+    def flush(self):
+        """
+        Write JPEGs of updated montages if completed or not written recently. Completed ones are released.
+        """
+        now = time.time()
+        for key in self.blocks.keys():
+            b = self.blocks[key]
+            complete = self.is_complete(b)
+            if b["dirty"] and (complete or now - b["jpeg_time"] >= self.jpeg_interval):
+                self.try_write_jpeg(key, b)
+            if complete and not b["dirty"]:
+                del self.blocks[key]
+    # flush()
+
+    def close(self):
+        for key in self.blocks.keys(): self.evict(key)
+    # close()
+
+# class ThumbnailMontages
+
 class ResultsManager:
-    def __init__(self, rqueue, dbdir):
+    def __init__(self, rqueue, dbdir, journal_mode="delete"):
         self.thread = threading.Thread(None, self.run)
         self.thread.daemon = True
         self.interval = 3
 
         self.dbdir = dbdir
         self.rqueue = rqueue
+        self.journal_mode = journal_mode
         self._diffscan_params = {}
+        self._prepared_dbs = set() # (dbfile, inode) of which tables were prepared
+        self.max_write_trials = 10
+        self._write_log = collections.deque() # (time, number of results, seconds taken for writing)
+        self.montages = ThumbnailMontages()
     # __init__()
 
+    def stop(self):
+        if self.is_running():
+            self.keep_going = False
+            self.thread.join()
+    # stop()
+
+    def add_write_log(self, nres, sec, keep_sec=60):
+        t = time.time()
+        self._write_log.append((t, nres, sec))
+        while self._write_log and t - self._write_log[0][0] > keep_sec: self._write_log.popleft()
+    # add_write_log()
+
+    def get_write_rate(self):
+        """
+        Returns (results written per second, results per second of writing) in the last minute.
+        The latter is the rate the writer could sustain; it should exceed the detector frame rate.
+        """
+        if not self._write_log: return 0., 0.
+        nres = sum(map(lambda x: x[1], self._write_log))
+        sec = sum(map(lambda x: x[2], self._write_log))
+        span = max(time.time() - self._write_log[0][0], self.interval)
+        return nres / span, nres / sec if sec > 0 else float("inf")
+    # get_write_rate()
+
     def start(self):
         if not self.is_running():
             self.keep_going = True
@@ -756,7 +911,7 @@ class ResultsManager:
 
     def run(self):
         shikalog.info("ResultsManager loop STARTED")
-        dbfile, summarydat, con, cur = None, None, None, None
+        dbfile, dbino, summarydat, con, cur = None, None, None, None, None
 
         rcon = sqlite3.connect(os.path.join(self.dbdir, "%s.db"%getpass.getuser()), timeout=10)
         rcur = rcon.cursor()
@@ -784,8 +939,9 @@ class ResultsManager:
 
                 for wdir in messages:
                     tmp = os.path.join(wdir, "shika.db")
-                    if dbfile != tmp:
-                        dbfile = tmp
+                    if dbfile != tmp or not os.path.isfile(dbfile) or os.stat(dbfile).st_ino != dbino:
+                        # connect again also when shika.db was removed or recreated
+                        dbfile, dbino = tmp, None
                         con, cur = None, None
                         for _ in xrange(10):
                             try:
@@ -798,41 +954,31 @@ class ResultsManager:
                             shikalog.error("Could not connect to %s." % dbfile)
                         else:
                             cur = con.cursor()
+                            journal_mode = self.journal_mode
+                            if journal_mode == "wal" and not util.is_local_filesystem(dbfile):
+                                journal_mode = "delete" # wal locking does not work over network file systems
+                            try:
+                                retry_until_success(cur.execute, "pragma journal_mode=%s;" % journal_mode)
+                                dbino = os.stat(dbfile).st_ino if os.path.isfile(dbfile) else None
+                                if dbino is None or (dbfile, dbino) not in self._prepared_dbs:
+                                    retry_until_success(shikadb.prepare_tables, cur)
+                                    con.commit()
+                                    dbino = os.stat(dbfile).st_ino
+                                    self._prepared_dbs.add((dbfile, dbino))
+                            except (sqlite3.Error, OSError):
+                                shikalog.error("Could not prepare %s\n%s" % (dbfile, traceback.format_exc()))
+                                con, cur, dbfile = None, None, None
 
                         summarydat = os.path.join(wdir, "summary.dat")
                         if not os.path.isfile(summarydat) or not os.path.getsize(summarydat):
                             open(summarydat, "w").write("prefix x y kind data filename\n")
 
-                    canvas_data = {}
+                    db_rows, summary_lines = [], []
                             
                     for msg in messages[wdir]:
                         imgf = os.path.basename(str(msg["imgfile"]))
                         spots_is = map(lambda x: x[2], msg["spots"])
 
-                        if cur is not None:
-                            # 'status'
-                            c = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='status';")
-                            if c.fetchone() is None:
-                                cur.execute("""create table status (filename text primary key);""")
-    
-                            cur.execute("insert or replace into status values (?)", (imgf,)) # for backward 
-    
-                            # 'stats'
-                            c = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stats';")
-                            if c.fetchone() is None:
-                                cur.execute("""create table stats (imgf text primary key, nspot real, total real, mean real);""")
-    
-                            cur.execute("insert or replace into stats values (?, ?,?,?)", 
-                                        (imgf, len(msg["spots"]),
-                                         sum(spots_is),
-                                         sum(spots_is) / len(msg["spots"]) if len(msg["spots"])>0 else 0
-                                         ))
-    
-                            # 'spots'
-                            c = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='spots';")
-                            if c.fetchone() is None:
-                                cur.execute("create table spots (filename text primary key, spots blob);")
-
                         # save jpg
                         if "jpgdata" in msg and msg["jpgdata"]:
                             jpgdir = os.path.join(wdir, 
@@ -843,100 +989,78 @@ class ResultsManager:
                             open(jpgout, "wb").write(msg["jpgdata"])
                             del msg["jpgdata"]
                         elif "thumbdata" in msg and msg["thumbdata"]:
-                            #assert len(msg["thumbdata"])==600*600*3
-                            thumbw = int(numpy.sqrt(len(msg["thumbdata"])/3))
-                            assert len(msg["thumbdata"]) == 3*thumbw*thumbw
-                            prefix = str(msg["file_prefix"])
-                            idx = (msg["idx"]-1)//100
-                            tmpdir = os.path.join(os.path.expanduser("~"), ".shikatmp")
-                            if not os.path.exists(tmpdir): os.mkdir(tmpdir)
-                            tmpfile = os.path.join(tmpdir, "%s_%s_%.3d.pkl" % (hashlib.sha256(wdir).hexdigest(), prefix, idx))
-
-                            if (prefix, idx) in canvas_data: 
-                                canvas, ninc, _ = canvas_data[(prefix, idx)]
-                            elif os.path.isfile(tmpfile):
-                                shikalog.debug("loading thumbnail data from %s" % tmpfile)
-                                canvas, ninc, _ = pickle.load(open(tmpfile))
-                            else:
-                                canvas, ninc = Image.new("RGB", (thumbw*10, thumbw*10), (0, 0, 0)), 0
-                                
-                            thumbimg = Image.frombytes("RGB", (thumbw, thumbw), msg["thumbdata"])
-                            idx2 = (msg["idx"]-1)%100
-                            x, y = idx2%10, idx2//10
-                            canvas.paste(thumbimg, (x*thumbw, y*thumbw))
-                            ninc += 1
-                            #canvas.save(jpgout, "JPEG", quality=90, optimize=True) # IT MAY COST TOO MUCH TIME (SHOULD RUN THIS JUST ONCE?)
-
                             # calc max frame number
                             hpoint = int(msg["header"].get("raster_horizotal_number", msg["header"].get("raster_horizontal_number"))) # raster_horizontal_number was raster_horizotal_number until bss_jul04_2017
                             vpoint = int(msg["header"]["raster_vertical_number"])
-                            n_max = hpoint * vpoint
-                            idx_max = (n_max-1)//100
-                            n_in_last = n_max - idx_max*100
-                            
-                            canvas_data[(prefix, idx)] = (canvas, ninc,
-                                                          ninc == 100 or (idx_max==idx and ninc == n_in_last) # jpeg-completed flag
-                                                          )
-                            
+                            self.montages.add(wdir, str(msg["file_prefix"]), msg["idx"], msg["thumbdata"], hpoint * vpoint)
                             del msg["thumbdata"]
                             
 
-                        if cur is not None:
-                            cur.execute("insert or replace into spots values (?, ?)",
-                                        (imgf, sqlite3.Binary(pickle.dumps(msg, -1))))
+                        try:
+                            gcxy = self.get_raster_grid_coordinate(msg)
+                        except:
+                            shikalog.error("Error in getting grid coordinate at %s\n%s" % (wdir, traceback.format_exc()))
+                            gcxy = None
+
+                        db_rows.append((imgf, msg, gcxy))
 
                         # summary.dat
                         try:
-                            #tmptmp = time.time()
-                            gcxy = self.get_raster_grid_coordinate(msg)
+                            if gcxy is None: gcxy = [float("nan")]*2
 
-                            with open(summarydat, "a") as ofs:
-                                kinds = ("n_spots", "total_integrated_signal","median_integrated_signal")
-                                data = (len(msg["spots"]), sum(spots_is), numpy.median(spots_is))
-                                for k, d in zip(kinds, data):
-                                    ofs.write("%s_ % .4f % .4f %s %s %s\n" % (str(msg["file_prefix"]),
-                                                                              gcxy[0], gcxy[1], k, d, imgf))
-                            #shikalog.info("##DEBUG time: %f" %( time.time()-tmptmp))
+                            kinds = ("n_spots", "total_integrated_signal","median_integrated_signal")
+                            data = (len(msg["spots"]), sum(spots_is), numpy.median(spots_is))
+                            for k, d in zip(kinds, data):
+                                summary_lines.append("%s_ % .4f % .4f %s %s %s\n" % (str(msg["file_prefix"]),
+                                                                                     gcxy[0], gcxy[1], k, d, imgf))
                         except:
                             shikalog.error("Error in summary.dat generation at %s\n%s" % (wdir, traceback.format_exc()))
 
                             
-                    for prefix, idx in canvas_data:
-                        tmpdir = os.path.join(os.path.expanduser("~"), ".shikatmp")
-                        jpgdir = os.path.join(wdir, "thumb_%s" % prefix)
-                        if not os.path.exists(tmpdir): os.mkdir(tmpdir)
-                        if not os.path.exists(jpgdir): os.mkdir(jpgdir)
-                        tmpfile = os.path.join(tmpdir, "%s_%s_%.3d.pkl" % (hashlib.sha256(wdir).hexdigest(), prefix, idx))                        
-                        jpgout = os.path.join(jpgdir, "%s_%.6d-%.6d.jpg" % (prefix, idx*100+1, (idx+1)*100))
-                        jpgtmp = os.path.join(jpgdir, ".tmp-%s_%.6d-%.6d.jpg" % (prefix, idx*100+1, (idx+1)*100))
-                        
-                        shikalog.info("saving thumbnail jpeg as %s" % jpgout)
-                        
-                        canvas_data[(prefix, idx)][0].save(jpgtmp, "JPEG", quality=50, optimize=True)
-                        os.rename(jpgtmp, jpgout) # as it may take time
-                        
-                        if canvas_data[(prefix, idx)][2]:
-                            if os.path.isfile(tmpfile): os.remove(tmpfile)
+                    startt = time.time()
+                    if cur is None:
+                        shikalog.error("Not connected. %d results not written to %s" % (len(db_rows), os.path.join(wdir, "shika.db")))
+                    else:
+                        for i in xrange(self.max_write_trials):
+                            try:
+                                shikadb.put_results(cur, db_rows)
+                                con.commit()
+                                break
+                            except sqlite3.OperationalError, e:
+                                shikalog.warning("sqlite3.OperationalError (%s). Retrying (%d)." % (e, i+1))
+                                con.rollback()
+                                if "no such table" in str(e):
+                                    try:
+                                        shikadb.prepare_tables(cur)
+                                        con.commit()
+                                    except sqlite3.Error:
+                                        con.rollback()
+                                time.sleep(1)
                         else:
-                            shikalog.info("saving thumbnail data to %s" % tmpfile)
-                            pickle.dump(canvas_data[(prefix, idx)], open(tmpfile, "w"), -1)
-                            
-                    while True:
-                        try: con.commit()
-                        except sqlite3.OperationalError:
-                            shikalog.warning("sqlite3.OperationalError. Retrying.")
-                            time.sleep(1)
-                            continue
-                        break
+                            shikalog.error("Gave up writing %d results to %s" % (len(db_rows), os.path.join(wdir, "shika.db")))
+                            self._prepared_dbs.discard((dbfile, dbino))
+                            con, cur, dbfile = None, None, None # connect again next time
+
+                    try:
+                        with open(summarydat, "a") as ofs: ofs.write("".join(summary_lines))
+                    except:
+                        shikalog.error("Error in writing summary.dat at %s\n%s" % (wdir, traceback.format_exc()))
+
+                    self.add_write_log(len(db_rows), time.time()-startt)
 
                     rcur.execute("insert or replace into updates values (?,?)", (wdir, time.time()))
                     rcon.commit()
-                    shikalog.info("%4d results updated in %s" % (len(messages[wdir]), wdir))
+                    shikalog.info("%4d results updated in %s (write rate: %.1f Hz, capacity: %.1f Hz)" % ((len(messages[wdir]),wdir)+self.get_write_rate()))
+
+                self.montages.flush()
             except:
                 shikalog.error("Exception: %s" % traceback.format_exc())
             
             time.sleep(self.interval)
 
+        try: self.montages.close()
+        except: shikalog.error("Exception: %s" % traceback.format_exc())
+
         self.running = False
         shikalog.info("ResultsManager loop FINISHED")
     # run()
@@ -996,6 +1120,8 @@ def worker(wrk_num, params):
         working_params = master_params.fetch(sources=[libtbx.phil.parse(params_str)])
         params_dict[key] = working_params.extract()
 
+    stream_decoder = eiger.StreamDecoder()
+
     shikalog.info("worker %d ready" % wrk_num)
 
     # Loop and accept messages from both channels, acting accordingly
@@ -1032,7 +1158,12 @@ def worker(wrk_num, params):
         if socks.get(eiger_receiver) == zmq.POLLIN:
             frames = eiger_receiver.recv_multipart(copy = False)
 
-            header, data = eiger.read_stream_data(frames)
+            try:
+                header, data = eiger.read_stream_data(frames, decoder=stream_decoder)
+            except:
+                shikalog.error("worker %d: failed to decode frame: %s" % (wrk_num, traceback.format_exc()))
+                continue
+
             if util.None_in(header, data): continue
 
             #params_str = config_manager.sp_params_strs[("BL32XU", "EIGER9M", None, None)] + config_manager.get_common_params_str()
@@ -1128,7 +1259,7 @@ def run_from_args(argv):
         #pp.append(p)
 
     rqueue = Queue.Queue()
-    results_manager = ResultsManager(rqueue=rqueue, dbdir=params.dbdir)
+    results_manager = ResultsManager(rqueue=rqueue, dbdir=params.dbdir, journal_mode=params.db_journal_mode)
 
     if params.mode == "watch_ramdisk":
         ramdisk_watcher = WatchRamdiskThread(pushport=params.ports[0],
@@ -1144,7 +1275,10 @@ def run_from_args(argv):
 
     results_manager.start() # this blocks!??!
 
-    results_receiver(rqueue=rqueue, pullport=params.ports[1], results_manager=results_manager)
+    try:
+        results_receiver(rqueue=rqueue, pullport=params.ports[1], results_manager=results_manager)
+    finally:
+        results_manager.stop() # to save thumbnails
 
     #for p in pp: p.wait()
 
@@ -47,6 +47,7 @@ from yamtbx.util import get_number_of_processors, rotate_file
 from yamtbx.dataproc.XIO import XIO
 from yamtbx.dataproc.myspotfinder import shikalog
 from yamtbx.dataproc.myspotfinder import config_manager
+from yamtbx.dataproc.myspotfinder import shikadb
 from yamtbx.dataproc.XIO.plugins import eiger_hdf5_interpreter
 
 EventResultsUpdated, EVT_RESULTS_UPDATED = wx.lib.newevent.NewEvent()
@@ -416,8 +417,7 @@ class ReportHTMLMakerThread:
         con = sqlite3.connect(dbfile, timeout=10, isolation_level=None)
         con.execute('pragma query_only = ON;')
         print "Reading data from DB for making report html."
-        c = con.execute("select filename,spots from spots")
-        dbspots = dict(map(lambda x: (str(x[0]), pickle.loads(str(x[1]))), c.fetchall()))
+        dbspots = shikadb.fetch_results(con)[0]
         spot_data = "var spot_data = {"
         for i, (f, stat) in enumerate(result):
             if stat is None: continue
@@ -1158,7 +1158,7 @@ class ControlPanel(wx.Panel):
             wx.PostEvent(self, EventTargetDirChanged(target=updates[-1][0],fpref=None))
 
         if os.path.normpath(updates[-1][0]) == os.path.normpath(self.current_target_dir):
-            self.mainFrame.load_results()
+            self.mainFrame.load_results(incremental=True)
     # on_result_update_timer()
 
     def get_spot_draw_mode(self):
@@ -1231,7 +1231,7 @@ class ControlPanel(wx.Panel):
         dbfile = os.path.join(os.path.dirname(self.mainFrame.data.keys()[0]), "_spotfinder", "shika.db")
         if os.path.isfile(dbfile):
             con = sqlite3.connect(dbfile, timeout=10)
-            con.execute("delete from spots")
+            shikadb.clear_results(con.cursor())
             con.execute("delete from stats")
             con.execute("delete from status")
             con.commit()
@@ -2732,6 +2732,8 @@ class MainFrame(wx.Frame):
         self.topdir = topdir
 
         self.data = collections.OrderedDict() # Data shown in grid
+        self.loaded_seq = (None, None) # (dbfile, last seq of spots) of results in current_stats
+        self.unmatched_results = {} # results loaded but not yet found in diffscan.log
 
         self.plotFrame = PlotFrame(self)
 
@@ -3015,14 +3017,22 @@ Try restarting KUMA and SHIKA!
                 self.html_maker_thread.start()
     # update_result()
 
-    def load_results(self):
-        current_stats.clear()
-        
-
+    def load_results(self, incremental=False):
+        """
+        If incremental, only results written after the last load of the same db are read
+        and merged into current_stats. Otherwise current_stats is rebuilt.
+        """
         if self.ctrlFrame.current_target_dir is None:
+            current_stats.clear()
             return
 
         dbfile = os.path.join(self.ctrlFrame.current_target_dir, "_spotfinder", "shika.db")
+        last_seq = self.loaded_seq[1] if incremental and self.loaded_seq[0] == dbfile else None
+        if last_seq is None:
+            current_stats.clear()
+            self.loaded_seq = (None, None)
+            self.unmatched_results = {}
+
         if not os.path.isfile(dbfile): return
 
         scanlog = os.path.join(self.ctrlFrame.current_target_dir, "diffscan.log")
@@ -3033,13 +3043,15 @@ Try restarting KUMA and SHIKA!
         slog = bl_logfiles.BssDiffscanLog(scanlog)
         slog.remove_overwritten_scans()
         
-        d = wx.lib.agw.pybusyinfo.PyBusyInfo("Loading saved results..", title="Busy SHIKA")
+        d = None
+        if last_seq is None:
+            d = wx.lib.agw.pybusyinfo.PyBusyInfo("Loading saved results..", title="Busy SHIKA")
 
-        try: wx.SafeYield()
-        except: pass
+            try: wx.SafeYield()
+            except: pass
 
         try:
-            shikalog.info("Loading data: %s" % dbfile)
+            shikalog.info("Loading data: %s (after seq= %s)" % (dbfile, last_seq))
             startt = time.time()
             result = []
             con = sqlite3.connect(dbfile, timeout=10, isolation_level=None)
@@ -3061,14 +3073,23 @@ Try restarting KUMA and SHIKA!
 
             for itrial in xrange(60):
                 try:
-                    c = con.execute("select filename,spots from spots")
-                    results = dict(map(lambda x: (str(x[0]), pickle.loads(str(x[1]))), c.fetchall()))
+                    results, new_seq, is_incr = shikadb.fetch_results(con, last_seq)
                     break
                 except sqlite3.DatabaseError:
                     shikalog.warning("DB failed. retrying (%d)" % itrial)
                     time.sleep(1)
                     continue
 
+            if last_seq is not None and not is_incr:
+                shikalog.info("Results in %s were reset. Reloading all." % dbfile)
+                current_stats.clear()
+            elif is_incr:
+                for f in self.unmatched_results: results.setdefault(f, self.unmatched_results[f])
+
+            self.loaded_seq = (dbfile, new_seq)
+            self.unmatched_results = {}
+            if not results: return
+
             exranges = self.ctrlFrame.get_exclude_resolution_ranges()
             if exranges:
                 shikalog.info("Applying resolution-range exclusion: %s" % exranges)
@@ -3080,6 +3101,7 @@ Try restarting KUMA and SHIKA!
                     for i in reversed(numpy.where(test)[0]): del r["spots"][i]
 
             print "DEBUG:: scans=", slog.scans 
+            matched = set()
             for scan in slog.scans:
                 for imgf, (gonio, gc) in scan.filename_coords:
                     #print imgf, (gonio, gc) 
@@ -3091,6 +3113,7 @@ Try restarting KUMA and SHIKA!
                     imgfs_found = filter(lambda x: x in results, possible_imgfs)
                     if not imgfs_found: continue
                     imgf = imgfs_found[0]
+                    matched.add(imgf)
                     snrlist = map(lambda x: x[2], results[imgf]["spots"])
                     stat.stats = (len(snrlist), sum(snrlist), numpy.median(snrlist) if snrlist else 0)
                     stat.spots = results[imgf]["spots"]
@@ -3102,6 +3125,8 @@ Try restarting KUMA and SHIKA!
                     stat.img_file = os.path.join(self.ctrlFrame.current_target_dir, imgf)
                     result.append((stat.img_file, stat))
 
+            self.unmatched_results = dict(filter(lambda x: x[0] not in matched, results.items()))
+
             delt = time.time() - startt
             shikalog.info("Data loaded: %s (took %f sec)" % (dbfile, delt))
 
@@ -0,0 +1,30 @@
+"""
+Convert shika.db files written by older SHIKA (whole pickled results in table spots)
+to the current schema. Files already converted are left as they are.
+
+Usage: yamtbx.python upgrade_shikadb.py */_spotfinder/shika.db
+"""
+
+import os
+import pysqlite2.dbapi2 as sqlite3
+from yamtbx.dataproc.myspotfinder import shikadb
+
+def run(dbfile):
+    size_org = os.path.getsize(dbfile)
+    con = sqlite3.connect(dbfile, timeout=30)
+    cur = con.cursor()
+    if not shikadb.migrate(cur):
+        print "%s: already version %d" % (dbfile, cur.execute("pragma user_version").fetchone()[0])
+        return
+
+    con.commit()
+    con.close()
+    print "%s: converted. %.1f MB -> %.1f MB" % (dbfile, size_org/1.e6, os.path.getsize(dbfile)/1.e6)
+# run()
+
+def run_from_args(argv):
+    for f in argv: run(f)
+
+if __name__ == "__main__":
+    import sys
+    run_from_args(sys.argv[1:])
@@ -0,0 +1,213 @@
+"""
+Access to spot-finding results in shika.db.
+
+Schema version 2 (pragma user_version=2) keeps one row per image in table results:
+  filename, seq, n_spots, total, median, gx, gy, params_id, spots, extra
+where spots is a packed float32 array of (n_spots, 4) in the order of spot tuples (y, x, snr, d),
+params_id refers to table params which keeps each distinct parameter object only once,
+and extra is a pickle of the remaining (small) items of the result message.
+seq increases every time a row is inserted or replaced, so that readers can fetch only
+rows written after their last load.
+
+Tables status (filename) and stats (imgf, nspot, total, mean) are also kept as before,
+for programs that only need the list of processed files or spot counts.
+
+Version 1 databases kept the whole pickled message in table spots (filename, spots[, seq]);
+they are converted by migrate() (see upgrade_shikadb.py), which may take long for large files.
+Writers only create the new tables (prepare_tables()), so a database may have both tables;
+readers then take rows of spots that are not in results.
+"""
+
+import cPickle as pickle
+import hashlib
+import numpy
+
+schema_version = 2
+spot_dtype = numpy.float32
+spot_columns = ("y", "x", "snr", "d")
+
+# items of result message that are stored in own columns or not stored at all
+_not_in_extra = ("spots", "params", "jpgdata", "thumbdata")
+
+def has_table(cur, name):
+    c = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (name,))
+    return c.fetchone() is not None
+# has_table()
+
+def has_column(cur, table, column):
+    return column in map(lambda x: x[1], cur.execute("pragma table_info(%s)" % table).fetchall())
+# has_column()
+
+def pack_spots(spots):
+    return buffer(numpy.array(spots, dtype=spot_dtype).reshape(-1, len(spot_columns)).tostring())
+# pack_spots()
+
+def unpack_spots(blob):
+    """
+    Returns list of spot tuples (as lists), as the result message had.
+    """
+    return numpy.frombuffer(str(blob), dtype=spot_dtype).reshape(-1, len(spot_columns)).tolist()
+# unpack_spots()
+
+def spot_stats(spots):
+    """
+    (n_spots, total, median) of snr
+    """
+    snr = numpy.array(map(lambda x: x[2], spots), dtype=numpy.float64)
+    return len(snr), float(snr.sum()), float(numpy.median(snr)) if len(snr) > 0 else 0.
+# spot_stats()
+
+_insert_result = """insert or replace into results values (?, (select coalesce(max(seq),0)+1 from results),
+                                                         ?,?,?,?,?,?,?,?)"""
+
+def prepare_tables(cur):
+    """
+    Create tables if not exist. Version 1 data (table spots) are left as they are.
+    Writers need to call this only once for each database.
+    """
+    cur.execute("create table if not exists status (filename text primary key);")
+    cur.execute("create table if not exists stats (imgf text primary key, nspot real, total real, mean real);")
+    cur.execute("""create table if not exists results (filename text primary key, seq integer,
+                   n_spots integer, total real, median real, gx real, gy real,
+                   params_id integer, spots blob, extra blob);""")
+    cur.execute("create index if not exists results_seq on results (seq);")
+    cur.execute("create table if not exists params (id integer primary key, digest text unique, params blob);")
+    cur.execute("pragma user_version = %d;" % schema_version)
+# prepare_tables()
+
+def migrate(cur):
+    """
+    Convert version 1 data (table spots) into results table. Returns False if nothing to convert.
+    Results already written in results table are kept. Commit before calling this, as it ends with vacuum.
+    """
+    if not has_table(cur, "spots"): return False
+    prepare_tables(cur)
+    order = "seq" if has_column(cur, "spots", "seq") else "rowid"
+    c = cur.execute("select filename,spots from spots where filename not in (select filename from results) order by %s" % order)
+    rows = map(lambda x: (str(x[0]), pickle.loads(str(x[1])), None), c.fetchall())
+    cur.executemany(_insert_result, result_rows(cur, rows))
+    cur.execute("drop table spots;")
+    cur.connection.commit()
+    cur.execute("vacuum;")
+    return True
+# migrate()
+
+def fetch_v1_results(cur):
+    """
+    Result messages in version 1 table spots, as returned by fetch_results()
+    """
+    ret = {}
+    for f, blob in cur.execute("select filename,spots from spots").fetchall():
+        msg = pickle.loads(str(blob))
+        msg["n_spots"], msg["total"], msg["median"] = spot_stats(msg["spots"])
+        msg["grid_coord"] = None
+        ret[str(f)] = msg
+    return ret
+# fetch_v1_results()
+
+def put_params(cur, params, cache=None):
+    """
+    Returns id of params in params table, adding it if new.
+    cache: dict of digest: id, to avoid queries for params seen before
+    """
+    if params is None: return None
+    blob = pickle.dumps(params, -1)
+    digest = hashlib.sha1(blob).hexdigest()
+    if cache is not None and digest in cache: return cache[digest]
+    cur.execute("insert or ignore into params (digest, params) values (?, ?)", (digest, buffer(blob)))
+    ret = cur.execute("select id from params where digest=?", (digest,)).fetchone()[0]
+    if cache is not None: cache[digest] = ret
+    return ret
+# put_params()
+
+def result_rows(cur, rows):
+    """
+    Rows of results table (without seq) for rows of (imgf, msg, gcxy).
+    gcxy: grid coordinate of the image (or None if unknown)
+    Parameters are added to params table if new.
+    """
+    ret, cache = [], {}
+    for imgf, msg, gcxy in rows:
+        if gcxy is None: gcxy = [float("nan")]*2
+        n_spots, total, median = spot_stats(msg["spots"])
+        extra = dict(filter(lambda x: x[0] not in _not_in_extra, msg.items()))
+        ret.append((imgf, n_spots, total, median, gcxy[0], gcxy[1], put_params(cur, msg.get("params"), cache),
+                    pack_spots(msg["spots"]), buffer(pickle.dumps(extra, -1))))
+    return ret
+# result_rows()
+
+def put_results(cur, rows):
+    """
+    Write results, stats and status of rows of (imgf, msg, gcxy) with one statement for each table.
+    The caller should commit, so that a batch of results is written in one transaction.
+    The seq subquery is evaluated before a replaced row is deleted, so seq never goes back.
+    """
+    data = result_rows(cur, rows)
+    cur.executemany("insert or replace into status values (?)", map(lambda x: (x[0],), data))
+    cur.executemany("insert or replace into stats values (?,?,?,?)",
+                    map(lambda x: (x[0], x[1], x[2], x[2]/x[1] if x[1] > 0 else 0), data))
+    cur.executemany(_insert_result, data)
+# put_results()
+
+def fetch_results(con, last_seq=None):
+    """
+    Returns (dict of filename: result message, last_seq, incremental).
+    Result messages are as they were given to put_results() (except jpgdata and thumbdata),
+    with n_spots, total, median and grid_coord added.
+    If last_seq is given, only rows written after it are returned and incremental is True.
+    Everything is returned (incremental=False) when last_seq is None, when the db is version 1
+    (then returned last_seq is None), or when rows were removed after last_seq was taken
+    (e.g. the table was cleared); the caller should then discard what was loaded before.
+    Version 1 rows not yet converted are included in full loads only, as they are never updated.
+    """
+    cur = con.cursor()
+    if not has_table(cur, "results"):
+        return fetch_v1_results(cur), None, False
+
+    max_seq = cur.execute("select max(seq) from results").fetchone()[0] or 0
+    if last_seq is not None and max_seq < last_seq: last_seq = None
+
+    ret, params = {}, {}
+    if last_seq is None and has_table(cur, "spots"): ret = fetch_v1_results(cur) # overwritten by results
+
+    query = "select filename,seq,n_spots,total,median,gx,gy,params_id,spots,extra from results"
+    if last_seq is None:
+        c = cur.execute(query)
+    else:
+        c = cur.execute(query + " where seq > ?", (last_seq,))
+
+    for f, seq, n_spots, total, median, gx, gy, params_id, spots, extra in c.fetchall():
+        if params_id is not None and params_id not in params:
+            blob = cur.execute("select params from params where id=?", (params_id,)).fetchone()[0]
+            params[params_id] = pickle.loads(str(blob))
+
+        msg = pickle.loads(str(extra))
+        msg.update(spots=unpack_spots(spots), params=params.get(params_id),
+                   n_spots=n_spots, total=total, median=median, grid_coord=(gx, gy))
+        ret[str(f)] = msg
+        max_seq = max(max_seq, seq)
+
+    return ret, max_seq, last_seq is not None
+# fetch_results()
+
+def fetch_stats(con):
+    """
+    Returns list of (filename, n_spots, total, median) without reading spots.
+    """
+    cur = con.cursor()
+    ret = []
+    if has_table(cur, "spots"):
+        query = "select filename,spots from spots"
+        if has_table(cur, "results"): query += " where filename not in (select filename from results)"
+        for f, blob in cur.execute(query).fetchall():
+            ret.append((f,) + spot_stats(pickle.loads(str(blob))["spots"]))
+
+    if has_table(cur, "results"):
+        ret.extend(cur.execute("select filename,n_spots,total,median from results").fetchall())
+    return ret
+# fetch_stats()
+
+def clear_results(cur):
+    for t in ("results", "spots"):
+        if has_table(cur, t): cur.execute("delete from %s" % t)
+# clear_results()
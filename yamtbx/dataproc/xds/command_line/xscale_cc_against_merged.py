@@ -6,9 +6,11 @@ This software is released under the new BSD License; see LICENSE.
 """
 import os
 import collections
-import copy
+import numpy
 from yamtbx.dataproc.xds import get_xdsinp_keyword
 from yamtbx.dataproc.xds import xds_ascii
+from yamtbx.dataproc.auto.cc_matrix import miller_index_keys, cc_from_sums
+from yamtbx.util.shm import shared_copy, run_tasks
 from cctbx.array_family import flex
 from libtbx import easy_mp
 
@@ -45,52 +47,116 @@ def eval_cc_with_original_file(f, merged_iobs):
     return ret1, ret2
 # eval_cc_with_original_file()
 
-def eval_cc_internal(merged_iobs, merged, setno):
+def cc_by_groups(gidx, x, y):
     """
-    merged_iobs: i_obs array where all data in xscale hkl were merged
-    merged: xscale hkl object
-    setno: iset number in interest
+    CC between x and y within each group, and number of elements in each group.
+    gidx: group index (0, 1, ..) of each element, in non-decreasing order
     """
-    merged_sel = copy.copy(merged)
-    merged_sel.remove_selection(merged.iset != setno)
-    
-    iobs_set = merged_sel.i_obs(anomalous_flag=merged_iobs.anomalous_flag())
-    iobs_set_merged = iobs_set.merge_equivalents(use_internal_variance=False).array()
-
-    n_all = iobs_set_merged.size()
-
-    m, i = merged_iobs.common_sets(iobs_set_merged, assert_is_similar_symmetry=False)
-    n_common = m.size()
-
-    corr = flex.linear_correlation(m.data(), i.data())
-    cc = corr.coefficient() if corr.is_well_defined() else float("nan")
+    n = numpy.bincount(gidx).astype(numpy.float64)
+    sums = map(lambda w: numpy.bincount(gidx, weights=w), (x, y, x*x, y*y, x*y))
+    return cc_from_sums(n, *sums), n.astype(int)
+# cc_by_groups()
 
-    ret1 = (n_all, n_common, cc)
-    ret2 = []
-
-    for frame in xrange(min(merged_sel.iframe), max(merged_sel.iframe)+1):
-        iobs = iobs_set.select(merged_sel.iframe == frame)
-        iobs = iobs.merge_equivalents(use_internal_variance=False).array()
-        n_all = iobs.size()
+def group_starts(*cols):
+    """
+    Boolean array which is True where any of sorted columns changes its value
+    """
+    ret = numpy.zeros(len(cols[0]), dtype=bool)
+    ret[:1] = True
+    for c in cols: ret[1:] |= c[1:] != c[:-1]
+    return ret
+# group_starts()
 
-        m, i = merged_iobs.common_sets(iobs, assert_is_similar_symmetry=False)
-        n_common = m.size()
+def eval_cc_sorted(iset, frame, u, w, wi, ref):
+    """
+    Per-dataset and per-frame CC against ref for observations sorted by (iset, frame, u).
+    Intensities are merged within each group with weights w, as merge_equivalents(use_internal_variance=False) does.
+    iset, frame, u: ISET, frame number and unique reflection index of each observation
+    w, wi: weight (1/sigma^2) and weighted intensity of each observation
+    ref: merged intensities of all data for each unique reflection
+    Returns dict of iset: (ret1, ret2) in the same format as eval_cc_with_original_file().
+    """
+    # merge within (iset, frame, hkl)
+    sel = group_starts(iset, frame, u)
+    gidx = numpy.cumsum(sel) - 1
+    g_w, g_wi = numpy.bincount(gidx, weights=w), numpy.bincount(gidx, weights=wi)
+    g_iset, g_frame, g_u = iset[sel], frame[sel], u[sel]
+
+    sel = group_starts(g_iset, g_frame)
+    f_cc, f_n = cc_by_groups(numpy.cumsum(sel) - 1, g_wi / g_w, ref[g_u])
+    f_iset, f_frame = g_iset[sel], g_frame[sel]
+
+    # merge within (iset, hkl)
+    perm = numpy.lexsort((g_u, g_iset))
+    g_iset, g_u, g_w, g_wi = g_iset[perm], g_u[perm], g_w[perm], g_wi[perm]
+    sel = group_starts(g_iset, g_u)
+    gidx = numpy.cumsum(sel) - 1
+    s_w, s_wi = numpy.bincount(gidx, weights=g_w), numpy.bincount(gidx, weights=g_wi)
+    s_iset, s_u = g_iset[sel], g_u[sel]
+    sel = group_starts(s_iset)
+    d_cc, d_n = cc_by_groups(numpy.cumsum(sel) - 1, s_wi / s_w, ref[s_u])
+    d_iset = s_iset[sel]
+
+    ret = {}
+    f_start = numpy.searchsorted(f_iset, d_iset, side="left")
+    f_end = numpy.searchsorted(f_iset, d_iset, side="right")
+    for i in xrange(len(d_iset)):
+        frames = dict(zip(f_frame[f_start[i]:f_end[i]].tolist(),
+                          zip(f_n[f_start[i]:f_end[i]].tolist(), f_cc[f_start[i]:f_end[i]].tolist())))
+        ret2 = []
+        for fr in xrange(min(frames), max(frames)+1):
+            n, cc = frames.get(fr, (0, float("nan")))
+            ret2.append([fr, n, n, cc]) # all reflections are common with ref
+        ret[int(d_iset[i])] = ((int(d_n[i]), int(d_n[i]), float(d_cc[i])), ret2)
 
-        corr = flex.linear_correlation(m.data(), i.data())
-        cc = corr.coefficient() if corr.is_well_defined() else float("nan")
+    return ret
+# eval_cc_sorted()
 
-        ret2.append([frame, n_all, n_common, cc])
-    return ret1, ret2
+def eval_cc_internal(merged, anomalous_flag=None, nproc=1):
+    """
+    CC of each dataset and each frame against all data merged, in one pass over xscale hkl object (merged).
+    Observations are sorted once by (iset, frame, hkl); rejected ones (sigma<=0) are not used.
+    When nproc>1, datasets are divided among processes.
+    Returns dict of iset: (ret1, ret2) in the same format as eval_cc_with_original_file().
+    """
+    sel = merged.sigma_iobs > 0
+    iobs = merged.i_obs(anomalous_flag).select(sel).map_to_asu()
+    keys, u = numpy.unique(miller_index_keys(iobs.indices()), return_inverse=True)
+    I = iobs.data().as_numpy_array()
+    if I.size > 1 and I.std() > 0: I = (I - I.mean()) / I.std() # does not change CC but avoids loss of precision
+    w = 1. / iobs.sigmas().as_numpy_array()**2
+    ref = numpy.bincount(u, weights=w*I) / numpy.bincount(u, weights=w)
+
+    iset = merged.iset.select(sel).as_numpy_array()
+    frame = merged.iframe.select(sel).as_numpy_array()
+    perm = numpy.lexsort((u, frame, iset))
+    cols = map(lambda x: x[perm], (iset, frame, u, w, w*I))
+    if nproc < 2: return eval_cc_sorted(*(cols + [ref]))
+
+    cols = map(shared_copy, cols)
+    ref = shared_copy(ref)
+    isets = numpy.unique(cols[0])
+    bounds = numpy.searchsorted(cols[0], isets[::max(1, len(isets)//(nproc*4))])
+    bounds = numpy.append(bounds, len(cols[0]))
+
+    def work(i):
+        s = slice(bounds[i], bounds[i+1])
+        return eval_cc_sorted(*(map(lambda x: x[s], cols) + [ref]))
+    # work()
+
+    ret = {}
+    for r in run_tasks(work, xrange(len(bounds)-1), nproc): ret.update(r)
+    return ret
 # eval_cc_internal()
 
-
-def run(hklin, output_dir=None, eval_internal=True):
+def run(hklin, output_dir=None, eval_internal=True, nproc=1):
     if output_dir is None: output_dir = os.getcwd()
 
     merged = xds_ascii.XDS_ASCII(hklin)
-    merged_iobs = merged.i_obs().merge_equivalents(use_internal_variance=False).array()
+    isets = sorted(merged.input_files)
+    input_files = map(lambda x: merged.input_files[x], isets)
 
-    fwidth = max(map(lambda x: len(x[0]), merged.input_files.values()))
+    fwidth = max(map(lambda x: len(x[0]), input_files))
     formatf = "%"+str(fwidth)+"s"
 
     out_files = open(os.path.join(output_dir, "cc_files.dat"), "w")
@@ -99,20 +165,22 @@ def run(hklin, output_dir=None, eval_internal=True):
     print >>out_files, "file name n.all n.common cc"
     print >>out_frames, "file name frame n.all n.common cc"
 
-    cutforname1 = len(os.path.commonprefix(map(lambda x: x[0], merged.input_files.values())))
-    cutforname2 = len(os.path.commonprefix(map(lambda x: x[0][::-1], merged.input_files.values())))
+    cutforname1 = len(os.path.commonprefix(map(lambda x: x[0], input_files)))
+    cutforname2 = len(os.path.commonprefix(map(lambda x: x[0][::-1], input_files)))
     formatn = "%"+str(fwidth-cutforname1-cutforname2)+"s"
 
     if eval_internal:
-        results = map(lambda x: eval_cc_internal(merged_iobs, merged, x), sorted(set(merged.iset)))
+        results = eval_cc_internal(merged, nproc=nproc)
+        results = map(lambda x: results.get(x, ((0, 0, float("nan")), [])), isets)
     else:
+        merged_iobs = merged.i_obs().merge_equivalents(use_internal_variance=False).array()
         results = map(lambda x: eval_cc_with_original_file(x, merged_iobs),
                       map(lambda x: x[0] if os.path.isabs(x[0]) else os.path.join(os.path.dirname(hklin), x[0]),
-                          merged.input_files.values()))
+                          input_files))
 
     ret = collections.OrderedDict()
 
-    for (f, wavelen, cell), (ret1, ret2) in zip(merged.input_files.values(), results):
+    for (f, wavelen, cell), (ret1, ret2) in zip(input_files, results):
         name = f[cutforname1+1:-cutforname2]
         n_all, n_common, cc = ret1
         print >>out_files, formatf%f, formatn%name, "%5d %5d %.4f" % (n_all, n_common, cc)
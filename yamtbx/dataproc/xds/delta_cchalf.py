@@ -0,0 +1,132 @@
+"""
+(c) RIKEN 2017. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+CC1/2 with each dataset (ISET) of XSCALE output removed, calculated in one pass.
+
+Observations are split randomly into two halves (with fixed seed), and for each unique reflection
+sums and counts of intensities of each half are kept for all data and for each ISET.
+CC1/2 without an ISET is obtained by subtracting its contribution from the affected reflections only.
+Unlike leave-one-out XSCALE runs, remaining datasets are not re-scaled.
+"""
+
+import numpy
+from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
+from yamtbx.dataproc.auto.cc_matrix import miller_index_keys, cc_from_sums
+
+def half_set_sums(S, N, shell, n_shells):
+    """
+    Sums for CC between half-set means (n, sx, sy, sxx, syy, sxy) and number of unique reflections,
+    as arrays of (n_shells+1); the last element is for all shells.
+    S, N: sums and counts of shape (n_refl, 2)
+    """
+    ok = (N[:,0] > 0) & (N[:,1] > 0)
+    x = S[ok,0] / N[ok,0]
+    y = S[ok,1] / N[ok,1]
+    sh = shell[ok]
+    ret = []
+    # shell index n_shells is for reflections outside the shells
+    for w in (None, x, y, x*x, y*y, x*y):
+        s = numpy.bincount(sh, weights=w, minlength=n_shells+1).astype(numpy.float64)
+        ret.append(numpy.append(s[:n_shells], s.sum()))
+
+    nuniq = numpy.bincount(shell[N.sum(axis=1) > 0], minlength=n_shells+1)
+    ret.append(numpy.append(nuniq[:n_shells], nuniq.sum()))
+    return numpy.array(ret, dtype=numpy.float64)
+# half_set_sums()
+
+class DeltaCCHalf:
+    """
+    xscale_hkl: unmerged output of XSCALE
+    d_limits: lower resolution limits of shells, as dmin column of statistics table in XSCALE.LP
+              (without total). Reflections outside the shells are only counted in total.
+    use_cache: passed to XDS_ASCII
+    """
+    def __init__(self, xscale_hkl, anomalous_flag=None, d_limits=None, seed=1234, use_cache=False):
+        xac = XDS_ASCII(xscale_hkl, use_cache=use_cache)
+        xac.remove_rejected()
+        iobs = xac.i_obs(anomalous_flag).map_to_asu()
+
+        keys, u = numpy.unique(miller_index_keys(iobs.indices()), return_inverse=True)
+        self.n_refl = len(keys)
+        I = iobs.data().as_numpy_array()
+        if I.size > 1 and I.std() > 0: I = (I - I.mean()) / I.std() # does not change CC but avoids loss of precision
+        half = numpy.random.RandomState(seed).randint(0, 2, I.size)
+
+        # resolution shell of each unique reflection
+        d = numpy.zeros(self.n_refl)
+        d[u] = iobs.d_spacings().data().as_numpy_array()
+        if d_limits:
+            self.n_shells = len(d_limits)
+            self.shell = numpy.searchsorted(-numpy.array(d_limits, dtype=float), -d)
+        else:
+            self.n_shells = 1
+            self.shell = numpy.zeros(self.n_refl, dtype=int)
+
+        # sums for all data
+        self.S = numpy.bincount(u*2+half, weights=I, minlength=self.n_refl*2).reshape(-1, 2)
+        self.N = numpy.bincount(u*2+half, minlength=self.n_refl*2).reshape(-1, 2).astype(numpy.float64)
+
+        # sums for each (ISET, reflection, half), sorted by ISET
+        iset = xac.iset.as_numpy_array().astype(numpy.int64)
+        gkeys, ginv = numpy.unique((iset * self.n_refl + u) * 2 + half, return_inverse=True)
+        self.g_s = numpy.bincount(ginv, weights=I)
+        self.g_n = numpy.bincount(ginv).astype(numpy.float64)
+        self.g_half = gkeys % 2
+        self.g_u = (gkeys // 2) % self.n_refl
+        g_iset = gkeys // 2 // self.n_refl
+        self.isets = numpy.unique(g_iset)
+        self.iset_ranges = dict(zip(self.isets, zip(numpy.searchsorted(g_iset, self.isets, side="left"),
+                                                    numpy.searchsorted(g_iset, self.isets, side="right"))))
+        self.removed = set()
+    # __init__()
+
+    def calc_cchalf(self):
+        """
+        Returns (cc, nuniq) of current data, as arrays of (n_shells+1); the last element is for total.
+        """
+        s = half_set_sums(self.S, self.N, self.shell, self.n_shells)
+        return cc_from_sums(*s[:6]), s[6]
+    # calc_cchalf()
+
+    def iset_contribution(self, iset):
+        """
+        Returns affected reflections, and their sums and counts of ISET (of shape (n, 2)).
+        """
+        start, end = self.iset_ranges[iset]
+        u, half = self.g_u[start:end], self.g_half[start:end]
+        aff = numpy.unique(u)
+        idx = numpy.searchsorted(aff, u)
+        dS, dN = numpy.zeros((len(aff), 2)), numpy.zeros((len(aff), 2))
+        dS[idx, half] = self.g_s[start:end]
+        dN[idx, half] = self.g_n[start:end]
+        return aff, dS, dN
+    # iset_contribution()
+
+    def calc_cchalf_by_removing(self):
+        """
+        Returns list of (iset, cc, nuniq) with each remaining ISET removed; cc and nuniq are arrays
+        of (n_shells+1) where the last element is for total.
+        """
+        all_sums = half_set_sums(self.S, self.N, self.shell, self.n_shells)
+        ret = []
+        for iset in self.isets:
+            if iset in self.removed: continue
+            aff, dS, dN = self.iset_contribution(iset)
+            S, N, shell = self.S[aff], self.N[aff], self.shell[aff]
+            s = all_sums - half_set_sums(S, N, shell, self.n_shells) + half_set_sums(S-dS, N-dN, shell, self.n_shells)
+            ret.append((iset, cc_from_sums(*s[:6]), s[6].astype(int)))
+        return ret
+    # calc_cchalf_by_removing()
+
+    def remove(self, iset):
+        aff, dS, dN = self.iset_contribution(iset)
+        self.S[aff] -= dS
+        self.N[aff] -= dN
+        self.removed.add(iset)
+    # remove()
+
+# class DeltaCCHalf
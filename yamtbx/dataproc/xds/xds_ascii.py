@@ -6,7 +6,9 @@ This software is released under the new BSD License; see LICENSE.
 """
 import re
 import os
+import stat
 import numpy
+import tempfile
 from cctbx import crystal
 from cctbx import miller
 from cctbx import uctbx
@@ -21,18 +23,126 @@ def is_xds_ascii(filein):
     return "FORMAT=XDS_ASCII" in line
 # is_xds_ascii()
 
+cache_version = 1
+
+def cache_file_name(filein):
+    """
+    Name of binary sidecar file for columnar data of XDS_ASCII file.
+    It is a hidden file in the same directory.
+    """
+    filein = os.path.abspath(filein)
+    return os.path.join(os.path.dirname(filein), ".%s.npz" % os.path.basename(filein))
+# cache_file_name()
+
+def _file_key(filein):
+    st = os.stat(filein)
+    return os.path.abspath(filein), st.st_size, st.st_mtime
+# _file_key()
+
+def load_data_cache(filein):
+    """
+    Returns dict of numpy arrays if valid cache exists. Otherwise None.
+    Cache is regarded as valid when path, size and mtime of the original file are unchanged.
+    """
+    cachein = cache_file_name(filein)
+    if not os.path.isfile(cachein): return None
+
+    try:
+        path, size, mtime = _file_key(filein)
+        npz = numpy.load(cachein)
+        try:
+            if int(npz["version"]) != cache_version: return None
+            if str(npz["path"]) != path or int(npz["size"]) != size or float(npz["mtime"]) != mtime: return None
+            return dict((k, npz[k]) for k in npz.files if k not in ("version", "path", "size", "mtime"))
+        finally:
+            npz.close()
+    except Exception:
+        return None
+# load_data_cache()
+
+def save_data_cache(filein, columns):
+    """
+    Write columns (dict of numpy arrays) as uncompressed npz.
+    Writes to a temporary file first so that other processes never see incomplete cache.
+    Silently gives up if the directory is not writable.
+    Permission is the same as the original file (without execute bits).
+    """
+    cacheout = cache_file_name(filein)
+    path, size, mtime = _file_key(filein)
+    tmp = None
+    try:
+        tmpfd, tmp = tempfile.mkstemp(prefix=os.path.basename(cacheout)+".", dir=os.path.dirname(cacheout))
+        with os.fdopen(tmpfd, "wb") as f:
+            numpy.savez(f, version=numpy.array(cache_version), path=numpy.array(path),
+                        size=numpy.array(size), mtime=numpy.array(mtime), **columns)
+        os.chmod(tmp, stat.S_IMODE(os.stat(filein).st_mode) & 0666)
+        os.rename(tmp, cacheout)
+        return True
+    except (IOError, OSError):
+        if tmp is not None and os.path.isfile(tmp): os.remove(tmp)
+        return False
+# save_data_cache()
+
+def count_data_lines(filein, data_offset):
+    """
+    Count reflection records from byte offset of data block (just after !END_OF_HEADER).
+    """
+    f = open(filein)
+    f.seek(data_offset)
+    count = 0
+    for line in f:
+        if line.startswith("!END_OF_DATA"): break
+        count += 1
+    return count
+# count_data_lines()
+
+def read_data_columns(filein, colindex, data_offset=None):
+    """
+    Parse reflection block in bulk and return dict of typed numpy arrays.
+    Returns None if the block is not a regular table (then parse line by line).
+    """
+    ncol = len(colindex)
+    f = open(filein)
+    if data_offset is not None:
+        f.seek(data_offset)
+    else:
+        while True:
+            line = f.readline()
+            if not line or line.startswith("!END_OF_HEADER"): break
+
+    body = f.read()
+    end = body.find("!END_OF_DATA")
+    if end >= 0: body = body[:end]
+    nlines = body.count("\n")
+
+    table = numpy.fromstring(body, dtype=numpy.float64, sep=" ")
+    del body
+    if table.size != nlines * ncol: return None
+    table = table.reshape(nlines, ncol)
+
+    ret = dict(indices=table[:, [colindex["H"], colindex["K"], colindex["L"]]].astype(numpy.int32))
+    for key, col in (("iobs", "IOBS"), ("sigma_iobs", "SIGMA(IOBS)"), ("xd", "XD"), ("yd", "YD"), ("zd", "ZD"),
+                     ("rlp", "RLP"), ("peak", "PEAK"), ("corr", "CORR")):
+        if col in colindex: ret[key] = numpy.ascontiguousarray(table[:, colindex[col]])
+    if "ISET" in colindex: ret["iset"] = table[:, colindex["ISET"]].astype(numpy.int32)
+
+    return ret
+# read_data_columns()
+
 class XDS_ASCII:
 
-    def __init__(self, filein, log_out=None, read_data=True, i_only=False):
+    def __init__(self, filein, log_out=None, read_data=True, i_only=False, use_cache=False):
         self._log = null_out() if log_out is None else log_out
         self._filein = filein
         self.indices = flex.miller_index()
         self.i_only = i_only
+        self.use_cache = use_cache
         self.iobs, self.sigma_iobs, self.xd, self.yd, self.zd, self.rlp, self.peak, self.corr = [flex.double() for i in xrange(8)]
         self.iframe = flex.int()
         self.iset = flex.int() # only for XSCALE
         self.input_files = {} # only for XSCALE [iset:(filename, wavelength), ...]
         self.by_dials = False
+        self._data_offset = None # byte offset where reflection data start
 
         self.read_header()
         if read_data:
@@ -43,21 +153,18 @@ class XDS_ASCII:
 
         colindex = {} # {"H":1, "K":2, "L":3, ...}
         nitemfound = 0
-        flag_data_start = False
-        num_hkl = 0
 
         headers = []
 
-        for line in open(self._filein):
-            if flag_data_start:
-                if line.startswith("!END_OF_DATA"):
-                    break
-                num_hkl += 1
-                continue
+        # Stop at the end of header. Reflection block is never read here.
+        ifs = open(self._filein)
+        while True:
+            line = ifs.readline()
+            if not line: break
 
             if line.startswith('!END_OF_HEADER'):
-                flag_data_start = True
-                continue
+                self._data_offset = ifs.tell()
+                break
 
             if line.startswith("!Generated by dials"):
                 self.by_dials = True
@@ -134,7 +241,7 @@ class XDS_ASCII:
         assert nitem == len(colindex)
 
         self._colindex = colindex
-        self._num_hkl = num_hkl
+        self._num_hkl = None # calculated when needed (get_num_hkl())
         self.symm = crystal.symmetry(unit_cell=(a, b, c, al, be, ga),
                                      space_group=ispgrp)
 
@@ -144,6 +251,39 @@ class XDS_ASCII:
     # read_header()
     
     def read_data(self):
+        columns = load_data_cache(self._filein) if self.use_cache else None
+
+        if columns is not None:
+            print >>self._log, "Reading data from cache: %s" % cache_file_name(self._filein)
+        else:
+            columns = read_data_columns(self._filein, self._colindex, self._data_offset)
+            if columns is None:
+                self.read_data_by_line()
+                return
+
+            if self.use_cache: save_data_cache(self._filein, columns)
+
+        self.indices = flex.miller_index(columns["indices"].tolist())
+        self.iobs, self.sigma_iobs = flex.double(columns["iobs"]), flex.double(columns["sigma_iobs"])
+        if not self.i_only:
+            is_xscale = "RLP" not in self._colindex
+            self.xd, self.yd, self.zd = [flex.double(columns[x]) for x in ("xd", "yd", "zd")]
+            iframe = columns["zd"].astype(numpy.int32) + 1
+            for z in columns["zd"][iframe < 0]:
+                print >>self._log, 'reflection with surprisingly low z-value:', z
+            iframe[iframe < 0] = 0
+            self.iframe = flex.int(iframe)
+            if not is_xscale:
+                self.rlp, self.peak, self.corr = [flex.double(columns[x]) for x in ("rlp", "peak", "corr")]
+            else:
+                self.iset = flex.int(columns["iset"])
+
+        self._num_hkl = self.iobs.size()
+        print >>self._log, "Reading data done.\n"
+
+    # read_data()
+
+    def read_data_by_line(self):
         colindex = self._colindex
         is_xscale = "RLP" not in colindex
         flag_data_start = False
@@ -190,13 +330,30 @@ class XDS_ASCII:
         self.iframe = flex.int(self.iframe)
         self.iset = flex.int(self.iset) # only for XSCALE
 
+        self._num_hkl = self.iobs.size()
         print >>self._log, "Reading data done.\n"
 
-    # read_data()
+    # read_data_by_line()
+
+    def get_num_hkl(self):
+        """number of reflections. Data block is scanned only at the first call if data were not read."""
+        if self._num_hkl is None:
+            if self._data_offset is None: self._num_hkl = 0
+            else: self._num_hkl = count_data_lines(self._filein, self._data_offset)
+        return self._num_hkl
+    # get_num_hkl()
 
     def get_frame_range(self): 
         """quick function only to get frame number range"""
 
+        columns = load_data_cache(self._filein) if self.use_cache else None
+        if columns is not None:
+            iframe = columns["zd"].astype(numpy.int32) + 1
+            positive = iframe[iframe > 0]
+            min_frame = int(positive.min()) if positive.size > 0 else float("inf")
+            max_frame = int(iframe.max()) if iframe.size > 0 else -float("inf")
+            return min_frame, max_frame
+
         flag_data_start = False
         col_zd = self._colindex["ZD"]
         min_frame, max_frame = float("inf"), -float("inf")
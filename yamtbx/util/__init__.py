@@ -252,6 +252,26 @@ def check_disk_free_bytes(d):
         return -1
 # check_disk_free_bytes()
 
+def is_local_filesystem(path):
+    """
+    True if path (or its nearest existing parent) is on a local file system, judged from /proc/mounts.
+    False for network file systems and when unknown.
+    """
+    path = os.path.realpath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path: path = os.path.dirname(path)
+
+    try:
+        mounts = map(lambda l: l.split()[1:3], open("/proc/mounts"))
+    except IOError:
+        return False
+
+    matched = filter(lambda x: path == x[0] or path.startswith(x[0].rstrip("/")+"/"), mounts)
+    if not matched: return False
+    fstype = max(matched, key=lambda x: len(x[0]))[1]
+    return fstype.split(".")[0] not in ("nfs", "nfs4", "cifs", "smbfs", "smb3", "afs", "lustre",
+                                        "gpfs", "ceph", "glusterfs", "fuse", "9p")
+# is_local_filesystem()
+
 def get_temp_local_dir(prefix, min_bytes=None, min_kb=None, min_mb=None, min_gb=None, additional_tmpd=None):
     assert (min_bytes, min_kb, min_mb, min_gb).count(None) >= 2
 
@@ -8,6 +8,8 @@ This software is released under the new BSD License; see LICENSE.
 
 import os, subprocess, re, threading, time, stat
 import shlex
+import getpass
+import sqlite3
 
 # JobState
 #  0: previous job is not finished.
@@ -39,15 +41,81 @@ echo finished at `date "+%Y-%m-%d %H:%M:%S"`
 class SgeError(Exception):
     pass
 
+class JobDB:
+    """
+    Small on-disk (sqlite3) database of job states, so that states of submitted jobs
+    survive restart of the program. A job is identified by (wdir, script_name).
+    """
+
+    def __init__(self, dbfile):
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(dbfile, timeout=60, check_same_thread=False)
+        self.con.execute("""create table if not exists jobs (wdir text, script_name text, engine text, job_id text,
+                                                             state text, updated real, primary key (wdir, script_name))""")
+        self.con.commit()
+    # __init__()
+
+    def update(self, j, engine, job_id=None):
+        with self.lock:
+            self.con.execute("insert or replace into jobs values (?,?,?,?,?,?)",
+                             (os.path.abspath(j.wdir), j.script_name, engine, job_id, j.state, time.time()))
+            self.con.commit()
+    # update()
+
+    def get(self, wdir, script_name):
+        """
+        Returns (engine, job_id, state) or None if unknown.
+        """
+        with self.lock:
+            cur = self.con.execute("select engine, job_id, state from jobs where wdir=? and script_name=?",
+                                   (os.path.abspath(wdir), script_name))
+            return cur.fetchone()
+    # get()
+# class JobDB
+
 class JobManager: # interface
-    def __init__(self): pass
+    engine = None # recorded in jobdb
+
+    def __init__(self, jobdb=None):
+        self.jobdb = jobdb
+    # __init__()
     def submit(self, j): pass
-    def update_stat(self, j): pass # update j's state to RUNNING/FINISHED
+    def update_state(self, j): pass # update j's state to RUNNING/FINISHED
+    def update_states(self, jobs):
+        for job in jobs: self.update_state(job)
+    # update_states()
     def stop_all(self):pass
+    def job_id_of(self, j): return None
+
+    def set_state(self, j, state):
+        j.state = state
+        if self.jobdb is not None:
+            self.jobdb.update(j, self.engine, self.job_id_of(j))
+    # set_state()
+
+    def reattach(self, j, job_id): return None # take over job submitted before restart
+
+    def restore_job(self, wdir, script_name, nproc=1):
+        """
+        Job object in the state recorded in jobdb.
+        Returns None if unknown, or it was left unfinished and cannot be taken over.
+        """
+        if self.jobdb is None: return None
+        rec = self.jobdb.get(wdir, script_name)
+        if rec is None: return None
+        engine, job_id, state = rec
+
+        j = Job(wdir, script_name, nproc=nproc)
+        j.state = state
+        if state in (STATE_FINISHED, STATE_FAILED): return j
+        if engine != self.engine: return None
+        return self.reattach(j, job_id)
+    # restore_job()
+
     def wait_all(self, jobs, interval=5, timeout=-1):
         acc = 0
         while True:
-            for job in jobs: self.update_state(job)
+            self.update_states(jobs)
             if all(map(lambda job: job.state==STATE_FINISHED, jobs)):
                 return True
 
@@ -57,13 +125,20 @@ class JobManager: # interface
     # wait_all()
 # class JobManager
 class LocalThread(threading.Thread):
-    def __init__(self, num_jobs):
+    """
+    Runs waiting jobs keeping at most num_jobs processes. Each process is waited (waitpid)
+    by a watcher thread, which wakes up this thread and callers of wait_jobs() when the process exits.
+    set_state(job, state) is called on every state change.
+    """
+    def __init__(self, num_jobs, set_state=None):
         self._stopevent = threading.Event()
-        self._sleepperiod = 1.0
+        self._cond = threading.Condition()
+        self._waiters = set() # Events of wait_jobs() calls
 
         self.num_jobs = num_jobs
         self.waiting_jobs = [] # [Job, ...]
         self.p_list = [] # running process list [(Job, subprocess.Popen), ..]
+        self.set_state = set_state if set_state else lambda j, state: setattr(j, "state", state)
 
         threading.Thread.__init__(self)
     # __init__()
@@ -76,34 +151,74 @@ class LocalThread(threading.Thread):
         return p
     # start_job()
 
-    def run(self):
-        while not self._stopevent.isSet():
-            # Change state if finished
-            for j, p in self.p_list:
-                if p.poll() is not None:
-                    j.state = STATE_FINISHED
+    def add_job(self, j):
+        with self._cond:
+            self.waiting_jobs.append(j)
+            self._cond.notify_all()
+    # add_job()
 
-            # Keep unfinished jobs
-            self.p_list = filter(lambda p: p[1].poll() is None, self.p_list)
+    def watch_process(self, j, p):
+        p.wait()
+        with self._cond:
+            self.p_list.remove((j, p))
+            if not self._stopevent.isSet(): self.set_state(j, STATE_FINISHED)
+            self._cond.notify_all()
+            for e in self._waiters: e.set()
+    # watch_process()
 
-            # Register new jobs
-            for i in range(self.num_jobs - len(self.p_list)):
-                # Start conversion
-                if len(self.waiting_jobs) > 0:
+    def run(self):
+        with self._cond:
+            while not self._stopevent.isSet():
+                # Register new jobs
+                while self.waiting_jobs and len(self.p_list) < self.num_jobs:
                     j = self.waiting_jobs.pop(0)
-                    self.p_list.append( (j, self.start_job(j)) )
-                    j.state = STATE_RUNNING
+                    p = self.start_job(j)
+                    self.p_list.append((j, p))
+                    self.set_state(j, STATE_RUNNING)
+                    watcher = threading.Thread(target=self.watch_process, args=(j, p))
+                    watcher.daemon = True
+                    watcher.start()
 
-            time.sleep(0.1)
+                self._cond.wait() # until a job is added or finished, or stopped
 
-        if self._stopevent.isSet():
             for j, p in self.p_list:
-                p.kill()
-                j.state = STATE_FAILED
+                if p.returncode is None:
+                    try: p.kill()
+                    except OSError: pass # already finished
+                self.set_state(j, STATE_FAILED)
     # run()
 
+    def wait_jobs(self, jobs, interval=5, timeout=-1):
+        """
+        Returns True when all jobs finished, or False if timed out or stopped.
+        Without timeout, this blocks until a process exits. With timeout, job states are checked
+        every interval seconds (waiting with timeout is not blocking in python2).
+        """
+        t0 = time.time()
+        event = threading.Event()
+        with self._cond: self._waiters.add(event)
+        try:
+            while True:
+                with self._cond:
+                    event.clear()
+                    if all(map(lambda job: job.state==STATE_FINISHED, jobs)): return True
+                    if self._stopevent.isSet(): return False
+
+                if timeout > 0:
+                    rest = t0 + timeout - time.time()
+                    if rest <= 0: return False
+                    time.sleep(min(interval, rest))
+                else:
+                    event.wait()
+        finally:
+            with self._cond: self._waiters.discard(event)
+    # wait_jobs()
+
     def join(self, timeout=None):
-        self._stopevent.set()
+        with self._cond:
+            self._stopevent.set()
+            self._cond.notify_all()
+            for e in self._waiters: e.set()
         threading.Thread.join(self, timeout)
     # join()
 
@@ -111,23 +226,28 @@ class LocalThread(threading.Thread):
 
 class ExecLocal(JobManager):
 
-    def __init__(self, max_parallel):
-        JobManager.__init__(self)
+    def __init__(self, max_parallel, jobdb=None):
+        JobManager.__init__(self, jobdb)
+        self.engine = "sh"
         self.num_jobs = max_parallel # referred by control tower when pickling
-        self._thread = LocalThread(num_jobs=self.num_jobs)
+        self._thread = LocalThread(num_jobs=self.num_jobs, set_state=self.set_state)
         self._thread.start()
 
     # __init__()
 
     def submit(self, j):
-        self._thread.waiting_jobs.append(j)
-        j.state = STATE_SUBMITTED
+        self.set_state(j, STATE_SUBMITTED)
+        self._thread.add_job(j)
     # submit()
 
     def update_state(self, j):
         # if running locally, state is changed during execution loop
         pass
 
+    def wait_all(self, jobs, interval=5, timeout=-1):
+        return self._thread.wait_jobs(jobs, interval, timeout)
+    # wait_all()
+
     def stop_all(self):
         self._thread.join()
 
@@ -135,7 +255,11 @@ class ExecLocal(JobManager):
 
 
 class SGE(JobManager):
-    def __init__(self, pe_name="par"):
+    def __init__(self, pe_name="par", jobdb=None, qstat_interval=5):
+        """
+        States of all jobs are obtained by one query (qstat_all_cmd), which is reused
+        for qstat_interval seconds unless a job was submitted after the query.
+        """
         qsub_found, qstat_found = False, False
 
         # for d in os.environ["PATH"].split(":"):
@@ -152,24 +276,39 @@ class SGE(JobManager):
             self.qsub_cmd = lambda job_name,cpu,script_name:"qsub -j y -pe %s %d %s" % (job_name, cpu, script_name)
             self.qsub_regex = r"^Your job ([0-9]+) "
             self.qstat_cmd = lambda job_id:"qstat -j %s" % job_id
+            self.qstat_all_cmd = "qstat -u %s" % getpass.getuser()
             self.qdel_cmd = lambda job_id:"qdel %s" % job_id
         elif self.engine == "pbs":
             self.qsub_cmd = lambda job_name,cpu,script_name:"qsub -j oe -N %s -l ncpus=%d %s" % (job_name, cpu, script_name)
             self.qsub_regex = r"^([0-9]+)"
             self.qstat_cmd = lambda job_id: "qstat  %s" % job_id
+            self.qstat_all_cmd = "qstat -u %s" % getpass.getuser()
             self.qdel_cmd = lambda job_id:"qdel %s" % job_id
         elif self.engine == "slurm":
             self.qsub_cmd = lambda job_name,cpu,script_name:"sbatch --job-name=%s --cpus-per-task=%d %s" % (job_name, cpu, script_name)
             self.qsub_regex =r"Submitted batch job ([0-9]+)"
             self.qstat_cmd = lambda job_id: "squeue -h --job=%s" % job_id
+            self.qstat_all_cmd = "squeue -h -o %%i -u %s" % getpass.getuser()
             self.qdel_cmd = lambda job_id:  "scancel %s" % job_id
         else:
             raise SgeError("cannot find qsub or sbatch command under $PATH")
-        JobManager.__init__(self)
+        JobManager.__init__(self, jobdb)
         self.pe_name = pe_name
         self.job_id = {} # [Job: jobid]
+        self.submit_time = {} # [Job: time]
+        self.qstat_interval = qstat_interval
+        self._queued_ids, self._queued_time = None, 0
     # __init__()
 
+    def job_id_of(self, j): return self.job_id.get(j)
+
+    def reattach(self, j, job_id):
+        if not job_id: return None
+        self.job_id[j] = job_id
+        self.submit_time[j] = 0
+        return j
+    # reattach()
+
     def submit(self, j):
         ##
         # submit script
@@ -198,6 +337,8 @@ class SGE(JobManager):
             raise SgeError("cannot read job-id from qsub result. please contact author. stdout is:\n" % stdout)
 
         self.job_id[j] = job_id
+        self.submit_time[j] = time.time()
+        self.set_state(j, STATE_SUBMITTED)
         print("Job %s on %s is started. id=%s"%(j.script_name, j.wdir, job_id))
 
     # submit()
@@ -205,18 +346,54 @@ class SGE(JobManager):
     def update_state(self, j):
         # if job_id is unknown (waiting or finished), state won't be changed
         if j in self.job_id:
-            status = self.qstat(self.job_id[j])
+            if time.time() - self._queued_time > self.qstat_interval or self._queued_time < self.submit_time[j]:
+                self.refresh_queued_ids()
+
+            if self._queued_ids is not None:
+                finished = self.job_id[j] not in self._queued_ids
+            else: # listing failed; ask about this job only
+                finished = self.qstat(self.job_id[j]) is None
 
-            if status is None: # if qsub failed, flagged as FINISHED
-                j.state = STATE_FINISHED
+            if finished: # if qsub failed, flagged as FINISHED
                 self.job_id.pop(j)
+                self.submit_time.pop(j)
+                self.set_state(j, STATE_FINISHED)
                 #j.check_after_run() # j.state may be changed to FAILED
 
-            else: # if qsub succeeded, RUNNING or WAITING.
-                j.state = STATE_RUNNING
+            elif j.state != STATE_RUNNING: # if qsub succeeded, RUNNING or WAITING.
+                self.set_state(j, STATE_RUNNING)
 
     # update_state()
 
+    def update_states(self, jobs):
+        self.refresh_queued_ids()
+        for job in jobs: self.update_state(job)
+    # update_states()
+
+    def refresh_queued_ids(self):
+        self._queued_time = time.time()
+        self._queued_ids = self.qstat_all()
+    # refresh_queued_ids()
+
+    def qstat_all(self):
+        """
+        Returns set of job ids in queue (waiting or running), or None if failed.
+        """
+        p = subprocess.Popen(self.qstat_all_cmd, shell=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+
+        if p.returncode != 0:
+            print "%s failed (returned %s)." % (self.qstat_all_cmd, p.returncode)
+            return None
+
+        ret = set()
+        for l in stdout.splitlines():
+            r = re.search("^ *([0-9]+)", l) # header lines are skipped
+            if r: ret.add(r.group(1))
+        return ret
+    # qstat_all()
+
     def qstat(self, job_id):
         cmd = self.qstat_cmd(job_id)
         p = subprocess.Popen(cmd, shell=True,
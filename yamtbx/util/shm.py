@@ -0,0 +1,91 @@
+"""
+(c) RIKEN 2017. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+numpy arrays on shared memory and a forked worker pool that passes only task ids.
+
+Arrays made by shared_empty() or shared_copy() before run_tasks() are inherited by
+the worker processes without being pickled or duplicated; workers can also write
+their (bulk) results into them.
+iter_tasks() is for many tasks whose results are consumed one by one; only a bounded
+number of results are held at once.
+"""
+
+import multiprocessing
+import multiprocessing.sharedctypes
+import collections
+import numpy
+
+def shared_empty(shape, dtype=numpy.float64):
+    """
+    Uninitialized numpy array allocated on shared memory.
+    """
+    dtype = numpy.dtype(dtype)
+    if not isinstance(shape, tuple): shape = (shape,)
+    n = int(numpy.prod(shape))
+    buf = multiprocessing.sharedctypes.RawArray("b", max(1, n * dtype.itemsize))
+    return numpy.frombuffer(buf, dtype=dtype, count=n).reshape(shape)
+# shared_empty()
+
+def shared_copy(arr):
+    ret = shared_empty(arr.shape, arr.dtype)
+    ret[...] = arr
+    return ret
+# shared_copy()
+
+_worker_func = None
+
+def _call_worker(task_id):
+    return _worker_func(task_id)
+# _call_worker()
+
+def run_tasks(func, task_ids, nproc=1):
+    """
+    Call func(task_id) for all task_ids and return list of the return values.
+    When nproc>1, func (and all objects it refers to) is inherited by forked processes,
+    and only integer task ids and return values are transferred.
+    Return values should be small; write bulk results into shared arrays.
+    """
+    global _worker_func
+    task_ids = list(task_ids)
+    if nproc < 2 or len(task_ids) < 2: return map(func, task_ids)
+
+    _worker_func = func # must be set before fork
+    pool = multiprocessing.Pool(min(nproc, len(task_ids)))
+    try:
+        return pool.map(_call_worker, task_ids, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _worker_func = None
+# run_tasks()
+
+def iter_tasks(func, task_ids, nproc=1, max_pending=None):
+    """
+    Generator of func(task_id) for all task_ids, in the same order.
+    As in run_tasks(), func is inherited by forked processes. At most max_pending tasks
+    (default: 2*nproc) are submitted ahead of the consumer, so memory held by results
+    does not grow with the number of tasks even when the consumer is slower than workers.
+    """
+    global _worker_func
+    if nproc < 2:
+        for t in task_ids: yield func(t)
+        return
+
+    if max_pending is None: max_pending = 2 * nproc
+    _worker_func = func # must be set before fork
+    pool = multiprocessing.Pool(nproc)
+    try:
+        pending = collections.deque()
+        for t in task_ids:
+            pending.append(pool.apply_async(_call_worker, (t,)))
+            if len(pending) >= max(1, max_pending): yield pending.popleft().get()
+        while pending: yield pending.popleft().get()
+    finally:
+        pool.terminate() # all results were received unless the consumer stopped early
+        pool.join()
+        _worker_func = None
+# iter_tasks()